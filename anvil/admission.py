@@ -0,0 +1,83 @@
+'''
+Admission control for the routes other actors call, so a flood from one host, or from many, is turned away
+cheaply and the app keeps serving everyone else:
+
+1. Each peer has a token bucket per route, refilled at a rate per second up to a burst, set with ANVIL_RATE_LIMITS,
+   e.g. *=5/20,/verinym_request=1/5 (* is every other route, 5/20 the default). A rate of 0 turns the limit off.
+2. Routes that decrypt or write to the ledger as the message arrives also take one of ANVIL_MAX_EXPENSIVE slots (default 8),
+   shared by all the apps in the process. Up to ANVIL_ADMISSION_QUEUE requests (default 16) wait for a slot,
+   within their deadline, and the rest are shed.
+3. Both checks run before the body is read or anything is decrypted. Rate limited requests get a 429, shed ones a 503,
+   with Retry-After.
+4. Buckets are kept for the ANVIL_RATE_PEERS (default 10000) most recently seen peers and routes per app.
+5. Messages delivered in memory by actors in the same process (see host.py) are not limited.
+'''
+
+import asyncio, os, time
+from collections import OrderedDict
+from sovrin.deadlines import within, DeadlineExceeded
+
+
+# Route: (tokens per second, burst), from e.g. '*=5/20,/verinym_request=1/5'
+def parse_limits(text):
+    limits = {}
+    for item in (item.strip() for item in text.split(',') if item.strip()):
+        route, _, limit = item.partition('=')
+        rate, _, burst = limit.partition('/')
+        limits[route.strip()] = (float(rate), float(burst or max(float(rate), 1)))
+    return limits
+
+
+LIMITS = dict({'*': (5.0, 20.0)}, **parse_limits(os.getenv('ANVIL_RATE_LIMITS', '')))
+MAX_EXPENSIVE = int(os.getenv('ANVIL_MAX_EXPENSIVE', 8))
+QUEUE = int(os.getenv('ANVIL_ADMISSION_QUEUE', 16))
+MAX_PEERS = int(os.getenv('ANVIL_RATE_PEERS', 10000))
+# Seconds shed requests are asked to wait before trying again
+RETRY_AFTER = 1
+
+# Slots for expensive routes, for every app in the process
+slots = {'semaphore': asyncio.Semaphore(MAX_EXPENSIVE), 'running': 0, 'waiting': 0, 'capacity': MAX_EXPENSIVE}
+
+
+def setup_admission(routes, limits = LIMITS, max_peers = MAX_PEERS):
+    return {
+        'routes': {route: limits.get(route, limits['*']) for route in routes},
+        'buckets': OrderedDict(), # (peer, route): (tokens, updated), least recently seen first
+        'max_peers': max_peers
+    }
+
+
+# Takes a token from the peer's bucket for the route. Returns 0 if one was there, otherwise the seconds until there is one.
+def take_token(admission, peer, route, now = None):
+    rate, burst = admission['routes'][route]
+    if not rate:
+        return 0
+    now = time.monotonic() if now is None else now
+    buckets = admission['buckets']
+    # New peers start with a full bucket
+    tokens, updated = buckets.pop((peer, route), (burst, now))
+    tokens = min(burst, tokens + (now - updated) * rate)
+    buckets[(peer, route)] = (tokens - 1 if tokens >= 1 else tokens, now)
+    while len(buckets) > admission['max_peers']:
+        buckets.popitem(last = False)
+    return 0 if tokens >= 1 else (1 - tokens) / rate
+
+
+# Waits for a slot for an expensive route, within the request's deadline. Returns False if the request is shed.
+async def acquire_slot():
+    if slots['running'] + slots['waiting'] >= slots['capacity'] + QUEUE:
+        return False
+    slots['waiting'] += 1
+    try:
+        await within(slots['semaphore'].acquire())
+    except DeadlineExceeded:
+        return False
+    finally:
+        slots['waiting'] -= 1
+    slots['running'] += 1
+    return True
+
+
+def release_slot():
+    slots['running'] -= 1
+    slots['semaphore'].release()
@@ -0,0 +1,148 @@
+'''
+Actions behind the apps' forms, also served as a versioned JSON API for machine clients:
+
+1. Each action is registered with the fields it takes and their types, and returns a JSON-serialisable dict.
+2. The page routes run the same actions with their form fields, so both stay in step.
+3. Errors have a code and an HTTP status, e.g. invalid_request (400) or nothing_pending (409),
+   and a message which the pages show as before.
+4. A batch runs several actions in order in one request, so a client pays for one round trip and one state sync.
+'''
+
+import json
+from sovrin.deadlines import within, DeadlineExceeded
+
+
+VERSION = 1
+
+# Error codes and their HTTP status
+ERRORS = {
+    'invalid_request': 400, # Missing or mistyped fields, or content that could not be parsed
+    'not_found': 404, # Unknown action, schema or template
+    'nothing_pending': 409, # No message waiting for this action, or a step before it missing
+    'conflict': 409, # Done already, e.g. setting up an actor that is set up
+    'rejected': 422, # The exchange failed a check, e.g. a proof failed verification
+    'skipped': 424, # Not run, an earlier action in the batch failed
+    'failed': 500, # Anything else, see the detail
+    'deadline_exceeded': 504 # A peer, the pool or the OEF took longer than the request's deadline, see sovrin/deadlines.py
+}
+
+
+class APIError(Exception):
+
+    def __init__(self, code, message, detail = None):
+        super().__init__(message)
+        self.code = code
+        self.status = ERRORS[code]
+        self.message = message
+        self.detail = detail
+
+    def body(self):
+        error = {'code': self.code, 'message': self.message}
+        if self.detail is not None:
+            error['detail'] = self.detail
+        return {'ok': False, 'error': error}
+
+
+# Marks a field as optional, e.g. revocable = optional(bool).
+class optional:
+
+    def __init__(self, *types):
+        self.types = types
+
+
+'''
+Registers an action with the types of its fields, e.g.
+@action(actions, 'offer_credential', schema_name = str, ip_address = str)
+A field given several types accepts any of them, e.g. schema = (dict, str) for an object or its JSON string.
+'''
+def action(actions, action_name, **fields):
+    def register(function):
+        actions[action_name] = {'function': function, 'fields': fields}
+        return function
+    return register
+
+
+def field_types(spec):
+    return spec.types if isinstance(spec, optional) else spec if isinstance(spec, tuple) else (spec,)
+
+
+def type_names(spec):
+    return [{dict: 'object', list: 'array', str: 'string', bool: 'boolean', int: 'integer', float: 'number'}[type_] for type_ in field_types(spec)]
+
+
+# The actions and their fields, served at GET /api/v1.
+def describe_actions(actions):
+    return {
+        name: {field: {'types': type_names(spec), 'required': not isinstance(spec, optional)}
+               for field, spec in entry['fields'].items()}
+        for name, entry in actions.items()
+    }
+
+
+def validate(fields, body):
+    if not isinstance(body, dict):
+        raise APIError('invalid_request', 'Fields must be a JSON object.')
+    unknown = [field for field in body if field not in fields]
+    if unknown:
+        raise APIError('invalid_request', 'Unknown fields: ' + ', '.join(unknown) + '.')
+    for field, spec in fields.items():
+        if field not in body:
+            if not isinstance(spec, optional):
+                raise APIError('invalid_request', 'Missing field ' + field + '.')
+            continue
+        types = field_types(spec)
+        # bool is an int in Python, do not let true through as a number
+        if not isinstance(body[field], types) or (isinstance(body[field], bool) and bool not in types):
+            raise APIError('invalid_request', 'Field ' + field + ' must be ' + ' or '.join(type_names(spec)) + '.')
+    return body
+
+
+# Runs an action within the request's deadline, cancelling it when the deadline passes.
+async def run(actions, name, body):
+    if name not in actions:
+        raise APIError('not_found', 'Unknown action ' + name + '.')
+    entry = actions[name]
+    try:
+        return await within(entry['function'](validate(entry['fields'], body))) or {}
+    except DeadlineExceeded as ex:
+        raise APIError('deadline_exceeded', 'Action ' + name + ' ran out of time.', str(ex))
+
+
+# Runs an action for the JSON API, returning the response body and status.
+async def respond(actions, name, body):
+    try:
+        return {'ok': True, 'result': await run(actions, name, body)}, 200
+    except APIError as ex:
+        return ex.body(), ex.status
+    except Exception as ex:
+        return APIError('failed', 'Action ' + name + ' failed.', repr(ex)).body(), 500
+
+
+'''
+Runs a batch, {"requests": [{"action": "setup", "fields": {}}, ...], "stop_on_error": true},
+in order, returning a result or an error for each. Actions after a failed one are skipped with stop_on_error.
+'''
+async def respond_batch(actions, body):
+    if not isinstance(body, dict) or not isinstance(body.get('requests'), list):
+        return APIError('invalid_request', 'A batch needs a list of requests.').body(), 400
+    results = []
+    failed = False
+    for item in body['requests']:
+        if failed and body.get('stop_on_error', True):
+            results.append(APIError('skipped', 'Skipped after an earlier error.').body())
+            continue
+        if not isinstance(item, dict) or not isinstance(item.get('action'), str):
+            results.append(APIError('invalid_request', 'Each request needs an action name.').body())
+        else:
+            results.append((await respond(actions, item['action'], item.get('fields', {})))[0])
+        failed = failed or not results[-1]['ok']
+    return {'ok': not failed, 'results': results}, 200
+
+
+# Fields given as an object or as a JSON string, as forms send them.
+def as_object(value):
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def as_string(value):
+    return value if isinstance(value, str) else json.dumps(value)
@@ -5,28 +5,69 @@ For fine-grained control, use the functions in the Sovrin folder.
 '''
 
 
-import os, requests, json
-from quart import request, redirect, url_for
-from sovrin.utilities import generate_base58
-from sovrin.setup import setup_pool, set_self_up, teardown
+import asyncio, contextvars, hmac, os, requests, json, time
+from urllib.parse import urlsplit
+from quart import request, redirect, url_for, g, jsonify, make_response, current_app
+from sovrin.metrics import describe, inc, observe, render, register_collector
+from sovrin.revocation import revocation_cache
+from sovrin.encoding import cache_info as encoding_cache_info
+from sovrin.tracing import span, traceparent, from_traceparent
+from sovrin.profiling import profile, start, stop, status
+from sovrin.events import log, counts as event_counts
+from sovrin.deadlines import set_deadline, reset_deadline, remaining, deadline_header, within, DeadlineExceeded, HEADER as DEADLINE_HEADER
+from sovrin.setup import setup_pool, set_self_up, teardown_actors, wallet_config, wallet_credentials, wallet_key, cached_handles
+from sovrin.backend import wallet
 from sovrin.onboarding import onboarding_anchor_send, onboarding_anchor_receive, onboarding_anchor_register_onboardee_did, onboarding_onboardee_reply, onboarding_onboardee_create_did
+from inbox import enqueue, peek, take, dead_letter, clear_inboxes
+from admission import setup_admission, take_token, acquire_slot, release_slot, slots, RETRY_AFTER
+from store import open_store, encode, decode, merge, assign
+from updates import Hub, stream, show
+from api import APIError, VERSION, describe_actions, respond, respond_batch
+
+
+# Shared by every app in the process, see host.py: one pool, one HTTP session, and the apps served here by port.
+pools = {}
+session = requests.Session()
+local_apps = {}
+# Deliveries handed over to apps in the process by common_outbound(), until they finish
+deliveries = set()
+LOCAL_HOSTS = ['127.0.0.1', 'localhost', '::1', '0.0.0.0'] + [address for address in os.getenv('ANVIL_HOST_ADDRESSES', '').split(',') if address]
+# The tenant whose app is loading or serving a request, see tenants.py, and the tenant that last wrote to each peer
+current_tenant = contextvars.ContextVar('tenant', default = None)
+tenant_peers = {}
+
+
+# The actor's name qualified by its tenant, e.g. issuer_acme, to keep tenants' wallets and metrics apart.
+def common_actor_name(actor):
+    tenant = current_tenant.get()
+    return actor + '_' + tenant if tenant else actor
+
+
+# Opens the pool once per process, actors set up concurrently wait for the same one.
+async def common_pool(net = 'local'):
+    if net not in pools:
+        pools[net] = asyncio.ensure_future(setup_pool(net))
+    try:
+        _, pool_handle = await pools[net]
+    except Exception:
+        # Let the next setup try again
+        pools.pop(net, None)
+        raise
+    return pool_handle
 
 
 # Steward has unique setup from seed, does not use this
 async def common_setup(name):
-    _, pool_handle = await setup_pool('local')
-    id_ = os.getenv('WALLET_ID', generate_base58(64))
-    key = os.getenv('WALLET_KEY', generate_base58(64))
-    actor = await set_self_up(name, id_, key, pool_handle)
+    pool_handle = await common_pool('local')
+    id_, key, key_method = await wallet_key(common_actor_name(name))
+    actor = await set_self_up(name, id_, key, pool_handle, key_method = key_method)
     return actor, pool_handle
 
 
-async def common_connection_request(anchor):
-    form = await request.form
-    ip = form['ip_address']
-    name = ''.join(e for e in form['name'] if e.isalnum())
+async def common_connection_request(anchor, ip, name):
+    name = ''.join(e for e in name if e.isalnum())
     anchor, connection_request = await onboarding_anchor_send(anchor, name)
-    requests.post('http://' + ip + '/receive', json = connection_request)
+    await common_post('http://' + ip + '/receive', json = connection_request)
     return anchor, name
 
 
@@ -47,25 +88,563 @@ async def common_verinym_request(anchor, counterparty_name):
 
 
 
-async def common_respond(onboardee, received_data, pool_handle, anchor_port):
-    anchor_ip = request.remote_addr
+# The anchor IP should be the sender of the connection request, falls back to the caller of this route.
+async def common_respond(onboardee, received_data, pool_handle, anchor_port, anchor_ip = None):
+    anchor_ip = anchor_ip or request.remote_addr
     data = json.loads(received_data)
     onboardee, anoncrypted_connection_response = await onboarding_onboardee_reply(onboardee, data, pool_handle)
     onboardee['connection_response'] = json.loads(onboardee['connection_response'])
-    requests.post('http://' + anchor_ip + ':' + str(anchor_port) + '/establish_channel', anoncrypted_connection_response)
+    await common_post('http://' + anchor_ip + ':' + str(anchor_port) + '/establish_channel', anoncrypted_connection_response)
     return onboardee, anchor_ip
 
 
 async def common_get_verinym(onboardee, anchor_ip, anchor_port):
     onboardee, authcrypted_did_info = await onboarding_onboardee_create_did(onboardee)
-    requests.post('http://' + anchor_ip + ':' + str(anchor_port) + '/verinym_request', authcrypted_did_info)
+    await common_post('http://' + anchor_ip + ':' + str(anchor_port) + '/verinym_request', authcrypted_did_info)
     return onboardee
 
 
 
+'''
+Queues the body of an inbound message with the sender's IP.
+Duplicates are acknowledged but not queued again, a full inbox answers 429 so the sender can back off.
+'''
+async def common_enqueue(inbox):
+    received_data = await request.data
+    outcome = enqueue(inbox, received_data, request.remote_addr)
+    if outcome == 'full':
+        return 'Inbox full. Retry later.', 429
+    if outcome == 'queued':
+        common_publish('inbox', {'inbox': inbox['name'], 'sender': request.remote_addr, 'waiting': len(inbox['messages'])})
+    return '200'
+
+
+# Inboxes being worked through by a request, by id, so a concurrent request leaves their messages to it
+processing = set()
+
+
+'''
+Handles the messages queued in an inbox one at a time, oldest first, with await handle(message).
+Each message is taken only once it is handled. One that fails is logged and moved to the inbox's dead letters,
+so it does not hold up the rest, and one that runs out of time stays queued for the next request.
+Returns the errors of the messages that failed, by digest.
+'''
+async def common_process(inbox, handle):
+    failed = {}
+    if id(inbox) in processing:
+        return failed
+    processing.add(id(inbox))
+    try:
+        while peek(inbox):
+            message = peek(inbox)
+            try:
+                await handle(message)
+            except DeadlineExceeded:
+                raise
+            except Exception as ex:
+                failed[message['digest']] = repr(ex)
+                log('message_failed', 'Could not handle a message from ' + message['sender'], level = 'warning', inbox = inbox['name'], sender = message['sender'], error = repr(ex))
+                # Unless a reset cleared the inbox meanwhile
+                if peek(inbox) is message:
+                    dead_letter(inbox, repr(ex))
+                continue
+            if peek(inbox) is message:
+                take(inbox)
+    finally:
+        processing.discard(id(inbox))
+    return failed
+
+
+
+'''
+Soft reset: drops the exchanges in flight, i.e. the given artefacts (see retention.py) and the messages in the inboxes.
+Keeps the pool, wallet, Verinym, connections and credential definitions, so there is nothing to set up again.
+Reset actions are soft when asked with soft, or by default with ANVIL_RESET=soft.
+'''
+def common_soft_reset(actor, inboxes, artefacts):
+    schema = actor.get('unique_schema_name', '')
+    for key in artefacts:
+        actor.pop(key.format(schema = schema), None)
+    clear_inboxes(inboxes)
+    return actor
+
+
+SOFT_VALUES = {'true': True, '1': True, 'soft': True, 'false': False, '0': False, 'hard': False}
+
+
+# Form fields are strings, so 'false' asks for a hard reset rather than counting as set.
+def common_soft(fields):
+    soft = fields.get('soft')
+    if soft is None or soft == '':
+        return os.getenv('ANVIL_RESET') == 'soft'
+    if isinstance(soft, bool):
+        return soft
+    if str(soft).lower() not in SOFT_VALUES:
+        raise APIError('invalid_request', 'Field soft must be true or false.')
+    return SOFT_VALUES[str(soft).lower()]
+
+
+# The pool stays open for the other actors in the process and the next setup.
 async def common_reset(actor_list, pool_handle):
-    await teardown('ANVIL', pool_handle, actor_list)
+    await teardown_actors(actor_list)
     for actor in actor_list:
         actor = {}
     pool_handle = 1
     return actor, pool_handle
+
+
+
+describe('anvil_http_requests_total', 'counter', 'Requests served by actor, route, method and status.', ('actor', 'route', 'method', 'status'))
+describe('anvil_http_request_seconds', 'histogram', 'Time to serve requests by actor, route and method.', ('actor', 'route', 'method'))
+describe('anvil_outbound_seconds', 'histogram', 'Duration of requests to other actors by method and path.', ('method', 'path'))
+describe('anvil_outbound_errors_total', 'counter', 'Requests to other actors that failed or got an error status, by method and path.', ('method', 'path'))
+
+
+'''
+Adds a /metrics endpoint in the Prometheus text format and times every route of the app.
+Inbox depths and counters are reported for the inboxes given, labelled with the actor's name.
+'''
+def common_instrument(app, inboxes = {}, actor = None):
+    actor = common_actor_name(actor or app.name)
+
+    @app.before_request
+    async def start_timer():
+        g.started = time.perf_counter()
+        # Everything the route calls out to runs within its deadline, see sovrin/deadlines.py
+        g.deadline = set_deadline(request.headers.get(DEADLINE_HEADER))
+        # Continue the caller's trace if it sent one, otherwise begin a new one
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.span = span('HTTP ' + request.method + ' ' + route, from_traceparent(request.headers.get('traceparent')),
+                      method = request.method, route = route).__enter__()
+        g.profile = profile(route).__enter__()
+
+    @app.after_request
+    async def record_request(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        inc('anvil_http_requests_total', actor, route, request.method, str(response.status_code))
+        observe('anvil_http_request_seconds', time.perf_counter() - g.started, actor, route, request.method)
+        g.span.attributes['status'] = response.status_code
+        g.span.__exit__(None, None, None)
+        return response
+
+    # Also runs when a route raises, so a profile is never left running
+    @app.teardown_request
+    async def end_profile(exception):
+        if 'profile' in g:
+            g.profile.__exit__(None, None, None)
+        if 'deadline' in g:
+            reset_deadline(g.deadline)
+
+    @app.route('/metrics')
+    async def metrics():
+        return render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    '''
+    Profiles routes and Sovrin steps for a while, e.g. /profile/start?names=/verify,verify_proof&mode=sample&seconds=60.
+    See sovrin/profiling.py for the modes and output files. Only for administrators, see common_admin().
+    '''
+    @app.route('/profile/start', methods = ['GET', 'POST'])
+    async def profile_start():
+        if not common_admin():
+            return jsonify({'error': 'Only from this machine or with the admin token.'}), 403
+        names = request.args.get('names', '*').split(',')
+        try:
+            return jsonify(start(names, request.args.get('mode', 'sample'), float(request.args.get('seconds', 60))))
+        except ValueError as ex:
+            return jsonify({'error': str(ex)}), 400
+
+    @app.route('/profile/stop', methods = ['GET', 'POST'])
+    async def profile_stop():
+        if not common_admin():
+            return jsonify({'error': 'Only from this machine or with the admin token.'}), 403
+        return jsonify({'written': stop()})
+
+    @app.route('/profile')
+    async def profile_status():
+        if not common_admin():
+            return jsonify({'error': 'Only from this machine or with the admin token.'}), 403
+        return jsonify(status())
+
+    def collect():
+        samples = []
+        for name, inbox in inboxes.items():
+            samples.append(('anvil_inbox_messages', 'gauge', 'Messages waiting in each inbox (in-flight exchanges).', {'actor': actor, 'inbox': name}, len(inbox['messages'])))
+            for outcome in ('accepted', 'duplicates', 'rejected', 'failed'):
+                samples.append(('anvil_inbox_' + outcome + '_total', 'counter', 'Inbound messages ' + outcome + ' by inbox.', {'actor': actor, 'inbox': name}, inbox[outcome]))
+        return samples
+
+    app.extensions['anvil_collector'] = collect
+    register_collector(collect)
+    register_collector(collect_process)
+    return app
+
+
+describe('anvil_admission_rejected_total', 'counter', 'Requests turned away before they ran, by actor, route and reason (rate_limited or overloaded).', ('actor', 'route', 'reason'))
+
+
+'''
+Admission control for the routes other actors call (see admission.py): a token bucket per peer and route,
+and for the expensive routes, those that decrypt or write to the ledger as the message arrives, a cap shared by the apps in the process.
+Call after common_instrument(), so turned away requests are still counted and timed.
+'''
+def common_admission(app, routes, expensive = (), actor = None):
+    actor = common_actor_name(actor or app.name)
+    admission = setup_admission(routes)
+
+    @app.before_request
+    async def admit():
+        route = request.url_rule.rule if request.url_rule else None
+        if route not in admission['routes'] or request.scope.get('anvil_local'):
+            return None
+        wait = take_token(admission, request.remote_addr, route)
+        if wait:
+            inc('anvil_admission_rejected_total', actor, route, 'rate_limited')
+            return 'Rate limited. Retry later.', 429, {'Retry-After': str(max(int(wait + 0.999), 1))}
+        if route in expensive:
+            if not await acquire_slot():
+                inc('anvil_admission_rejected_total', actor, route, 'overloaded')
+                log('request_shed', 'Shed a request to ' + route + ', too many in progress', level = 'warning', actor = actor, route = route, sender = request.remote_addr)
+                return 'Overloaded. Retry later.', 503, {'Retry-After': str(RETRY_AFTER)}
+            g.slot = True
+
+    @app.teardown_request
+    async def release(exception):
+        if g.pop('slot', None):
+            release_slot()
+
+    return app
+
+
+'''
+Whether the request may use the administration routes, e.g. /profile: from a loopback address,
+or from elsewhere with the token in ANVIL_ADMIN_TOKEN as Authorization: Bearer [token]. Without the token set, loopback only.
+'''
+def common_admin():
+    if request.remote_addr in ('127.0.0.1', '::1'):
+        return True
+    token = os.getenv('ANVIL_ADMIN_TOKEN')
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)
+
+
+# Samples shared by all the apps in the process, registered once.
+def collect_process():
+    samples = []
+    lookups = revocation_cache['hits'] + revocation_cache['misses']
+    samples.append(('anvil_cache_hits_total', 'counter', 'Cache hits by cache.', {'cache': 'revocation'}, revocation_cache['hits']))
+    samples.append(('anvil_cache_misses_total', 'counter', 'Cache misses by cache.', {'cache': 'revocation'}, revocation_cache['misses']))
+    samples.append(('anvil_cache_hit_ratio', 'gauge', 'Share of cache lookups that hit, by cache.', {'cache': 'revocation'}, revocation_cache['hits'] / lookups if lookups else 0))
+    encoding = encoding_cache_info()
+    samples.append(('anvil_cache_hits_total', 'counter', 'Cache hits by cache.', {'cache': 'encoding'}, encoding.hits))
+    samples.append(('anvil_cache_misses_total', 'counter', 'Cache misses by cache.', {'cache': 'encoding'}, encoding.misses))
+    samples.append(('anvil_cache_hit_ratio', 'gauge', 'Share of cache lookups that hit, by cache.', {'cache': 'encoding'}, encoding.hits / (encoding.hits + encoding.misses) if encoding.hits + encoding.misses else 0))
+    samples.append(('anvil_admission_running', 'gauge', 'Expensive requests running, across the apps in the process.', {}, slots['running']))
+    samples.append(('anvil_admission_waiting', 'gauge', 'Expensive requests waiting for a slot.', {}, slots['waiting']))
+    samples.append(('anvil_admission_capacity', 'gauge', 'Expensive requests that can run at once (ANVIL_MAX_EXPENSIVE).', {}, slots['capacity']))
+    for outcome in ('logged', 'dropped', 'sampled_out'):
+        samples.append(('anvil_log_events_total', 'counter', 'Event log entries by outcome (logged, dropped on a full queue, or sampled out).', {'outcome': outcome}, event_counts[outcome]))
+    return samples
+
+
+'''
+Adds /events, a stream of server-sent events of the actor's state (see updates.py) for the page and other subscribers.
+view_state() returns the flags the page is rendered with, changes are pushed after each request.
+'''
+def common_updates(app, view_state):
+    hub = app.extensions['anvil_updates'] = Hub(view_state)
+    app.add_template_global(show)
+
+    @app.after_request
+    async def push_changes(response):
+        hub.refresh()
+        return response
+
+    @app.route('/events')
+    async def events():
+        response = await make_response(stream(hub), 200, {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        response.timeout = None # Open for as long as the subscriber listens
+        return response
+
+    return hub
+
+
+# Pushes an event, e.g. common_publish('proof_verified', report), to the app's /events subscribers.
+def common_publish(event, data = None):
+    hub = current_app.extensions.get('anvil_updates')
+    if hub:
+        hub.publish(event, data)
+
+
+'''
+Runs an action (see api.py) with the page's form fields, then shows the page again.
+Errors from the action are shown as their message, as the forms always have.
+'''
+async def common_form(function):
+    try:
+        await within(function(await request.form))
+    except APIError as ex:
+        return ex.message
+    except DeadlineExceeded as ex:
+        return 'Ran out of time. ' + str(ex)
+    return redirect(url_for('index'))
+
+
+'''
+Serves the app's actions as JSON under /api/v1, for machine clients. Nothing is rendered:
+GET /api/v1 lists the actions and their fields, GET /api/v1/state returns the page's flags,
+POST /api/v1/<action> runs one, and POST /api/v1/batch runs several in order.
+'''
+def common_api(app, actor, actions, view_state):
+    prefix = '/api/v' + str(VERSION)
+
+    async def body():
+        data = await request.get_data()
+        fields = json.loads(data) if data.strip() else None
+        return {} if fields is None else fields
+
+    @app.route(prefix)
+    async def api_index():
+        return jsonify({'actor': actor, 'version': VERSION, 'actions': describe_actions(actions)})
+
+    @app.route(prefix + '/state')
+    async def api_state():
+        return jsonify({'ok': True, 'result': view_state()})
+
+    @app.route(prefix + '/batch', methods = ['POST'])
+    async def api_batch():
+        try:
+            result, status = await respond_batch(actions, await body())
+        except ValueError:
+            result, status = APIError('invalid_request', 'Body is not valid JSON.').body(), 400
+        return jsonify(result), status
+
+    @app.route(prefix + '/<name>', methods = ['POST'])
+    async def api_action(name):
+        try:
+            result, status = await respond(actions, name, await body())
+        except ValueError:
+            result, status = APIError('invalid_request', 'Body is not valid JSON.').body(), 400
+        return jsonify(result), status
+
+    return app
+
+
+# Handles that belong to the worker process, never shared through the store.
+WORKER_KEYS = ('wallet', 'pool')
+
+
+'''
+Shares the app's globals between workers through the store set with ANVIL_STORE (see store.py), e.g.
+common_state(app, 'issuer', globals(), ['issuer', 'anchor_ip', 'inboxes']), the actor's dict first.
+Before a request the worker takes in changes made by the others, after it the worker's own changes are merged in.
+Each worker opens the pool and the actor's wallet itself, and keeps the pool handle in the pool_handle global.
+Without ANVIL_STORE the state stays in the process as before.
+'''
+def common_state(app, key, scope, names):
+    if not os.getenv('ANVIL_STORE'):
+        return None
+    state = {'store': open_store(os.getenv('ANVIL_STORE')), 'synced': None, 'version': 0, 'lock': asyncio.Lock(), 'wallets': {}}
+
+    def shared():
+        actor = {name: value for name, value in scope[names[0]].items() if name not in WORKER_KEYS}
+        return encode(dict({names[0]: actor}, **{name: scope[name] for name in names[1:]}))
+
+    async def open_handles(actor):
+        for config in [config for config in state['wallets'] if config != actor.get('wallet_config')]:
+            handle = state['wallets'].pop(config)
+            if handle in cached_handles():
+                continue # Kept open by the reset for the next setup
+            try:
+                await wallet.close_wallet(handle)
+            except Exception:
+                pass # Already deleted by the worker that reset the actor
+        if 'wallet_config' not in actor:
+            return
+        if actor['wallet_config'] not in state['wallets']:
+            try:
+                state['wallets'][actor['wallet_config']] = await wallet.open_wallet(wallet_config('open', actor['wallet_config']),
+                                                                                    wallet_credentials('open', actor['wallet_credentials']))
+            except Exception as ex:
+                log('wallet_unavailable', 'Could not open the actor wallet in this worker', level = 'error', actor = key, error = repr(ex))
+                return
+        actor['wallet'] = state['wallets'][actor['wallet_config']]
+        actor['pool'] = scope['pool_handle'] = await common_pool('local')
+
+    async def sync():
+        async with state['lock']:
+            actor = scope[names[0]]
+            if 'wallet' in actor and 'wallet_config' in actor:
+                state['wallets'][actor['wallet_config']] = actor['wallet']
+            ours = shared()
+            if state['synced'] is None:
+                latest, state['version'] = await state['store'].get(key)
+                if latest is None:
+                    latest, state['version'] = await state['store'].update(key, lambda theirs: theirs or ours)
+            elif ours != state['synced']:
+                base = state['synced']
+                latest, state['version'] = await state['store'].update(key, lambda theirs: merge(base, ours, theirs or base))
+            elif await state['store'].version(key) != state['version']:
+                latest, state['version'] = await state['store'].get(key)
+            else:
+                return
+            for name in names:
+                if name in latest:
+                    scope[name] = assign(scope[name], decode(latest[name]))
+            state['synced'] = latest
+            await open_handles(scope[names[0]])
+
+    @app.before_request
+    async def take_in_changes():
+        await sync()
+
+    @app.after_request
+    async def share_changes(response):
+        await sync()
+        return response
+
+    return state
+
+
+'''
+Runs the app with Quart's development server, or in production with Hypercorn when ANVIL_WORKERS is set,
+e.g. ANVIL_WORKERS=4 to use four cores. Several workers share their state through ANVIL_STORE,
+which defaults to a SQLite file named after the app.
+'''
+def common_run(app, name, host, port, debug = False):
+    workers = int(os.getenv('ANVIL_WORKERS', 0))
+    if not workers:
+        app.run(host, port, debug)
+        return
+    from hypercorn.config import Config
+    from hypercorn.run import run
+    if workers > 1 and not os.getenv('ANVIL_STORE'):
+        # Inherited by the workers
+        os.environ['ANVIL_STORE'] = 'sqlite://' + os.path.abspath('anvil_' + name + '_state.db')
+    config = Config()
+    config.bind = [host + ':' + str(port)]
+    config.workers = workers
+    config.application_path = name + ':app'
+    run(config)
+
+
+'''
+Requests to other actors, timed and counted in the metrics by URL path, awaited e.g. await common_post(url, data).
+Pass a label such as '/tails/<tails_hash>' for paths with IDs in them to keep the number of series small.
+The blocking request runs off the event loop within the http budget, so the other apps in the process keep serving
+and the route's deadline stops the wait. Messages to an actor served from the same process are delivered in memory, see common_deliver().
+'''
+async def common_post(url, data = None, label = None, **kwargs):
+    return await common_request('POST', url, label, data = data, **kwargs)
+
+
+# As common_post(), e.g. tails = await common_get(url).
+async def common_get(url, label = None, **kwargs):
+    return await common_request('GET', url, label, **kwargs)
+
+
+# One to an app in the process is delivered in memory and awaited, answering with the app's own response.
+async def common_request(method, url, label = None, **kwargs):
+    app = common_local_app(url)
+    if app is None:
+        return await within(asyncio.to_thread(common_outbound, method, url, label, **kwargs), 'http')
+    return await within(common_deliver(app, url, label or urlsplit(url).path, method = method, **outbound_args(url, kwargs)), 'http')
+
+
+# Headers and timeout for a request to another actor, noting the peer for the tenant sending it.
+def outbound_args(url, kwargs):
+    if traceparent():
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, traceparent = traceparent())
+    # The actor called works to the same deadline, and a peer that does not answer in time is given up on
+    kwargs['headers'] = dict(kwargs.get('headers') or {}, **deadline_header())
+    kwargs.setdefault('timeout', remaining('http'))
+    if current_tenant.get():
+        # Replies from the peer without the tenant's path go to this tenant
+        tenant_peers[urlsplit(url).hostname] = current_tenant.get()
+    return kwargs
+
+
+# Blocking requests to other actors, for callers that cannot await. Use common_post() and common_get() in routes.
+def common_outbound(method, url, label = None, **kwargs):
+    path = label or urlsplit(url).path
+    started = time.perf_counter()
+    kwargs = outbound_args(url, kwargs)
+    app = common_local_app(url) if method == 'POST' else None
+    if app is not None:
+        # A blocking request to our own process would never be answered, so hand it over and carry on
+        delivery = asyncio.get_running_loop().create_task(common_deliver(app, url, path, **kwargs))
+        # Referenced until done, so it is not garbage collected on the way
+        deliveries.add(delivery)
+        delivery.add_done_callback(deliveries.discard)
+        response = requests.Response()
+        response.status_code = 202
+        return response
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.Timeout as ex:
+        inc('anvil_outbound_errors_total', method, path)
+        raise DeadlineExceeded(method + ' ' + url + ' took longer than ' + '{:.1f}'.format(kwargs['timeout']) + 's.') from ex
+    except requests.RequestException:
+        inc('anvil_outbound_errors_total', method, path)
+        raise
+    finally:
+        observe('anvil_outbound_seconds', time.perf_counter() - started, method, path)
+    if response.status_code >= 400:
+        inc('anvil_outbound_errors_total', method, path)
+    return response
+
+
+def common_local_app(url):
+    parts = urlsplit(url)
+    if parts.port in local_apps and parts.hostname in LOCAL_HOSTS:
+        return local_apps[parts.port]
+    return None
+
+
+'''
+Delivers a request to an app in this process through its ASGI interface, without a socket, and returns the response.
+The receiver sees the URL's host as the sender's address, as it would over loopback.
+'''
+async def common_deliver(app, url, path, data = None, headers = None, method = 'POST', **kwargs):
+    parts = urlsplit(url)
+    body = data.encode('utf-8') if isinstance(data, str) else bytes(data or b'')
+    headers = dict(headers or {})
+    if kwargs.get('json') is not None:
+        body = json.dumps(kwargs['json']).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    headers.update({'Host': parts.netloc, 'Content-Length': str(len(body))})
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+        'path': parts.path, 'raw_path': parts.path.encode('utf-8'), 'query_string': parts.query.encode('utf-8'), 'root_path': '',
+        'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()],
+        'client': (parts.hostname, 0), 'server': (parts.hostname, parts.port), 'extensions': {},
+        # Not rate limited, see common_admission()
+        'anvil_local': True
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response = requests.Response()
+    response.status_code = 500
+    chunks = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # The sender never disconnects, the app stops listening once it has answered
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response.status_code = message['status']
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    started = time.perf_counter()
+    try:
+        await app(scope, receive, send)
+    except Exception as ex:
+        log('local_delivery_failed', 'Delivery to a co-located actor failed', level = 'error', url = url, error = repr(ex))
+        response.status_code = 500
+    observe('anvil_outbound_seconds', time.perf_counter() - started, method, path)
+    if response.status_code >= 400:
+        inc('anvil_outbound_errors_total', method, path)
+    response._content = b''.join(chunks)
+    response.url = url
+    return response
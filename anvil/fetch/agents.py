@@ -4,19 +4,40 @@ Fetch AEA functions:
 1. Search the OEF.
 2. Offer a Fetch service.
 3. Purchase a Fetch service.
+
+Searches and purchases are awaited, e.g. await search(terms). They wait for their agent within the request's deadline
+and the oef budget (see sovrin/deadlines.py), without holding up the event loop.
 '''
 
 
-import subprocess
+import asyncio, os, signal, subprocess
+from sovrin.deadlines import within, DeadlineExceeded
+
+
+# Runs an agent to completion, killing it and everything it started if it runs out of time. The event loop keeps serving meanwhile.
+async def run_agent(command):
+    process = await asyncio.create_subprocess_shell(command, start_new_session = True)
+    try:
+        return await within(process.wait(), 'oef')
+    except (DeadlineExceeded, asyncio.CancelledError) as ex:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(process.wait()), 5)
+        except asyncio.TimeoutError:
+            os.killpg(process.pid, signal.SIGKILL)
+            await asyncio.shield(process.wait())
+        if isinstance(ex, DeadlineExceeded):
+            raise DeadlineExceeded('The OEF agent ran out of time: ' + command) from ex
+        raise
 
 
-def search(search_terms, path_to_fetch_folder = './fetch', net = 'test'):
-    subprocess.run('python3 ' + path_to_fetch_folder + '/searcher.py ' + search_terms + ' ' + net, shell = True)
+async def search(search_terms, path_to_fetch_folder = './fetch', net = 'test'):
+    await run_agent('python3 ' + path_to_fetch_folder + '/searcher.py ' + search_terms + ' ' + net)
 
 
 def offer_service(price, service_path, path_to_fetch_folder = './fetch', net = 'test'):
     subprocess.Popen('python3 ' + path_to_fetch_folder + '/prover.py ' + service_path + ' ' + str(price) + ' ' + net, shell = True)
 
 
-def purchase_service(max_price, search_terms, path_to_fetch_folder = './fetch', net = 'test'):
-    subprocess.run('python3 ' + path_to_fetch_folder + '/verifier.py ' + search_terms + ' ' + str(max_price) + ' ' + net, shell = True)
+async def purchase_service(max_price, search_terms, path_to_fetch_folder = './fetch', net = 'test'):
+    await run_agent('python3 ' + path_to_fetch_folder + '/verifier.py ' + search_terms + ' ' + str(max_price) + ' ' + net)
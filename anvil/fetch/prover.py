@@ -2,10 +2,13 @@
 Prover: AEA receiving the CFP.
 '''
 
-import json, sys
+import json, os, sys
+# The agents run as scripts from this folder, so make the sovrin modules importable as in the apps.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from oef.agents import OEFAgent
 from oef.schema import AttributeSchema, DataModel, Description
 from oef.messages import CFP_TYPES
+from sovrin.events import log
 
 
 class Prover(OEFAgent):
@@ -21,24 +24,24 @@ class Prover(OEFAgent):
 
     # Send a Propose to the sender of the CFP.
     def on_cfp(self, msg_id: int, dialogue_id: int, origin: str, target: int, query: CFP_TYPES):
-        print("[{0}]: Received CFP from {1}".format(self.public_key, origin))
+        log('fetch_cfp', 'Received CFP', agent = self.public_key, origin = origin)
         proposal = Description({"price": self.price})
-        print("[{}]: Sending propose at price: {}".format(self.public_key, self.price))
+        log('fetch_propose', 'Sending propose', agent = self.public_key, price = self.price)
         self.send_propose(msg_id + 1, dialogue_id, origin, target + 1, [proposal])
 
 
     # Send data if Proposal accepted
     def on_accept(self, msg_id: int, dialogue_id: int, origin: str, target: int):
-        print("[{0}]: Received accept from {1}.".format(self.public_key, origin))
+        log('fetch_accept', 'Received accept', agent = self.public_key, origin = origin)
         encoded_data = json.dumps(self.data).encode("utf-8")
-        print("[{0}]: Sending data to {1}: {2}".format(self.public_key, origin, self.data))
+        log('fetch_send_data', 'Sending data', agent = self.public_key, origin = origin, data = self.data)
         self.send_message(0, dialogue_id, origin, encoded_data)
         self.stop()
 
 
     # Send data if Proposal accepted
     def on_decline(self, msg_id: int, dialogue_id: int, origin: str, target: int):
-        print("[{0}]: Received decline from {1}.".format(self.public_key, origin))
+        log('fetch_decline', 'Received decline', agent = self.public_key, origin = origin)
         self.stop()
 
 
@@ -70,7 +73,7 @@ if __name__ == '__main__':
     agent = Prover('Prover', oef_addr = oef, oef_port = 3333, data_model_json = data_model_json, service_description_json = service_description_json, data_to_send_json = data_to_send_json, price = price)
     agent.connect()
     agent.register_service(0, agent.service)
-    print('Fetch service offered...')
+    log('fetch_service_offered', 'Fetch service offered...', price = price)
     try:
         agent.run()
     finally:
@@ -2,12 +2,15 @@
 Verifier: AEA sending the CFP.
 '''
 
-import json, sys
+import json, os, sys
+# The agents run as scripts from this folder, so make the sovrin modules importable as in the apps.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from typing import List
 from oef.agents import OEFAgent
 from oef.schema import AttributeSchema, DataModel
 from oef.messages import PROPOSE_TYPES
 from oef.query import Query, Constraint, Eq
+from sovrin.events import log
 
 
 class Verifier(OEFAgent):
@@ -21,28 +24,28 @@ class Verifier(OEFAgent):
     # For every agent returned in the service search, send a CFP to obtain resources from them.
     def on_search_result(self, search_id: int, agents: List[str]):
         if len(agents) == 0:
-            print('[{}]: No agent found. Stopping...'.format(self.public_key))
+            log('fetch_search_result', 'No agent found. Stopping...', agent = self.public_key)
             self.stop()
             return
-        print('[{0}]: Agent found: {1}'.format(self.public_key, agents))
+        log('fetch_search_result', 'Agents found', agent = self.public_key, agents = agents)
         # 'None' query returns all the resources the prover can propose.
         for agent in agents:
-            print('[{0}]: Sending to agent {1}'.format(self.public_key, agent))
+            log('fetch_cfp', 'Sending CFP', agent = self.public_key, to = agent)
             query = None
             self.send_cfp(1, 0, agent, 0, query)
 
 
     # Accept Proposals that this agent sent a CFP for.
     def on_propose(self, msg_id: int, dialogue_id: int, origin: str, target: int, proposals: PROPOSE_TYPES):
-        print('[{0}]: Received propose from agent {1}'.format(self.public_key, origin))
+        log('fetch_propose', 'Received propose', agent = self.public_key, origin = origin, proposals = len(proposals))
         for i, p in enumerate(proposals):
-            print('[{0}]: Proposal {1}: {2}'.format(self.public_key, i, p.values))
+            log('fetch_proposal', 'Proposal', level = 'debug', agent = self.public_key, index = i, values = p.values)
             if p.values['price'] > self.price_threshold:
-                print('[{0}]: Declining Propose.'.format(self.public_key))
+                log('fetch_decline', 'Declining propose', agent = self.public_key, price = p.values['price'])
                 self.send_decline(msg_id, dialogue_id, origin, msg_id + 1)
                 self.stop()
                 return
-        print('[{0}]: Accepting Propose.'.format(self.public_key))
+        log('fetch_accept', 'Accepting propose', agent = self.public_key)
         self.send_accept(msg_id, dialogue_id, origin, msg_id + 1)
         self.stop()
 
@@ -50,7 +53,7 @@ class Verifier(OEFAgent):
     # Get data from incoming messages from the prover.
     def on_message(self, msg_id: int, dialogue_id: int, origin: str, content: bytes):
         data = json.loads(content.decode('utf-8'))
-        print('[{0}]: Received measurement from {1}: {2}'.format(self.public_key, origin, data))
+        log('fetch_data_received', 'Received measurement', agent = self.public_key, origin = origin, data = data)
         self.stop()
 
 
@@ -0,0 +1,65 @@
+'''
+Runs several actors in one process, on one event loop:
+
+1. Each actor's app keeps its own port (5000-5003), pages and routes, so the actors' addresses do not change.
+2. The actors share one pool handle, one HTTP session, and the revocation and tails caches.
+3. Messages from one actor to another in the process are delivered in memory rather than over loopback HTTP.
+
+Run from this folder, for all four actors or a few:
+python3 host.py
+ANVIL_HOST_ACTORS=issuer,prover python3 host.py
+Add this machine's other addresses to ANVIL_HOST_ADDRESSES (e.g. 192.168.1.10) if actors are given those.
+'''
+
+import asyncio, importlib, os
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from common import local_apps
+
+
+ACTORS = ('steward', 'issuer', 'prover', 'verifier')
+host = '0.0.0.0'
+
+
+# Loads the actors' apps and registers them by port, so common_outbound() knows they are local.
+def mount(names):
+    for name in names:
+        if name not in ACTORS:
+            raise ValueError('Unknown actor ' + name + ', choose from ' + ', '.join(ACTORS) + '.')
+        module = importlib.import_module(name)
+        module.app.secret_key = os.getenv('ANVIL_KEY', 'MUST_BE_STATIC')
+        local_apps[module.port] = module.app
+    return local_apps
+
+
+# ASGI app passing each connection to the actor app for the port it came in on.
+async def host_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    app = local_apps.get(scope['server'][1]) if scope.get('server') else None
+    if app is None:
+        await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'No actor on this port.'})
+        return
+    await app(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            for app in local_apps.values():
+                await app.startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for app in local_apps.values():
+                await app.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+if __name__ == '__main__':
+    mount(os.getenv('ANVIL_HOST_ACTORS', ','.join(ACTORS)).split(','))
+    config = Config()
+    config.bind = [host + ':' + str(port) for port in local_apps]
+    asyncio.run(serve(host_app, config))
@@ -0,0 +1,90 @@
+'''
+Bounded inboxes for inbound actor endpoints.
+
+Each inbound endpoint queues messages instead of writing a single global slot,
+so concurrent senders cannot overwrite each other:
+
+1. Messages keep the sender's IP so replies go back to the right peer.
+2. Messages are deduplicated by SHA-256 digest over a sliding window.
+3. Full inboxes reject new messages, which endpoints turn into a 429.
+4. Consumers peek/take one message at a time or drain a batch.
+5. Messages that fail to be handled are moved to the inbox's dead letters, so they do not hold up the rest.
+'''
+
+import hashlib, os, time
+from collections import deque, OrderedDict
+
+
+def setup_inbox(name, max_size = 256):
+    return {
+        'name': name,
+        'max_size': max_size,
+        'messages': deque(),
+        'seen': OrderedDict(), # Digest window for deduplication, oldest first
+        'dead_letters': deque(), # Messages that failed, with the error, most recent max_size kept
+        'accepted': 0,
+        'duplicates': 0,
+        'rejected': 0,
+        'failed': 0
+    }
+
+
+# Inbox size can be set with the ANVIL_INBOX_SIZE environment variable.
+def setup_inboxes(names):
+    max_size = int(os.getenv('ANVIL_INBOX_SIZE', 256))
+    return {name: setup_inbox(name, max_size) for name in names}
+
+
+# Returns one of 'queued', 'duplicate' or 'full'.
+def enqueue(inbox, data, sender):
+    digest = hashlib.sha256(data).hexdigest()
+    if digest in inbox['seen']:
+        inbox['duplicates'] += 1
+        return 'duplicate'
+    if len(inbox['messages']) >= inbox['max_size']:
+        inbox['rejected'] += 1
+        return 'full'
+    inbox['messages'].append({
+        'sender': sender,
+        'digest': digest,
+        'data': data,
+        'received': time.time()
+    })
+    inbox['seen'][digest] = True
+    # Window is a few inboxes deep so retransmissions of recently consumed messages are still caught
+    while len(inbox['seen']) > 4 * inbox['max_size']:
+        inbox['seen'].popitem(last = False)
+    inbox['accepted'] += 1
+    return 'queued'
+
+
+def peek(inbox):
+    return inbox['messages'][0] if inbox['messages'] else None
+
+
+def take(inbox):
+    return inbox['messages'].popleft() if inbox['messages'] else None
+
+
+def drain(inbox, limit = None):
+    count = len(inbox['messages']) if limit is None else min(limit, len(inbox['messages']))
+    return [inbox['messages'].popleft() for _ in range(count)]
+
+
+# Moves the message at the head of the inbox to its dead letters, with the error it failed with.
+def dead_letter(inbox, error):
+    message = take(inbox)
+    if message is None:
+        return None
+    inbox['dead_letters'].append(dict(message, error = error, failed = time.time()))
+    while len(inbox['dead_letters']) > inbox['max_size']:
+        inbox['dead_letters'].popleft()
+    inbox['failed'] += 1
+    return message
+
+
+def clear_inboxes(inboxes):
+    for inbox in inboxes.values():
+        inbox['messages'].clear()
+        inbox['seen'].clear()
+        inbox['dead_letters'].clear()
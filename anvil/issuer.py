@@ -1,8 +1,14 @@
 import os, requests, json, time
 from quart import Quart, render_template, redirect, url_for, request
-from common import common_setup, common_respond, common_get_verinym, common_reset, common_connection_request, common_establish_channel, common_verinym_request
-from sovrin.schema import create_schema, create_credential_definition
+from common import common_setup, common_respond, common_get_verinym, common_reset, common_connection_request, common_establish_channel, common_verinym_request, common_enqueue, common_post, common_instrument, common_admission, common_state, common_run, common_updates, common_publish, common_form, common_api, common_soft, common_soft_reset
+from api import APIError, action, optional, as_object
+from inbox import setup_inboxes, peek, take, clear_inboxes
+from sovrin.schema import create_schema, create_credential_definition, find_definition
+from sovrin.catalogue import load_catalogue, catalogue_entries, register_catalogue
 from sovrin.credentials import offer_credential, create_and_send_credential
+from sovrin.revocation import revoke_credential, has_tails, iter_tails
+from sovrin.retention import retention_from_env, retire_artefacts, ISSUER_ARTEFACTS
+from sovrin.events import log
 app = Quart(__name__)
 
 debug = False # Do not enable in production
@@ -14,15 +20,24 @@ prover_port = 5002
 
 # We use globals for our server-side session since this is not supported in Quart yet.
 issuer = {}
-request_ip = anchor_ip = received_data = counterparty_name = False
+anchor_ip = counterparty_name = False
 pool_handle = 1
-created_schema = []
+retention = retention_from_env()
+inboxes = setup_inboxes(['receive', 'credential_request'])
+common_instrument(app, inboxes, 'issuer')
+# The routes peers call, and those of them that decrypt or write to the ledger straight away
+common_admission(app, ['/receive', '/establish_channel', '/verinym_request', '/credential_request'], ['/establish_channel', '/verinym_request'], 'issuer')
+common_state(app, 'issuer', globals(), ['issuer', 'anchor_ip', 'counterparty_name', 'inboxes'])
 
 
-@app.route('/')
-def index():
+# Flags for the page and for /events subscribers.
+def view_state():
     setup = True if issuer else False
-    have_data = True if received_data else False
+    connection_request = peek(inboxes['receive'])
+    have_data = True if connection_request else False
+    connection_ip = connection_request['sender'] if connection_request else False
+    credential_request = peek(inboxes['credential_request'])
+    credential_request_ip = credential_request['sender'] if credential_request else False
     responded = True if 'connection_response' in issuer else False
     '''
     The onboardee depends on the anchor to finish establishing the secure channel.
@@ -34,46 +49,89 @@ def index():
     channel_established = True if anchor_ip else False
     prover_registered = True if 'prover_ip' in issuer else False
     have_verinym = True if 'did_info' in issuer else False
-    credential_requested = True if 'authcrypted_cred_request' in issuer else False
-    created_schema_string = ', '.join(schema for schema in created_schema)
-    return render_template('issuer.html', actor = 'ISSUER', setup = setup, have_data = have_data, request_ip = request_ip, responded = responded, channel_established = channel_established, have_verinym = have_verinym, created_schema = created_schema_string, prover_registered = prover_registered, credential_requested = credential_requested)
- 
+    credential_requested = True if credential_request else False
+    created_schema_string = ', '.join(issuer.get('definitions', {}))
+    return {
+        'setup': setup,
+        'have_data': have_data,
+        'connection_ip': connection_ip,
+        'credential_request_ip': credential_request_ip,
+        'responded': responded,
+        'channel_established': channel_established,
+        'have_verinym': have_verinym,
+        'created_schema': created_schema_string,
+        'prover_registered': prover_registered,
+        'credential_requested': credential_requested
+    }
 
-@app.route('/setup', methods = ['GET', 'POST'])
-async def setup():
+
+@app.route('/')
+def index():
+    return render_template('issuer.html', actor = 'ISSUER', **view_state())
+
+
+common_updates(app, view_state)
+actions = {}
+common_api(app, 'issuer', actions, view_state)
+
+
+@action(actions, 'setup')
+async def do_setup(fields):
     global issuer, pool_handle
+    if issuer:
+        raise APIError('conflict', 'Already set up. Reset first.')
     issuer, pool_handle = await common_setup('issuer')
-    return redirect(url_for('index'))
+
+
+@app.route('/setup', methods = ['GET', 'POST'])
+async def setup():
+    return await common_form(do_setup)
 
 
 @app.route('/receive', methods = ['GET', 'POST'])
 async def data():
-    global received_data, request_ip
-    received_data = await request.data
-    request_ip = request.remote_addr
-    print(received_data)
-    return '200'
+    log('message_received', 'Message received', route = '/receive', sender = request.remote_addr, payload = await request.data)
+    return await common_enqueue(inboxes['receive'])
+
+
+@action(actions, 'respond')
+async def do_respond(fields):
+    global issuer, anchor_ip
+    message = peek(inboxes['receive'])
+    if not message:
+        raise APIError('nothing_pending', 'No connection request waiting.')
+    issuer, anchor_ip = await common_respond(issuer, message['data'], pool_handle, anchor_port, message['sender'])
+    take(inboxes['receive'])
+    return {'anchor_ip': anchor_ip}
 
 
 @app.route('/respond', methods = ['GET', 'POST'])
 async def respond():
-    global issuer, anchor_ip
-    issuer, anchor_ip = await common_respond(issuer, received_data, pool_handle, anchor_port)
-    return redirect(url_for('index'))
+    return await common_form(do_respond)
 
 
-@app.route('/get_verinym', methods = ['GET', 'POST'])
-async def get_verinym():
+@action(actions, 'get_verinym')
+async def do_get_verinym(fields):
     global issuer
     issuer = await common_get_verinym(issuer, anchor_ip, anchor_port)
-    return redirect(url_for('index'))
+    return {'did': issuer['did']}
+
+
+@app.route('/get_verinym', methods = ['GET', 'POST'])
+async def get_verinym():
+    return await common_form(do_get_verinym)
+
+
+@action(actions, 'connection_request', ip_address = str, name = str)
+async def do_connection_request(fields):
+    global issuer, counterparty_name
+    issuer, counterparty_name = await common_connection_request(issuer, fields['ip_address'], fields['name'])
+    return {'name': counterparty_name}
 
 
 @app.route('/connection_request', methods = ['GET', 'POST'])
 async def connection_request():
-    global issuer, counterparty_name
-    issuer, counterparty_name = await common_connection_request(issuer)
-    return redirect(url_for('index'))
+    return await common_form(do_connection_request)
 
 
 @app.route('/establish_channel', methods = ['GET', 'POST'])
@@ -93,62 +151,127 @@ async def verinym_request():
 
 
 '''
-Set revocation support here if needed.
+Revocation support is set with the revocable checkbox.
+Revocable credentials get a revocation registry whose tails file provers download from /tails.
 '''
+@action(actions, 'create_credential', schema = (dict, str), revocable = optional(bool))
+async def do_create_credential(fields):
+    global issuer
+    try:
+        schema = as_object(fields['schema'])
+        unique_schema_name, schema_id, issuer = await create_schema(schema, issuer)
+        issuer = await create_credential_definition(issuer, schema_id, unique_schema_name, revocable = bool(fields.get('revocable')))
+    except Exception as ex:
+        raise APIError('invalid_request', 'Invalid schema. Check formatting.', repr(ex))
+    return {'schema_name': unique_schema_name, 'schema_id': schema_id, 'cred_def_id': issuer[unique_schema_name + '_cred_def_id']}
+
+
 @app.route('/create_credential', methods = ['GET', 'POST'])
 async def create_credential():
-    global issuer, created_schema
+    return await common_form(do_create_credential)
+
+
+'''
+Registers the schemas and definitions of a catalogue that are not on the ledger and in the wallet yet (see sovrin/catalogue.py).
+Give the path of a folder or manifest on this machine, e.g. ./example_data, or the manifest itself.
+'''
+@action(actions, 'register_catalogue', path = optional(str), manifest = optional(list))
+async def do_register_catalogue(fields):
+    global issuer
+    if 'did_info' not in issuer:
+        raise APIError('nothing_pending', 'Get a Verinym before registering schemas.')
     try:
-        form = await request.form
-        schema = json.loads(form['schema'])
-        unique_schema_name, schema_id, issuer = await create_schema(schema, issuer)
-        issuer = await create_credential_definition(issuer, schema_id, unique_schema_name, revocable = False)
-        created_schema.append(unique_schema_name)
-        return redirect(url_for('index'))
-    except:
-        return 'Invalid schema. Check formatting.'
+        entries = catalogue_entries(fields['manifest']) if fields.get('manifest') else load_catalogue(fields['path'])
+    except Exception as ex:
+        raise APIError('invalid_request', 'Invalid catalogue. Check the path and formatting.', repr(ex))
+    issuer, report = await register_catalogue(issuer, entries)
+    return report
+
+
+@app.route('/register_catalogue', methods = ['GET', 'POST'])
+async def register_catalogue_():
+    return await common_form(do_register_catalogue)
 
 
 
+@action(actions, 'offer_credential', schema_name = str, ip_address = str)
+async def do_offer_credential(fields):
+    global issuer
+    # By unique schema name, schema ID or credential definition ID
+    unique_schema_name, _ = find_definition(issuer, fields['schema_name'])
+    if not unique_schema_name:
+        raise APIError('not_found', 'Schema does not exist. Check name input.')
+    issuer, cred_offer = await offer_credential(issuer, unique_schema_name)
+    await common_post('http://' + fields['ip_address'] + '/credential_inbox', cred_offer)
+
+
 @app.route('/offer_credential', methods = ['GET', 'POST'])
 async def offer_credential_to_ip():
-    global issuer
-    form = await request.form
-    schema_name = form['schema_name']
-    if schema_name in created_schema:
-        issuer, cred_offer = await offer_credential(issuer, schema_name)
-        requests.post('http://' + form['ip_address'] + '/credential_inbox', cred_offer)
-        return redirect(url_for('index'))
-    else:
-        return 'Schema does not exist. Check name input.'
+    return await common_form(do_offer_credential)
 
 
 @app.route('/credential_request', methods = ['GET', 'POST'])
 async def credential_request():
-    global issuer, request_ip
-    issuer['authcrypted_cred_request'] = await request.data
-    # Old request IP now has name anchor IP so can safely overwrite
-    request_ip = request.remote_addr
-    return '200'
+    return await common_enqueue(inboxes['credential_request'])
+
+
+@action(actions, 'send_credential')
+async def do_send_credential(fields):
+    global issuer, retention
+    message = peek(inboxes['credential_request'])
+    if not message:
+        raise APIError('nothing_pending', 'No credential request waiting.')
+    issuer['authcrypted_cred_request'] = message['data']
+    issuer, credential = await create_and_send_credential(issuer)
+    await common_post('http://' + message['sender'] + ':' + str(prover_port) + '/credential_store', credential)
+    # Hides send credential function until next credential request
+    take(inboxes['credential_request'])
+    retention, issuer = retire_artefacts(retention, issuer, ISSUER_ARTEFACTS)
+    sent = {'prover': message['sender'], 'schema': issuer.get('unique_schema_name')}
+    common_publish('credential_sent', sent)
+    return sent
 
 
 @app.route('/send_credential', methods = ['GET', 'POST'])
 async def send_credential():
+    return await common_form(do_send_credential)
+
+
+@action(actions, 'revoke_credential', schema_name = str, cred_rev_id = (str, int))
+async def do_revoke_credential(fields):
     global issuer
-    issuer, credential = await create_and_send_credential(issuer)
-    requests.post('http://' + request_ip + ':' + str(prover_port) + '/credential_store', credential)
-    # Hides send credential function until next credential request
-    issuer.pop('authcrypted_cred_request', None)
-    return redirect(url_for('index'))
+    if fields['schema_name'] + '_rev_reg_id' not in issuer:
+        raise APIError('not_found', 'Schema does not exist or is not revocable. Check name input.')
+    issuer = await revoke_credential(issuer, fields['schema_name'], str(fields['cred_rev_id']))
 
 
-@app.route('/reset')
-async def reset():
-    global issuer, pool_handle, received_data, anchor_ip
+@app.route('/revoke_credential', methods = ['GET', 'POST'])
+async def revoke():
+    return await common_form(do_revoke_credential)
+
+
+# Served from the memory-mapped file, without reading it into memory.
+@app.route('/tails/<tails_hash>')
+async def tails(tails_hash):
+    if not tails_hash.isalnum() or not has_tails(tails_hash):
+        return 'Unknown tails file.', 404
+    return iter_tails(tails_hash), 200, {'Content-Type': 'application/octet-stream'}
+
+
+@action(actions, 'reset', soft = optional(bool))
+async def do_reset(fields):
+    global issuer, pool_handle, anchor_ip
+    if common_soft(fields):
+        issuer = common_soft_reset(issuer, inboxes, ISSUER_ARTEFACTS)
+        return {'soft': True}
     issuer, pool_handle = await common_reset([issuer], pool_handle)
-    received_data = False
+    clear_inboxes(inboxes)
     anchor_ip = False
-    return redirect(url_for('index'))
+
+
+@app.route('/reset', methods = ['GET', 'POST'])
+async def reset():
+    return await common_form(do_reset)
 
 
 @app.route('/reload')
@@ -158,4 +281,4 @@ def reload():
 
 if __name__ == '__main__':
     app.secret_key = os.getenv('ANVIL_KEY', 'MUST_BE_STATIC')
-    app.run(host, port, debug)
+    common_run(app, 'issuer', host, port, debug)
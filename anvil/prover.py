@@ -1,8 +1,12 @@
-import os, requests, json, time, subprocess
+import os, requests, json, time, subprocess, hashlib
 from quart import Quart, render_template, redirect, url_for, request
-from common import common_setup, common_respond, common_get_verinym, common_reset
+from common import common_setup, common_respond, common_get_verinym, common_reset, common_enqueue, common_process, common_post, common_instrument, common_admission, common_get, common_state, common_run, common_updates, common_publish, common_form, common_api, common_soft, common_soft_reset
+from api import APIError, action, optional, as_object, as_string
+from inbox import setup_inboxes, peek, take, clear_inboxes
 from sovrin.credentials import receive_credential_offer, request_credential, store_credential
 from sovrin.proofs import create_proof_of_credential
+from sovrin.revocation import has_tails, store_tails
+from sovrin.retention import retention_from_env, retire_artefacts, PROVER_CREDENTIAL_ARTEFACTS, PROVER_PROOF_ARTEFACTS
 from fetch.agents import offer_service
 app = Quart(__name__)
 
@@ -15,15 +19,23 @@ verifier_port = 5003
 
 # We use globals for our server-side session since this is not supported in Quart yet.
 prover = {}
-request_ip = anchor_ip = received_data = multiple_onboard = service_published = False
+anchor_ip = multiple_onboard = service_published = False
 pool_handle = 1
 stored_credentials = []
+retention = retention_from_env()
+inboxes = setup_inboxes(['receive', 'credential_inbox', 'credential_store', 'proof_request'])
+common_instrument(app, inboxes, 'prover')
+# The routes peers call, and those of them that decrypt or write to the ledger straight away
+common_admission(app, ['/receive', '/credential_inbox', '/credential_store', '/proof_request'], ['/credential_store'], 'prover')
+common_state(app, 'prover', globals(), ['prover', 'anchor_ip', 'multiple_onboard', 'service_published', 'stored_credentials', 'inboxes'])
 
 
-@app.route('/')
-def index():
+# Flags for the page and for /events subscribers.
+def view_state():
     setup = True if prover else False
-    have_data = True if received_data else False
+    connection_request = peek(inboxes['receive'])
+    have_data = True if connection_request else False
+    request_ip = connection_request['sender'] if connection_request else False
     responded = True if 'connection_response' in prover else False
     '''
     The onboardee depends on the anchor to finish establishing the secure channel.
@@ -35,132 +47,214 @@ def index():
     channel_established = True if anchor_ip else False
     have_verinym = True if 'did_info' in prover else False
     unique_schema_name = prover['unique_schema_name'] if 'unique_schema_name' in prover else False
-    have_proof_request = True if 'authcrypted_proof_request' in prover else False
+    proof_request = peek(inboxes['proof_request'])
+    have_proof_request = True if proof_request else False
+    proof_request_ip = proof_request['sender'] if proof_request else False
     stored_credentials_string = ', '.join(credential for credential in stored_credentials)
     # If stored credentials == credential offer, hide credential request
-    return render_template('prover.html', actor = 'PROVER', setup = setup, have_data = have_data, request_ip = request_ip, responded = responded, channel_established = channel_established, have_verinym = have_verinym, stored_credentials = stored_credentials_string, unique_schema_name = unique_schema_name, have_proof_request = have_proof_request, multiple_onboard = multiple_onboard, service_published = service_published)
- 
+    credential_offered = True if unique_schema_name and unique_schema_name != stored_credentials_string else False
+    return {
+        'setup': setup,
+        'have_data': have_data,
+        'request_ip': request_ip,
+        'responded': responded,
+        'channel_established': channel_established,
+        'have_verinym': have_verinym,
+        'stored_credentials': stored_credentials_string,
+        'unique_schema_name': unique_schema_name,
+        'credential_offered': credential_offered,
+        'have_proof_request': have_proof_request,
+        'proof_request_ip': proof_request_ip,
+        'multiple_onboard': multiple_onboard,
+        'service_published': service_published
+    }
 
-@app.route('/setup', methods = ['GET', 'POST'])
-async def setup():
+
+@app.route('/')
+def index():
+    return render_template('prover.html', actor = 'PROVER', **view_state())
+
+
+common_updates(app, view_state)
+actions = {}
+common_api(app, 'prover', actions, view_state)
+
+
+@action(actions, 'setup')
+async def do_setup(fields):
     global prover, pool_handle
+    if prover:
+        raise APIError('conflict', 'Already set up. Reset first.')
     prover, pool_handle = await common_setup('prover')
-    return redirect(url_for('index'))
 
 
-@app.route('/publish_service', methods = ['GET', 'POST'])
-async def publish_service():
+@app.route('/setup', methods = ['GET', 'POST'])
+async def setup():
+    return await common_form(do_setup)
+
+
+@action(actions, 'publish_service', servicepath = str, price = (str, int, float))
+async def do_publish_service(fields):
     global service_published
-    form = await request.form
-    service_path = form['servicepath']
-    price = form['price']
-    offer_service(price, service_path)
+    offer_service(fields['price'], fields['servicepath'])
     service_published = True
-    return redirect(url_for('index'))
+
+
+@app.route('/publish_service', methods = ['GET', 'POST'])
+async def publish_service():
+    return await common_form(do_publish_service)
 
 
 @app.route('/receive', methods = ['GET', 'POST'])
 async def data():
-    global prover, received_data, request_ip, anchor_ip
-    received_data = await request.data
-    request_ip = request.remote_addr
+    global prover, anchor_ip
     # Drop any old connections
     prover.pop('connection_response', None)
     anchor_ip = False
-    return '200'
+    return await common_enqueue(inboxes['receive'])
 
 
-@app.route('/respond', methods = ['GET', 'POST'])
-async def respond():
+@action(actions, 'respond')
+async def do_respond(fields):
     global prover, anchor_ip, issuer_port, multiple_onboard
+    message = peek(inboxes['receive'])
+    if not message:
+        raise APIError('nothing_pending', 'No connection request waiting.')
     port = issuer_port
     # have_verinym as condition here doesn't work - see scoping
     if 'did_info' in prover:
         multiple_onboard = True
          # If all running on same machine, set manually
         port = verifier_port
-    prover, anchor_ip = await common_respond(prover, received_data, pool_handle, port)
-    return redirect(url_for('index'))
+    prover, anchor_ip = await common_respond(prover, message['data'], pool_handle, port, message['sender'])
+    take(inboxes['receive'])
+    return {'anchor_ip': anchor_ip}
 
 
-@app.route('/get_verinym', methods = ['GET', 'POST'])
-async def get_verinym():
+@app.route('/respond', methods = ['GET', 'POST'])
+async def respond():
+    return await common_form(do_respond)
+
+
+@action(actions, 'get_verinym')
+async def do_get_verinym(fields):
     global prover, multiple_onboard
     # If all running on same machine, set manually
     port = verifier_port if 'did_info' in prover else issuer_port
     prover = await common_get_verinym(prover, anchor_ip, port)
     # Hide get Verinym function if no new connection requests and all existing are set up
     multiple_onboard = False
-    return redirect(url_for('index'))
+    return {'did': prover['did']}
+
+
+@app.route('/get_verinym', methods = ['GET', 'POST'])
+async def get_verinym():
+    return await common_form(do_get_verinym)
 
 
 @app.route('/credential_inbox', methods = ['GET', 'POST'])
 async def credential_inbox():
+    status = await common_enqueue(inboxes['credential_inbox'])
+    await common_process(inboxes['credential_inbox'], receive_offer)
+    return status
+
+
+async def receive_offer(message):
     global prover
-    prover['authcrypted_cred_offer'] = await request.data
+    prover['authcrypted_cred_offer'] = message['data']
     prover = await receive_credential_offer(prover)
-    return '200'
 
 
-@app.route('/request_credential', methods = ['GET', 'POST'])
-async def request_credential_from_issuer():
+@action(actions, 'request_credential', credrequest = (dict, str))
+async def do_request_credential(fields):
     global prover
     try:
-        form = await request.form
-        json_request = form['credrequest'] # Request credential demands a string-formatted JSON
+        json_request = as_string(fields['credrequest']) # Request credential demands a string-formatted JSON
         prover, cred_request = await request_credential(prover, json_request)
-        requests.post('http://' + anchor_ip + ':' + str(issuer_port) + '/credential_request', cred_request)
-        return redirect(url_for('index'))
-    except:
-        return 'Invalid credential request. Check formatting.'
+    except Exception as ex:
+        raise APIError('invalid_request', 'Invalid credential request. Check formatting.', repr(ex))
+    await common_post('http://' + anchor_ip + ':' + str(issuer_port) + '/credential_request', cred_request)
+
+
+@app.route('/request_credential', methods = ['GET', 'POST'])
+async def request_credential_from_issuer():
+    return await common_form(do_request_credential)
 
 
 @app.route('/credential_store', methods = ['GET', 'POST'])
 async def credential_store():
-    global prover, stored_credentials
-    try:
-        prover['authcrypted_cred'] = await request.data
-        prover = await store_credential(prover)
-        # May cause failure of block if schema exists but name hasnt been stored, store name if so
-        stored_credentials.append(prover['unique_schema_name'])
-        return '200'
-    except:
-        return 'Invalid credential. Check you are authcrypting with the verification key for this actor.'
+    status = await common_enqueue(inboxes['credential_store'])
+    failed = await common_process(inboxes['credential_store'], store)
+    if hashlib.sha256(await request.data).hexdigest() in failed:
+        return 'Invalid credential. Check you are authcrypting with the verification key for this actor.', 422
+    return status
+
+
+async def store(message):
+    global prover, stored_credentials, retention
+    prover['authcrypted_cred'] = message['data']
+    prover = await store_credential(prover)
+    # Revocable credentials need the registry's tails file, served by the issuer
+    tails_hash = prover.get(prover['unique_schema_name'] + '_tails_hash')
+    if tails_hash and not has_tails(tails_hash):
+        tails_file = await common_get('http://' + message['sender'] + ':' + str(issuer_port) + '/tails/' + tails_hash,
+                                      label = '/tails/<tails_hash>')
+        if tails_file.status_code != 200:
+            raise ValueError('Could not download tails file ' + tails_hash + ', the issuer answered ' + str(tails_file.status_code) + '.')
+        # Checked against the hash before it is stored
+        store_tails(tails_hash, tails_file.content)
+    # May cause failure of block if schema exists but name hasnt been stored, store name if so
+    stored_credentials.append(prover['unique_schema_name'])
+    retention, prover = retire_artefacts(retention, prover, PROVER_CREDENTIAL_ARTEFACTS)
+    common_publish('credential_stored', {'schema': prover['unique_schema_name']})
 
 
 @app.route('/proof_request', methods = ['GET', 'POST'])
 async def proof_request():
-    global prover, request_ip
-    prover['authcrypted_proof_request'] = await request.data
-    # Old request IP now has name anchor IP so can safely overwrite
-    request_ip = request.remote_addr
-    return '200'
+    return await common_enqueue(inboxes['proof_request'])
 
 
-@app.route('/create_and_send_proof', methods = ['GET', 'POST'])
-async def create_and_send_proof():
-    global prover
+@action(actions, 'create_and_send_proof', proof = (dict, str))
+async def do_create_and_send_proof(fields):
+    global prover, retention
+    message = peek(inboxes['proof_request'])
+    if not message:
+        raise APIError('nothing_pending', 'No proof request waiting.')
     try:
-        form = await request.form
-        proof = json.loads(form['proof'])
+        proof = as_object(fields['proof'])
+        prover['authcrypted_proof_request'] = message['data']
         prover, proof = await create_proof_of_credential(prover, proof['self_attested_attributes'], proof['requested_attributes'],
                                                          proof['requested_predicates'], proof['non_issuer_attributes'])
-        requests.post('http://' + request_ip + ':' + str(verifier_port) + '/proof_inbox', proof)
-        # Stop ability to send proof until next request
-        prover.pop('authcrypted_proof_request', None)
-        return redirect(url_for('index'))
-    except:
-        return 'Invalid proof. Check formatting.'
+    except Exception as ex:
+        raise APIError('invalid_request', 'Invalid proof. Check formatting.', repr(ex))
+    await common_post('http://' + message['sender'] + ':' + str(verifier_port) + '/proof_inbox', proof)
+    # Stop ability to send proof until next request
+    take(inboxes['proof_request'])
+    retention, prover = retire_artefacts(retention, prover, PROVER_PROOF_ARTEFACTS)
+    common_publish('proof_sent', {'verifier': message['sender']})
+    return {'verifier': message['sender']}
 
 
-@app.route('/reset')
-async def reset():
-    global prover, pool_handle, received_data, anchor_ip, service_published
+@app.route('/create_and_send_proof', methods = ['GET', 'POST'])
+async def create_and_send_proof():
+    return await common_form(do_create_and_send_proof)
+
+
+@action(actions, 'reset', soft = optional(bool))
+async def do_reset(fields):
+    global prover, pool_handle, anchor_ip, service_published
+    if common_soft(fields):
+        prover = common_soft_reset(prover, inboxes, PROVER_CREDENTIAL_ARTEFACTS + PROVER_PROOF_ARTEFACTS)
+        return {'soft': True}
     prover, pool_handle = await common_reset([prover], pool_handle)
-    received_data = False
+    clear_inboxes(inboxes)
     anchor_ip = False
     service_published = False
-    return redirect(url_for('index'))
+
+
+@app.route('/reset', methods = ['GET', 'POST'])
+async def reset():
+    return await common_form(do_reset)
 
 
 @app.route('/reload')
@@ -170,4 +264,4 @@ def reload():
 
 if __name__ == '__main__':
     app.secret_key = os.getenv('ANVIL_KEY', 'MUST_BE_STATIC')
-    app.run(host, port, debug)
+    common_run(app, 'prover', host, port, debug)
@@ -0,0 +1,80 @@
+'''
+Backend for the Indy calls made by the Sovrin modules:
+
+1. indy: libindy through the python3-indy wrapper (default). Needs a running node pool.
+2. memory: in-memory stand-in for the ledger, wallets and crypto (see the memory package).
+   Runs without libindy or Docker, with configurable latency and failure injection.
+
+Select with the ANVIL_BACKEND environment variable or use_backend() before the first call.
+Modules are imported as usual, e.g. `from backend import anoncreds, ledger`, and resolve
+to the selected backend on each call. Calls are timed and counted in metrics.py,
+and calls to the pool run within the request's deadline (see deadlines.py).
+'''
+
+import os, importlib, inspect
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.metrics import instrument
+    from sovrin.deadlines import bounded
+except ImportError:
+    from metrics import instrument
+    from deadlines import bounded
+
+
+BACKENDS = ('indy', 'memory')
+MODULES = ('anoncreds', 'blob_storage', 'crypto', 'did', 'error', 'ledger', 'pool', 'wallet')
+# Calls that wait on the pool, by the budget they run within
+POOL_CALLS = {('ledger', 'submit_request'): 'ledger', ('ledger', 'sign_and_submit_request'): 'ledger',
+              ('ledger', 'submit_action'): 'ledger', ('pool', 'open_pool_ledger'): 'ledger'}
+selected = {'backend': os.getenv('ANVIL_BACKEND', 'indy'), 'modules': {}, 'calls': {}}
+
+
+def use_backend(name):
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend ' + name + ', choose one of ' + ', '.join(BACKENDS) + '.')
+    selected['backend'] = name
+    selected['modules'] = {}
+    selected['calls'] = {}
+
+
+def current_backend():
+    return selected['backend']
+
+
+def backend_module(name):
+    modules = selected['modules']
+    if name not in modules:
+        if selected['backend'] == 'indy':
+            modules[name] = importlib.import_module('indy.' + name)
+        elif __package__:
+            modules[name] = importlib.import_module('.memory.' + name, __package__)
+        else:
+            modules[name] = importlib.import_module('memory.' + name)
+    return modules[name]
+
+
+class BackendModule:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        calls = selected['calls']
+        if (self.name, attribute) not in calls:
+            value = getattr(backend_module(self.name), attribute)
+            if inspect.iscoroutinefunction(value):
+                value = instrument(self.name, attribute, value)
+            if (self.name, attribute) in POOL_CALLS:
+                value = bounded(POOL_CALLS[(self.name, attribute)], value, shield = True)
+            calls[(self.name, attribute)] = value
+        return calls[(self.name, attribute)]
+
+
+anoncreds = BackendModule('anoncreds')
+blob_storage = BackendModule('blob_storage')
+crypto = BackendModule('crypto')
+did = BackendModule('did')
+error = BackendModule('error')
+ledger = BackendModule('ledger')
+pool = BackendModule('pool')
+wallet = BackendModule('wallet')
@@ -0,0 +1,187 @@
+'''
+Benchmark of the claims pipeline in claims.py, stage by stage:
+
+1. Runs the full flow (setup, onboarding x4, schema, credential definition, issuance, proof, verification)
+   for each scenario in example_data, after a number of warmup runs that are not recorded.
+2. Reports count, mean, min, max and percentiles of every stage.
+3. Writes the results as JSON with the commit they were measured on, and compares them with an earlier
+   results file, exiting with status 1 if any stage got slower than the threshold allows.
+
+Run from this folder like claims.py, e.g. without a pool:
+python3 benchmark.py -b memory -n 20 -w 2 -o results.json
+python3 benchmark.py -b memory -n 20 --compare results.json
+'''
+
+import argparse, asyncio, contextlib, json, math, os, subprocess, sys, time
+
+from utilities import generate_base58
+from setup import setup_pool, set_self_up, teardown
+from backend import current_backend
+from events import configure as configure_events
+from onboarding import demo_onboard
+from schema import create_schema, create_credential_definition
+from credentials import offer_credential, receive_credential_offer, request_credential, create_and_send_credential, store_credential
+from proofs import request_proof_of_credential, create_proof_of_credential, verify_proof, load_proof_templates, instantiate_proof_request, proof_templates
+from claims import load_example_data
+
+
+EXAMPLE_DATA = '../example_data/'
+SCENARIOS = ('degree_example', 'service_example')
+STAGES = ('setup', 'onboarding', 'schema', 'cred_def', 'offer', 'receive_offer', 'request', 'issue', 'store',
+          'proof_request', 'proof', 'verify', 'teardown')
+PERCENTILES = (50, 90, 95, 99)
+
+parser = argparse.ArgumentParser(description='Benchmark the claims pipeline stage by stage')
+parser.add_argument('-n', '--runs', type = int, default = 10, help='recorded runs per scenario')
+parser.add_argument('-w', '--warmup', type = int, default = 1, help='unrecorded runs per scenario before the recorded ones')
+parser.add_argument('-x', '--scenario', action = 'append', choices = SCENARIOS, help='scenario to run, can be repeated (default all)')
+parser.add_argument('-r', '--revocable', action = 'store_true', help='issue revocable credentials')
+parser.add_argument('-o', '--output', help='file to write results to as JSON')
+parser.add_argument('--compare', help='results file to compare against')
+parser.add_argument('--threshold', type = float, default = 10, help='percent change of a stage p50 or p95 counted as a regression')
+parser.add_argument('--min-delta', type = float, default = 1, help='milliseconds a stage must slow down by to count as a regression')
+parser.add_argument('-v', '--verbose', action = 'store_true', help='keep the output and event log of the Sovrin functions')
+
+
+async def timed(timings, stage, coroutine):
+    started = time.perf_counter()
+    result = await coroutine
+    timings.setdefault(stage, []).append(time.perf_counter() - started)
+    return result
+
+
+# One run of the claims flow, with messages handed over directly rather than through net_sim files.
+async def run_scenario(name, timings, revocable = False):
+    cred_request, schema, _, _, self_attested_attributes, \
+    requested_attributes, requested_predicates, non_issuer_attributes \
+    = load_example_data(EXAMPLE_DATA + name + '/')
+    started = time.perf_counter()
+    pool_name, pool_handle = await setup_pool('local')
+    steward = await set_self_up('steward', generate_base58(64), generate_base58(64), pool_handle,
+                                seed = '000000000000000000000000Steward1')
+    issuer = await set_self_up('issuer', generate_base58(64), generate_base58(64), pool_handle)
+    prover = await set_self_up('prover', generate_base58(64), generate_base58(64), pool_handle)
+    verifier = await set_self_up('verifier', generate_base58(64), generate_base58(64), pool_handle)
+    timings.setdefault('setup', []).append(time.perf_counter() - started)
+    # Onboarding
+    steward, issuer = await timed(timings, 'onboarding', demo_onboard(steward, issuer))
+    steward, verifier = await timed(timings, 'onboarding', demo_onboard(steward, verifier))
+    issuer, prover = await timed(timings, 'onboarding', demo_onboard(issuer, prover))
+    verifier, prover = await timed(timings, 'onboarding', demo_onboard(verifier, prover))
+    # Schema and definition
+    unique_schema_name, schema_id, issuer = await timed(timings, 'schema', create_schema(schema, issuer))
+    issuer = await timed(timings, 'cred_def', create_credential_definition(issuer, schema_id, unique_schema_name, revocable = revocable))
+    # Issuance
+    issuer, prover['authcrypted_cred_offer'] = await timed(timings, 'offer', offer_credential(issuer, unique_schema_name))
+    prover = await timed(timings, 'receive_offer', receive_credential_offer(prover))
+    prover, issuer['authcrypted_cred_request'] = await timed(timings, 'request', request_credential(prover, json.dumps(cred_request)))
+    issuer, prover['authcrypted_cred'] = await timed(timings, 'issue', create_and_send_credential(issuer))
+    prover = await timed(timings, 'store', store_credential(prover))
+    # Proof
+    verifier, prover['authcrypted_proof_request'] = \
+        await timed(timings, 'proof_request', request_proof_of_credential(verifier, instantiate_proof_request(name)))
+    prover, verifier['authcrypted_proof'] = \
+        await timed(timings, 'proof', create_proof_of_credential(prover, self_attested_attributes, requested_attributes,
+                                                                 requested_predicates, non_issuer_attributes))
+    verifier = await timed(timings, 'verify', verify_proof(verifier, proof_templates[name]['check']))
+    await timed(timings, 'teardown', teardown(pool_name, pool_handle, [steward, issuer, prover, verifier]))
+
+
+# Nearest-rank percentile of sorted samples.
+def percentile(samples, percent):
+    return samples[max(0, math.ceil(percent / 100 * len(samples)) - 1)]
+
+
+def summarise(timings):
+    summary = {}
+    for stage in STAGES:
+        samples = sorted(timings.get(stage, []))
+        if not samples:
+            continue
+        summary[stage] = {'count': len(samples), 'mean': sum(samples) / len(samples), 'min': samples[0], 'max': samples[-1]}
+        for percent in PERCENTILES:
+            summary[stage]['p' + str(percent)] = percentile(samples, percent)
+    return summary
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(scenarios, runs, warmup, revocable = False, verbose = False):
+    load_proof_templates(EXAMPLE_DATA)
+    results = {
+        'commit': current_commit(),
+        'backend': current_backend(),
+        'runs': runs,
+        'warmup': warmup,
+        'revocable': revocable,
+        'time': int(time.time()),
+        'scenarios': {}
+    }
+    if not verbose:
+        configure_events(level = 'warning')
+    for name in scenarios:
+        print('Benchmarking ' + name + '...')
+        timings = {}
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            for i in range(warmup):
+                await run_scenario(name, {}, revocable)
+            for i in range(runs):
+                await run_scenario(name, timings, revocable)
+        results['scenarios'][name] = summarise(timings)
+    return results
+
+
+def print_results(results):
+    columns = ('count', 'mean', 'p50', 'p90', 'p95', 'p99', 'max')
+    for name, summary in results['scenarios'].items():
+        print('\n' + name + ' (' + results['backend'] + ', commit ' + str(results['commit']) + '), ms:')
+        print('{:<14}'.format('stage') + ''.join('{:>10}'.format(column) for column in columns))
+        for stage, stats in summary.items():
+            print('{:<14}'.format(stage) + '{:>10}'.format(stats['count']) +
+                  ''.join('{:>10.2f}'.format(stats[column] * 1000) for column in columns[1:]))
+
+
+'''
+Returns the stages whose p50 or p95 grew by more than threshold percent and min_delta milliseconds,
+as 'scenario/stage/statistic' strings. The absolute floor keeps sub-millisecond jitter from counting.
+'''
+def compare(results, baseline, threshold, min_delta = 1):
+    regressions = []
+    print('\nChange against ' + str(baseline.get('commit')) + ' (' + baseline.get('backend', '?') + '):')
+    if (baseline.get('backend'), baseline.get('revocable')) != (results['backend'], results['revocable']):
+        print('Warning: baseline was measured with a different backend or revocation setting.')
+    for name, summary in results['scenarios'].items():
+        for stage, stats in summary.items():
+            before = baseline.get('scenarios', {}).get(name, {}).get(stage)
+            if not before:
+                continue
+            changes = []
+            for statistic in ('p50', 'p95'):
+                change = (stats[statistic] - before[statistic]) / before[statistic] * 100 if before[statistic] else 0
+                changes.append('{} {:+.1f}%'.format(statistic, change))
+                if change > threshold and (stats[statistic] - before[statistic]) * 1000 > min_delta:
+                    regressions.append(name + '/' + stage + '/' + statistic)
+            print('{:<16}{:<14}'.format(name, stage) + ', '.join(changes))
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parser.parse_known_args()[0]
+    results = asyncio.get_event_loop().run_until_complete(
+        benchmark(args.scenario or SCENARIOS, args.runs, args.warmup, args.revocable, args.verbose))
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as file_:
+            json.dump(results, file_, indent = 4)
+        print('\nResults written to ' + args.output + '.')
+    if args.compare:
+        with open(args.compare) as file_:
+            regressions = compare(results, json.load(file_), args.threshold, args.min_delta)
+        if regressions:
+            print('\nRegressions over ' + str(args.threshold) + '%: ' + ', '.join(regressions))
+            sys.exit(1)
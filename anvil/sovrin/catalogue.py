@@ -0,0 +1,139 @@
+'''
+Catalogues of credential schemas, to bring up an issuer with many credential types in one step:
+
+1. A catalogue is a folder with a credential_schema.json in each subfolder (as in example_data),
+   or a manifest: a JSON list of schemas or paths to them, or of {"schema": schema or path, "revocable": true}.
+2. Each schema is compared with the ledger and the issuer's wallet. Schemas, definitions and revocation
+   registries already there are reused, only the missing ones are registered.
+3. Missing ones are registered concurrently, up to ANVIL_CATALOGUE_CONCURRENCY (default 8) at once.
+4. Every definition ends up in the issuer's index (see index_definition() in schema.py).
+
+Registering the same catalogue again finds everything in place and registers nothing.
+'''
+
+import asyncio, json, os
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.backend import anoncreds, error
+    from sovrin.schema import create_schema, create_credential_definition, get_schema, index_definition, unique_name, CRED_DEF_TAG
+    from sovrin.credentials import get_cred_def
+    from sovrin.revocation import create_revocation_registry, get_rev_reg_def
+    from sovrin.events import log
+except ImportError:
+    from backend import anoncreds, error
+    from schema import create_schema, create_credential_definition, get_schema, index_definition, unique_name, CRED_DEF_TAG
+    from credentials import get_cred_def
+    from revocation import create_revocation_registry, get_rev_reg_def
+    from events import log
+
+
+CONCURRENCY = int(os.getenv('ANVIL_CATALOGUE_CONCURRENCY', 8))
+
+
+# Reads a catalogue folder or manifest file into entries of {'schema': ..., 'revocable': ...}.
+def load_catalogue(path):
+    if os.path.isdir(path):
+        manifest = [os.path.join(name, 'credential_schema.json') for name in sorted(os.listdir(path))
+                    if os.path.isfile(os.path.join(path, name, 'credential_schema.json'))]
+        return catalogue_entries(manifest, path)
+    with open(path) as file_:
+        return catalogue_entries(json.load(file_), os.path.dirname(path))
+
+
+# Entries from a manifest, with schema paths relative to base.
+def catalogue_entries(manifest, base = '.'):
+    entries = {}
+    for item in manifest:
+        entry = dict(item) if isinstance(item, dict) and 'schema' in item else {'schema': item}
+        if isinstance(entry['schema'], str):
+            with open(os.path.join(base, entry['schema'])) as file_:
+                entry['schema'] = json.load(file_)
+        schema = entry['schema']
+        if not isinstance(schema.get('name'), str) or not isinstance(schema.get('version'), str) or not isinstance(schema.get('attributes'), list):
+            raise ValueError('Schemas need a name, a version and a list of attributes: ' + json.dumps(schema))
+        if unique_name(schema) in entries:
+            raise ValueError('Schema ' + schema['name'] + ' is in the catalogue twice.')
+        entries[unique_name(schema)] = {'schema': schema, 'revocable': bool(entry.get('revocable'))}
+    return list(entries.values())
+
+
+'''
+Registers what is missing from the catalogue for the creator, concurrently.
+Returns the creator and a report of the unique schema names registered, found already in place,
+in conflict (e.g. a definition on the ledger that is not in this wallet) or failed, with the reasons.
+'''
+async def register_catalogue(creator, entries, concurrency = CONCURRENCY):
+    log('register_catalogue', creator['name'].capitalize() + ' registering a catalogue of schemas...', actor = creator['name'], schemas = len(entries))
+    limit = asyncio.Semaphore(concurrency)
+    report = {'registered': [], 'existing': [], 'conflicts': {}, 'failed': {}}
+
+    async def register(entry):
+        name = unique_name(entry['schema'])
+        async with limit:
+            try:
+                outcome = await register_entry(creator, entry)
+            except Exception as ex:
+                report['failed'][name] = repr(ex)
+                return
+        if outcome in ('registered', 'existing'):
+            report[outcome].append(name)
+        else:
+            report['conflicts'][name] = outcome
+
+    await asyncio.gather(*(register(entry) for entry in entries))
+    return creator, report
+
+
+# Returns 'registered', 'existing', or the reason for a conflict.
+async def register_entry(creator, entry):
+    schema, revocable = entry['schema'], entry['revocable']
+    unique_schema_name = unique_name(schema)
+    schema_id = creator['did'] + ':2:' + schema['name'] + ':' + schema['version']
+    schema_json = await on_ledger(get_schema(creator['pool'], creator['did'], schema_id))
+    if schema_json is None:
+        unique_schema_name, schema_id, creator = await create_schema(schema, creator)
+        await create_credential_definition(creator, schema_id, unique_schema_name, revocable = revocable)
+        return 'registered'
+    # The definition ID follows from the schema's sequence number on the ledger
+    cred_def_id = creator['did'] + ':3:CL:' + str(json.loads(schema_json)['seqNo']) + ':' + CRED_DEF_TAG
+    cred_def_json = await on_ledger(get_cred_def(creator['pool'], creator['did'], cred_def_id))
+    if cred_def_json is None:
+        await create_credential_definition(creator, schema_id, unique_schema_name, revocable = revocable)
+        return 'registered'
+    if not await in_wallet(creator, cred_def_id):
+        return 'definition ' + cred_def_id + ' is on the ledger but not in this wallet'
+    if revocable and 'revocation' not in json.loads(cred_def_json)['value']:
+        return 'definition ' + cred_def_id + ' does not support revocation'
+    creator[unique_schema_name + '_schema'] = schema_json
+    creator[unique_schema_name + '_cred_def_id'] = cred_def_id
+    creator[unique_schema_name + '_cred_def'] = cred_def_json
+    outcome = 'existing'
+    if revocable:
+        rev_reg_id = creator['did'] + ':4:' + cred_def_id + ':CL_ACCUM:' + CRED_DEF_TAG
+        rev_reg_def = await on_ledger(get_rev_reg_def(creator['pool'], creator['did'], rev_reg_id))
+        if rev_reg_def is None:
+            await create_revocation_registry(creator, unique_schema_name)
+            outcome = 'registered'
+        else:
+            creator[unique_schema_name + '_rev_reg_id'], creator[unique_schema_name + '_rev_reg_def'] = rev_reg_id, rev_reg_def
+    index_definition(creator, unique_schema_name, schema_id, revocable)
+    return outcome
+
+
+# The JSON read from the ledger, or None if it is not there.
+async def on_ledger(read):
+    try:
+        result = await read
+    except error.IndyError as ex:
+        if ex.error_code == error.ErrorCode.LedgerNotFound:
+            return None
+        raise
+    return result[1] if isinstance(result, tuple) else result
+
+
+async def in_wallet(creator, cred_def_id):
+    try:
+        await anoncreds.issuer_create_credential_offer(creator['wallet'], cred_def_id)
+    except error.IndyError:
+        return False
+    return True
@@ -7,16 +7,18 @@ Changing names means going through the modules (esp. issue.py & proofs.py) and d
 [actor]_key or [actor]_did depending on the context.
 '''
 
-import logging, argparse, sys, json, time, os
+import logging, argparse, asyncio, sys, json, time, os, functools
 
 from ctypes import CDLL
 
-from utilities import run_coroutine, send_data, receive_data, generate_nonce, generate_base58
-from setup import setup_pool, set_self_up, teardown
-from onboarding import demo_onboard
+from utilities import run_coroutine, send_data_async, receive_data_async, generate_nonce, generate_base58, run_graph
+from transport import use_transport, TRANSPORTS
+from events import configure as configure_events
+from setup import setup_pool, set_self_up, teardown, teardown_actors
+from onboarding import demo_onboard, onboarding_steps
 from schema import create_schema, create_credential_definition
 from credentials import offer_credential, receive_credential_offer, request_credential, create_and_send_credential, store_credential
-from proofs import request_proof_of_credential, create_proof_of_credential, verify_proof
+from proofs import request_proof_of_credential, create_proof_of_credential, verify_proof, load_proof_templates, instantiate_proof_request, proof_templates
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.WARN)
@@ -27,7 +29,13 @@ parser.add_argument('-l', '--library', help='dynamic library to load for plug-in
 parser.add_argument('-e', '--entrypoint', help='entry point for dynamic library')
 parser.add_argument('-c', '--config', help='entry point for dynamic library')
 parser.add_argument('-s', '--creds', help='entry point for dynamic library')
+parser.add_argument('-b', '--backend', help='indy (default) or memory, see backend.py')
+parser.add_argument('-m', '--transport', choices = TRANSPORTS, help='memory (default) or file (net_sim files), see transport.py')
+parser.add_argument('-k', '--concurrency', help='throughput mode: comma-separated numbers of concurrent flows, e.g. 1,2,4,8')
+parser.add_argument('-n', '--rounds', type = int, default = 5, help='throughput mode: credentials each flow issues and verifies')
 args = parser.parse_known_args()[0]
+if args.transport:
+    use_transport(args.transport)
 
 
 # Check if we need to dyna-load a custom wallet storage plug-in
@@ -47,84 +55,148 @@ if args.storage_type:
 
 async def run():
 
-    cred_request, schema, proof_request, assertions_to_make, self_attested_attributes, \
-    requested_attributes, requested_predicates, non_issuer_attributes \
-    = load_example_data('../example_data/service_example/')
+    # Set up pool
+    pool_name, pool_handle = await setup_pool('local')
 
-    # Add a nonce to the proof request and stringify
-    proof_request['nonce'] = generate_nonce(25)
+    actors = await set_up_flow(pool_handle)
+    actors = await issue_credential(actors)
+    actors = await verify_credential(actors)
 
-    # Requests need to be json formatted
-    proof_request = json.dumps(proof_request)
-    cred_request = json.dumps(cred_request)
+    await teardown(pool_name, pool_handle, [actors[name] for name in ('steward', 'issuer', 'prover', 'verifier')])
 
-    # Set up pool
-    pool_name, pool_handle = await setup_pool('local')
+    print('Credential verified.')
+
+
+# Messages between actors go through the selected transport, over a channel per flow.
+async def transfer(data, channel = 0):
+    await send_data_async(data, channel)
+    return await receive_data_async(channel, timeout = 60)
+
+
+async def set_up_flow(pool_handle, channel = 0):
+
+    _, schema, *_ = load_example_data('../example_data/service_example/')
+
+    actors = {'channel': channel}
 
     # Set up actors
     # For demo purposes, parameters ID, KEY are just random base58 strings here
     # Generally only seed-initialise Steward Anchors
-    steward = await set_self_up('steward', generate_base58(64), generate_base58(64), pool_handle,
-                                seed = '000000000000000000000000Steward1')
-    issuer = await set_self_up('issuer', generate_base58(64), generate_base58(64), pool_handle)
-    prover = await set_self_up('prover', generate_base58(64), generate_base58(64), pool_handle)
-    verifier = await set_self_up('verifier', generate_base58(64), generate_base58(64), pool_handle)
-    
+    async def set_up(name, seed = None):
+        actors[name] = await set_self_up(name, generate_base58(64), generate_base58(64), pool_handle, seed = seed)
+
+    # Create schema and corresponding definition
+    async def create_definition():
+        unique_schema_name, schema_id, issuer = await create_schema(schema, actors['issuer'])
+        issuer = await create_credential_definition(issuer, schema_id, unique_schema_name, revocable = False)
+        issuer['unique_schema_name'] = unique_schema_name
+
     '''
-    Onboard each actor with the parties they will interact with.
+    Set up the actors concurrently, then onboard each with the parties they will interact with.
     Assuming no pre-existing relationships:
     1. Onboard the issuer and verifier with a steward.
     2. Onboard the prover with the issuer and verifier.
+    Steps run as soon as what they need is done (see onboarding_steps()), the definition once the issuer has a Verinym.
     '''
-    steward, issuer = await demo_onboard(steward, issuer)
-    steward, verifier = await demo_onboard(steward, verifier)
-    issuer, prover = await demo_onboard(issuer, prover)
-    verifier, prover = await demo_onboard(verifier, prover)
-    
-    # Create schema and corresponding definition
-    unique_schema_name, schema_id, issuer = await create_schema(schema, issuer)
-    issuer = await create_credential_definition(issuer, schema_id, unique_schema_name, revocable = False)
+    steps = {
+        'steward': ([], functools.partial(set_up, 'steward', seed = '000000000000000000000000Steward1')),
+        'issuer': ([], functools.partial(set_up, 'issuer')),
+        'prover': ([], functools.partial(set_up, 'prover')),
+        'verifier': ([], functools.partial(set_up, 'verifier')),
+        'definition': (['steward_issuer'], create_definition)
+    }
+    steps.update(onboarding_steps(actors, setup = True))
+    _, actors['bootstrap'] = await run_graph(steps, 'set_up_flow')
+    return actors
+
+
+async def issue_credential(actors):
+    issuer, prover, channel = actors['issuer'], actors['prover'], actors['channel']
+
+    # Requests need to be json formatted
+    cred_request = json.dumps(load_example_data('../example_data/service_example/')[0])
 
     # Issue credential
-    issuer, cred_offer = await offer_credential(issuer, unique_schema_name)
+    issuer, cred_offer = await offer_credential(issuer, issuer['unique_schema_name'])
 
-    send_data(cred_offer)
-    prover['authcrypted_cred_offer'] = receive_data()
+    prover['authcrypted_cred_offer'] = await transfer(cred_offer, channel)
 
     prover = await receive_credential_offer(prover)
     prover, cred_request = await request_credential(prover, cred_request)
 
-    send_data(cred_request)
-    issuer['authcrypted_cred_request'] = receive_data()
+    issuer['authcrypted_cred_request'] = await transfer(cred_request, channel)
 
     issuer, cred = await create_and_send_credential(issuer)
 
-    send_data(cred)
-    prover['authcrypted_cred'] = receive_data()
+    prover['authcrypted_cred'] = await transfer(cred, channel)
 
     prover = await store_credential(prover)
-    
+    return actors
+
+
+async def verify_credential(actors):
+    prover, verifier, channel = actors['prover'], actors['verifier'], actors['channel']
+
+    _, _, _, _, self_attested_attributes, requested_attributes, requested_predicates, non_issuer_attributes \
+    = load_example_data('../example_data/service_example/')
+
+    # Proof request templates are registered once, each request only gets a fresh nonce
+    load_proof_templates('../example_data/')
+    proof_request = instantiate_proof_request('service_example')
+    assertions_to_make = proof_templates['service_example']['check']
 
     # Verify credential
     verifier, proof_request = await request_proof_of_credential(verifier, proof_request)
 
-    send_data(proof_request)
-    prover['authcrypted_proof_request'] = receive_data()
+    prover['authcrypted_proof_request'] = await transfer(proof_request, channel)
 
     prover, proof = await create_proof_of_credential(prover, self_attested_attributes, requested_attributes,
                                               requested_predicates, non_issuer_attributes)
     
-    send_data(proof)
-    verifier['authcrypted_proof'] = receive_data()
+    verifier['authcrypted_proof'] = await transfer(proof, channel)
 
     verifier = await verify_proof(verifier, assertions_to_make)
+    return actors
 
-    await teardown(pool_name, pool_handle, [steward, issuer, prover, verifier])
-
-    print('Credential verified.')
 
+'''
+Throughput mode: for each concurrency level K, sets up K independent issuer/prover/verifier flows,
+then has each issue `rounds` credentials at once over its own channel, and after that verify `rounds` proofs.
+The two phases are timed apart, to report credentials issued and proofs verified per second on their own.
+Setup and onboarding are excluded.
+'''
+async def run_throughput(levels, rounds):
+    configure_events(level = 'warning')
+    pool_name, pool_handle = await setup_pool('local')
 
-# Loads examples in the example_data folder
+    async def run_rounds(actors, step):
+        for i in range(rounds):
+            actors = await step(actors)
+
+    async def timed_phase(flows, step):
+        started = time.perf_counter()
+        await asyncio.gather(*[run_rounds(actors, step) for actors in flows])
+        return time.perf_counter() - started
+
+    results = []
+    for concurrency in levels:
+        print('Running ' + str(concurrency) + ' concurrent flows...')
+        flows = await asyncio.gather(*[set_up_flow(pool_handle, channel = 'flow_' + str(i)) for i in range(concurrency)])
+        issuing = await timed_phase(flows, issue_credential)
+        verifying = await timed_phase(flows, verify_credential)
+        for actors in flows:
+            await teardown_actors([actors[name] for name in ('steward', 'issuer', 'prover', 'verifier')])
+        total = concurrency * rounds
+        results.append((concurrency, total / issuing, total / verifying, issuing, verifying))
+    await teardown(pool_name, pool_handle)
+    print('{:>6}{:>16}{:>12}{:>12}{:>12}'.format('K', 'credentials/s', 'proofs/s', 'issuing s', 'verifying s'))
+    for concurrency, credentials, proofs, issuing, verifying in results:
+        print('{:>6}{:>16.2f}{:>12.2f}{:>12.2f}{:>12.2f}'.format(concurrency, credentials, proofs, issuing, verifying))
+    return results
+
+
+# Loads examples in the example_data folder, once per path. Do not modify the returned data.
+@functools.lru_cache(maxsize = None)
 def load_example_data(path):
     example_data = {}
     for filename in os.listdir(path):
@@ -145,5 +217,9 @@ def load_example_data(path):
 
 
 if __name__ == '__main__':
-    run_coroutine(run)
+    if args.concurrency:
+        levels = [int(level) for level in args.concurrency.split(',')]
+        run_coroutine(lambda: run_throughput(levels, args.rounds))
+    else:
+        run_coroutine(run)
     time.sleep(1)  # FIXME waiting for libindy thread complete
@@ -8,12 +8,28 @@ Sovrin credential issuance functions:
 5. Store a credential.
 '''
 
-import json
-from indy import anoncreds, crypto, did, ledger
-
-
+import json, time
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.backend import anoncreds, crypto, did, ledger
+    from sovrin.revocation import tails_reader, send_rev_reg_entry, get_rev_reg_def, tails_hash_of
+    from sovrin.tracing import traced, inject, extract, record
+    from sovrin.profiling import profiled
+    from sovrin.events import log
+    from sovrin.encoding import encode_values, schema_attributes
+except ImportError:
+    from backend import anoncreds, crypto, did, ledger
+    from revocation import tails_reader, send_rev_reg_entry, get_rev_reg_def, tails_hash_of
+    from tracing import traced, inject, extract, record
+    from profiling import profiled
+    from events import log
+    from encoding import encode_values, schema_attributes
+
+
+@traced('offer_credential', starts = True)
+@profiled('offer_credential')
 async def offer_credential(issuer, unique_schema_name):
-    print('Issuer offering credential to Prover...')
+    log('offer_credential', 'Issuer offering credential to Prover...', actor = issuer['name'])
     issuer['unique_schema_name'] = unique_schema_name
     issuer[issuer['unique_schema_name'] + '_cred_offer'] = \
         await anoncreds.issuer_create_credential_offer(issuer['wallet'], issuer[issuer['unique_schema_name'] + '_cred_def_id'])
@@ -28,12 +44,14 @@ async def offer_credential(issuer, unique_schema_name):
     # Authenticate, encrypt and send
     issuer['authcrypted_cred_offer'] = \
         await crypto.auth_crypt(issuer['wallet'], issuer['prover_key'], issuer['prover_key_for_issuer'],
-                                json.dumps(offer).encode('utf-8'))
+                                json.dumps(inject(offer)).encode('utf-8'))
     return issuer, issuer['authcrypted_cred_offer']
 
 
+@traced('receive_credential_offer')
+@profiled('receive_credential_offer')
 async def receive_credential_offer(prover):
-    print('Prover getting credential offer from Issuer...')
+    log('receive_credential_offer', 'Prover getting credential offer from Issuer...', actor = prover['name'])
     # Decrypt
     prover['issuer_key_for_prover'], _, json_cred_offer = \
         await auth_decrypt(prover['wallet'], prover['issuer_key'], prover['authcrypted_cred_offer'])
@@ -42,16 +60,21 @@ async def receive_credential_offer(prover):
     authdecrypted_cred_offer = json.loads(json_cred_offer['cred_offer'])
     prover[prover['unique_schema_name'] + '_schema_id'] = authdecrypted_cred_offer['schema_id']
     prover[prover['unique_schema_name'] + '_cred_def_id'] = authdecrypted_cred_offer['cred_def_id']
-    # Prover creates master secret so they can use the credential
-    prover['master_secret_id'] = await anoncreds.prover_create_master_secret(prover['wallet'], None)
+    # Prover creates master secret so they can use the credential, once so all their credentials share it
+    if 'master_secret_id' not in prover:
+        prover['master_secret_id'] = await anoncreds.prover_create_master_secret(prover['wallet'], None)
     # Get credential definition from ledger
     (prover['issuer_cred_def_id'], prover['issuer_cred_def']) = \
         await get_cred_def(prover['pool'], prover['issuer_did'], authdecrypted_cred_offer['cred_def_id'])
     return prover
 
 
+@traced('request_credential')
+@profiled('request_credential')
 async def request_credential(prover, values):
-    print('Prover requesting credential itself...')
+    log('request_credential', 'Prover requesting credential itself...', actor = prover['name'])
+    # Values may be given raw, encodings are added where missing
+    values = json.dumps(encode_values(values))
     prover[prover['unique_schema_name'] + '_cred_values'] = values
     (prover[prover['unique_schema_name'] + '_cred_request'], prover[prover['unique_schema_name'] + '_cred_request_metadata']) = \
         await anoncreds.prover_create_credential_req(prover['wallet'], prover['issuer_did'],
@@ -65,39 +88,56 @@ async def request_credential(prover, values):
     # Authenticate, encrypt and send
     prover['authcrypted_cred_request'] = \
         await crypto.auth_crypt(prover['wallet'], prover['issuer_key'], prover['issuer_key_for_prover'],
-                                json.dumps(cred_request).encode('utf-8'))
+                                json.dumps(inject(cred_request)).encode('utf-8'))
     return prover, prover['authcrypted_cred_request']
 
 
 
+@traced('create_and_send_credential')
+@profiled('create_and_send_credential')
 async def create_and_send_credential(issuer):
-    print('Issuer creating credential and sending to Prover...')
+    log('create_and_send_credential', 'Issuer creating credential and sending to Prover...', actor = issuer['name'])
     # Decrypt
     issuer['prover_key_for_issuer'], _, cred_request = \
         await auth_decrypt(issuer['wallet'], issuer['prover_key'], issuer['authcrypted_cred_request'])
     issuer[issuer['unique_schema_name'] + '_cred_request'] = cred_request['request']
-    issuer['prover_cred_values'] = cred_request['values']
-    # Create the credential according to the request
-    issuer[issuer['unique_schema_name'] + '_cred'], _, _ = \
+    # Checked against the schema's attributes, with encodings added where the prover left them out
+    schema = issuer.get(issuer['unique_schema_name'] + '_schema')
+    issuer['prover_cred_values'] = json.dumps(encode_values(cred_request['values'], schema_attributes(schema) if schema else None))
+    # Create the credential according to the request, in the revocation registry if the definition has one
+    rev_reg_id = issuer.get(issuer['unique_schema_name'] + '_rev_reg_id')
+    issuer[issuer['unique_schema_name'] + '_cred'], cred_rev_id, rev_reg_delta = \
         await anoncreds.issuer_create_credential(issuer['wallet'], issuer[issuer['unique_schema_name'] + '_cred_offer'],
                                                  issuer[issuer['unique_schema_name'] + '_cred_request'],
-                                                 issuer['prover_cred_values'], None, None)
+                                                 issuer['prover_cred_values'], rev_reg_id,
+                                                 await tails_reader() if rev_reg_id else None)
+    if rev_reg_id:
+        # Keep the revocation ID so the credential can be revoked later
+        issuer[issuer['unique_schema_name'] + '_cred_rev_id'] = cred_rev_id
+        await send_rev_reg_entry(issuer, rev_reg_id, rev_reg_delta)
     # Authenticate, encrypt and send
     issuer['authcrypted_cred'] = \
         await crypto.auth_crypt(issuer['wallet'], issuer['prover_key'], issuer['prover_key_for_issuer'],
-                                issuer[issuer['unique_schema_name'] + '_cred'].encode('utf-8'))
+                                inject(issuer[issuer['unique_schema_name'] + '_cred']).encode('utf-8'))
     return issuer, issuer['authcrypted_cred']
 
 
+@traced('store_credential')
+@profiled('store_credential')
 async def store_credential(prover):
-    print('Prover storing credential...')
+    log('store_credential', 'Prover storing credential...', actor = prover['name'])
     # Decrypt, get definition and store credential
     _, prover[prover['unique_schema_name'] + '_cred'], _ = \
         await auth_decrypt(prover['wallet'], prover['issuer_key'], prover['authcrypted_cred'])
     _, prover[prover['unique_schema_name'] + '_cred_def'] = await get_cred_def(prover['pool'], prover['issuer_did'],
                                                          prover[prover['unique_schema_name'] + '_cred_def_id'])
+    # Revocable credentials need their registry definition, whose tails file the prover needs for proofs
+    rev_reg_id = json.loads(prover[prover['unique_schema_name'] + '_cred']).get('rev_reg_id')
+    rev_reg_def = await get_rev_reg_def(prover['pool'], prover['issuer_did'], rev_reg_id) if rev_reg_id else None
+    if rev_reg_def:
+        prover[prover['unique_schema_name'] + '_tails_hash'] = tails_hash_of(rev_reg_def)
     await anoncreds.prover_store_credential(prover['wallet'], None, prover[prover['unique_schema_name'] + '_cred_request_metadata'],
-                                            prover[prover['unique_schema_name'] + '_cred'], prover[prover['unique_schema_name'] + '_cred_def'], None)
+                                            prover[prover['unique_schema_name'] + '_cred'], prover[prover['unique_schema_name'] + '_cred_def'], rev_reg_def)
     return prover
 
 
@@ -109,7 +149,13 @@ async def get_cred_def(pool_handle, _did, cred_def_id):
 
 
 async def auth_decrypt(wallet_handle, key, message):
+    started = time.time_ns()
     from_verkey, decrypted_message_json = await crypto.auth_decrypt(wallet_handle, key, message)
     decrypted_message_json = decrypted_message_json.decode("utf-8")
     decrypted_message = json.loads(decrypted_message_json)
+    # Continue the sender's trace if the message carries one, and pass the message on without it
+    decrypted_message, carried_trace = extract(decrypted_message)
+    if carried_trace:
+        decrypted_message_json = json.dumps(decrypted_message)
+    record('decrypt', started)
     return from_verkey, decrypted_message_json, decrypted_message
\ No newline at end of file
@@ -0,0 +1,87 @@
+'''
+Deadlines for the work a request starts, so an unresponsive peer, pool or OEF node cannot hold a route forever:
+
+1. Each route gets a deadline when it starts, ANVIL_DEADLINE seconds (default 60) or sooner if the caller sent one.
+2. Outbound HTTP, ledger and OEF calls run within the time left, and within their own budget from ANVIL_TIMEOUTS,
+   e.g. http=10,ledger=30,oef=120 (the defaults).
+3. Requests to other actors carry the time left in the anvil-timeout header, so they work to the same deadline.
+4. A call that runs out of time is cancelled and raises DeadlineExceeded, a TimeoutError. Ledger calls are left to
+   finish in the background, since a write may still be accepted, but the route does not wait for them.
+Outside a route, e.g. in the demo runners, only the budgets apply.
+'''
+
+import asyncio, contextvars, os, time
+
+
+DEADLINE = float(os.getenv('ANVIL_DEADLINE', 60))
+BUDGETS = dict({'http': 10.0, 'ledger': 30.0, 'oef': 120.0},
+               **{operation: float(seconds) for operation, seconds in (item.split('=') for item in os.getenv('ANVIL_TIMEOUTS', '').split(',') if item)})
+HEADER = 'anvil-timeout'
+
+# Monotonic time by which the current request has to be done, None outside requests
+deadline = contextvars.ContextVar('deadline', default = None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+# Starts a request's deadline, seconds from now or as sent in the anvil-timeout header, whichever is sooner.
+def set_deadline(header = None):
+    seconds = DEADLINE
+    try:
+        seconds = min(seconds, float(header)) if header else seconds
+    except ValueError:
+        pass # Ignored, as a caller without a deadline
+    return deadline.set(time.monotonic() + seconds)
+
+
+def reset_deadline(token):
+    deadline.reset(token)
+
+
+# Seconds left for an operation, None without a deadline or budget. Raises DeadlineExceeded if none are left.
+def remaining(operation = None):
+    limits = [BUDGETS[operation]] if operation in BUDGETS else []
+    if deadline.get() is not None:
+        limits.append(deadline.get() - time.monotonic())
+    if not limits:
+        return None
+    seconds = min(limits)
+    if seconds <= 0:
+        raise DeadlineExceeded('No time left for ' + (operation or 'the request') + '.')
+    return seconds
+
+
+# Header carrying the time left to the actor called, empty without a deadline.
+def deadline_header():
+    if deadline.get() is None:
+        return {}
+    return {HEADER: '{:.3f}'.format(max(deadline.get() - time.monotonic(), 0))}
+
+
+'''
+Awaits within the time left for the operation, cancelling the awaitable when it runs out.
+With shield, the awaitable is left to finish in the background instead.
+'''
+async def within(awaitable, operation = None, shield = False):
+    try:
+        seconds = remaining(operation)
+    except DeadlineExceeded:
+        # Not started, so not left pending either
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    try:
+        return await asyncio.wait_for(asyncio.shield(awaitable) if shield else awaitable, seconds)
+    except DeadlineExceeded:
+        raise
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded((operation or 'The request').capitalize() + ' took longer than the ' + '{:.1f}'.format(seconds) + 's left.')
+
+
+# Wraps a coroutine function so each call runs within the operation's time, e.g. ledger submits.
+def bounded(operation, function, shield = False):
+    async def call(*args, **kwargs):
+        return await within(function(*args, **kwargs), operation, shield)
+    return call
@@ -0,0 +1,71 @@
+'''
+Encoding of credential attribute values, so callers only give the raw values:
+
+1. Integers, and strings of integers, in the 32-bit signed range are encoded as themselves, so predicates such as year >= 2019 compare the values.
+2. Anything else is encoded as the decimal of the SHA-256 digest of its string, the encoding other Indy agents use.
+3. Encodings are cached, so values repeated across records (e.g. a status or a degree) are hashed once.
+4. Values given with an encoding keep it, so credential requests with their own encodings are unchanged.
+5. Verifiers can check that revealed raw values match their encodings (see proofs.py).
+'''
+
+import functools, hashlib, json, os
+
+
+I32_BOUND = 2 ** 31
+
+
+@functools.lru_cache(maxsize = int(os.getenv('ANVIL_ENCODING_CACHE', 65536)), typed = True)
+def encode(raw):
+    if isinstance(raw, int) and -I32_BOUND <= raw < I32_BOUND:
+        return str(int(raw))
+    try:
+        # Not int(raw), floats are hashed rather than truncated
+        number = int(str(raw))
+        if -I32_BOUND <= number < I32_BOUND:
+            return str(number)
+    except ValueError:
+        pass
+    return str(int.from_bytes(hashlib.sha256(str(raw).encode('utf-8')).digest(), 'big'))
+
+
+def cache_info():
+    return encode.cache_info()
+
+
+'''
+Completes credential values, given as a dict or its JSON string, in the format Indy expects:
+each attribute as {"raw": ..., "encoded": ...}, from a raw value or {"raw": ...} alone.
+With the schema's attribute names, attributes missing from or not in the schema raise a ValueError.
+'''
+def encode_values(values, attributes = None):
+    values = json.loads(values) if isinstance(values, (str, bytes)) else values
+    if attributes is not None:
+        missing = [name for name in attributes if name not in values]
+        unknown = [name for name in values if name not in attributes]
+        problems = (['missing ' + ', '.join(missing)] if missing else []) + (['not in the schema ' + ', '.join(unknown)] if unknown else [])
+        if problems:
+            raise ValueError('Credential values do not match the schema: ' + '; '.join(problems) + '.')
+    encoded = {}
+    for name, value in values.items():
+        if isinstance(value, dict):
+            raw = value['raw']
+            encoded[name] = {'raw': str(raw), 'encoded': str(value['encoded']) if 'encoded' in value else encode(raw)}
+        else:
+            encoded[name] = {'raw': str(value), 'encoded': encode(value)}
+    return encoded
+
+
+# Encodes many records at once for bulk issuance, e.g. rows read from a CSV file.
+def encode_records(records, attributes = None):
+    return [encode_values(record, attributes) for record in records]
+
+
+# Schema attribute names from a schema JSON, as kept by create_schema() or read from the ledger.
+def schema_attributes(schema_json):
+    return json.loads(schema_json)['attrNames']
+
+
+# Returns the referents of revealed attributes whose raw value does not encode to the value proven.
+def check_revealed_encodings(decrypted_proof):
+    revealed_attrs = decrypted_proof['requested_proof'].get('revealed_attrs', {})
+    return [referent for referent, attr in revealed_attrs.items() if encode(attr['raw']) != attr['encoded']]
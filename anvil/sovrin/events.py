@@ -0,0 +1,138 @@
+'''
+Structured event log for the Sovrin functions, the apps and the Fetch agents:
+
+1. Events have a name, a level, a short message and fields, e.g.
+   log('offer_credential', 'Issuer offering credential to Prover...', actor = 'issuer').
+2. Events below ANVIL_LOG_LEVEL (default info) cost a dictionary lookup. The rest are queued and written
+   by a background thread, so a slow terminal or pipe never blocks the event loop. If the queue is full,
+   events are dropped and counted rather than waited for.
+3. High-volume events are sampled, e.g. ANVIL_LOG_SAMPLE='message_received=0.01', and carry their sample rate.
+4. Fields named like secrets are redacted and long payloads are summarised as their size and hash.
+
+Written to stdout as text, or as one JSON object per line with ANVIL_LOG_FORMAT=json.
+Events go through the 'anvil' logger, so the logging module's configuration applies as well.
+'''
+
+import atexit, hashlib, json, logging, logging.handlers, os, queue, random, sys, time
+
+
+LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+REDACTED = ('key', 'seed', 'secret', 'password', 'token')
+MAX_FIELD = 200
+QUEUE_SIZE = 10000
+
+
+def parse_rates(value):
+    rates = {}
+    for setting in (value or '').split(','):
+        if '=' in setting:
+            name, rate = setting.split('=', 1)
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+settings = {
+    'level': LEVELS.get(os.getenv('ANVIL_LOG_LEVEL', 'info').lower(), logging.INFO),
+    'format': os.getenv('ANVIL_LOG_FORMAT', 'text'),
+    # Received messages can arrive thousands a second, so only some are logged unless configured otherwise
+    'sample': dict({'message_received': 0.1}, **parse_rates(os.getenv('ANVIL_LOG_SAMPLE')))
+}
+counts = {'logged': 0, 'dropped': 0, 'sampled_out': 0}
+logger = logging.getLogger('anvil')
+logger.propagate = False
+
+
+def configure(level = None, format_ = None, sample = None):
+    if level is not None:
+        settings['level'] = LEVELS[level]
+    if format_ is not None:
+        settings['format'] = format_
+    if sample is not None:
+        settings['sample'].update(sample)
+
+
+def enabled(level = 'info'):
+    return LEVELS[level] >= settings['level']
+
+
+# A payload's size and hash, enough to match it against the sender's log without writing it out.
+def summarise(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if not isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = json.dumps(payload, sort_keys = True, default = str).encode('utf-8')
+    return {'bytes': len(payload), 'sha256': hashlib.sha256(payload).hexdigest()[:16]}
+
+
+def redact(name, value):
+    if any(word in name.lower() for word in REDACTED):
+        return '[redacted]'
+    if isinstance(value, (bytes, bytearray, memoryview)) or (isinstance(value, (str, dict, list)) and len(str(value)) > MAX_FIELD):
+        return summarise(value)
+    return value
+
+
+'''
+Logs an event if its level is enabled and it is not sampled out. `sample` overrides the configured rate.
+Fields are redacted before queueing, and formatted on the writer thread.
+'''
+def log(event, message = '', level = 'info', sample = None, **fields):
+    if LEVELS[level] < settings['level']:
+        return
+    rate = settings['sample'].get(event, 1) if sample is None else sample
+    if rate < 1:
+        if random.random() >= rate:
+            counts['sampled_out'] += 1
+            return
+        fields['sample_rate'] = rate
+    record = logger.makeRecord(logger.name, LEVELS[level], '', 0, message, None, None)
+    record.event = event
+    record.fields = {name: redact(name, value) for name, value in fields.items()}
+    logger.handle(record)
+
+
+class EventFormatter(logging.Formatter):
+
+    converter = time.gmtime
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if settings['format'] == 'json':
+            return json.dumps(dict({
+                'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + '.%03dZ' % record.msecs,
+                'level': record.levelname.lower(),
+                'event': getattr(record, 'event', record.name),
+                'message': record.getMessage()
+            }, **fields), default = str)
+        return ' '.join([self.formatTime(record, '%H:%M:%S'), record.levelname, getattr(record, 'event', record.name) + ':',
+                         record.getMessage()] + [name + '=' + json.dumps(value, default = str) for name, value in fields.items()])
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    # The record is formatted by the writer, not here on the event loop
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            counts['logged'] += 1
+        except queue.Full:
+            counts['dropped'] += 1
+
+
+def start_writer(stream = None):
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(EventFormatter())
+    events = queue.Queue(QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(events, writer)
+    logger.addHandler(DroppingQueueHandler(events))
+    logger.setLevel(logging.DEBUG)
+    listener.start()
+    # Write what is still queued before the process exits
+    atexit.register(listener.stop)
+    return listener
+
+
+listener = start_writer()
@@ -0,0 +1,7 @@
+'''
+In-memory stand-in for the parts of libindy used by ANVIL: pool, ledger, wallets, DIDs, crypto,
+anoncreds and blob storage. Call signatures and return formats mirror the python3-indy wrapper.
+
+It is for tests, demos and benchmarks only: envelopes are not encrypted and proofs are not
+zero-knowledge, only tamper-evident. See state.py for latency and failure injection.
+'''
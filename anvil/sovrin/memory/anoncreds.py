@@ -0,0 +1,337 @@
+'''
+Stand-in for indy.anoncreds. Objects have the same JSON layout as Indy's where ANVIL reads them.
+
+Credentials are signed with a digest over per-attribute digests, the prover's master secret and
+the revocation index. Proofs carry the attribute digests so revealed values can be checked against
+the signature, and the verifier checks the nonce, the predicates and the registry accumulator.
+None of this hides anything: use it to exercise the flow, not to protect data.
+'''
+
+import hashlib, json, os, secrets, uuid
+from .error import ErrorCode, IndyError
+from .state import get_wallet, get_handle, new_handle, handles, simulate, digest, b58encode
+
+
+PREDICATES = {
+    '>=': lambda value, limit: value >= limit,
+    '>': lambda value, limit: value > limit,
+    '<=': lambda value, limit: value <= limit,
+    '<': lambda value, limit: value < limit
+}
+RESTRICTION_KEYS = ('schema_id', 'schema_issuer_did', 'schema_name', 'schema_version', 'issuer_did', 'cred_def_id', 'rev_reg_id')
+
+
+async def issuer_create_schema(issuer_did, name, version, attrs):
+    id_ = issuer_did + ':2:' + name + ':' + version
+    return id_, json.dumps({'ver': '1.0', 'id': id_, 'name': name, 'version': version,
+                            'attrNames': json.loads(attrs), 'seqNo': None})
+
+
+async def issuer_create_and_store_credential_def(wallet_handle, issuer_did, schema_json, tag, signature_type, config_json):
+    await simulate('anoncreds')
+    wallet = get_wallet(wallet_handle)
+    schema = json.loads(schema_json)
+    id_ = issuer_did + ':3:' + (signature_type or 'CL') + ':' + str(schema['seqNo']) + ':' + tag
+    if id_ in wallet['cred_defs']:
+        raise IndyError(ErrorCode.CommonInvalidStructure, {'message': 'Credential definition already exists'})
+    value = {'primary': {'key': secrets.token_hex(32)}}
+    if json.loads(config_json or '{}').get('support_revocation'):
+        value['revocation'] = {'key': secrets.token_hex(32)}
+    cred_def = {'ver': '1.0', 'id': id_, 'schemaId': str(schema['seqNo']), 'type': signature_type or 'CL',
+                'tag': tag, 'value': value}
+    wallet['cred_defs'][id_] = {'cred_def': cred_def, 'schema': schema}
+    return id_, json.dumps(cred_def)
+
+
+async def issuer_create_credential_offer(wallet_handle, cred_def_id):
+    wallet = get_wallet(wallet_handle)
+    if cred_def_id not in wallet['cred_defs']:
+        raise IndyError(ErrorCode.WalletItemNotFound)
+    return json.dumps({'schema_id': wallet['cred_defs'][cred_def_id]['schema']['id'], 'cred_def_id': cred_def_id,
+                       'nonce': str(secrets.randbelow(10 ** 25)), 'key_correctness_proof': {}})
+
+
+'''
+Creates a registry with a tails file of max_cred_num entries, written to the writer's base_dir
+and named by its base58 SHA-256 like Indy's.
+'''
+async def issuer_create_and_store_revoc_reg(wallet_handle, issuer_did, revoc_def_type, tag, cred_def_id, config_json, tails_writer_handle):
+    await simulate('anoncreds')
+    wallet = get_wallet(wallet_handle)
+    if cred_def_id not in wallet['cred_defs'] or 'revocation' not in wallet['cred_defs'][cred_def_id]['cred_def']['value']:
+        raise IndyError(ErrorCode.CommonInvalidStructure, {'message': 'Credential definition does not support revocation'})
+    config = json.loads(config_json)
+    max_cred_num = config.get('max_cred_num', 100000)
+    id_ = issuer_did + ':4:' + cred_def_id + ':CL_ACCUM:' + tag
+    tails = b''.join(bytes.fromhex(digest(id_, index)) for index in range(1, max_cred_num + 1))
+    tails_hash = b58encode(hashlib.sha256(tails).digest())
+    base_dir = get_handle('blobs', tails_writer_handle, ErrorCode.CommonInvalidParam1)['base_dir']
+    os.makedirs(base_dir, exist_ok = True)
+    with open(os.path.join(base_dir, tails_hash), 'wb') as file_:
+        file_.write(tails)
+    rev_reg_def = {'ver': '1.0', 'id': id_, 'revocDefType': 'CL_ACCUM', 'tag': tag, 'credDefId': cred_def_id,
+                   'value': {'issuanceType': config.get('issuance_type', 'ISSUANCE_ON_DEMAND'), 'maxCredNum': max_cred_num,
+                             'publicKeys': {'accumKey': {'z': digest(id_, 'accum_key')}},
+                             'tailsHash': tails_hash, 'tailsLocation': os.path.join(base_dir, tails_hash)}}
+    accum = digest(id_, 'accum')
+    wallet['rev_regs'][id_] = {'rev_reg_def': rev_reg_def, 'accum': accum, 'issued': [], 'revoked': []}
+    return id_, json.dumps(rev_reg_def), json.dumps({'ver': '1.0', 'value': {'accum': accum}})
+
+
+def attr_digests(values, salt):
+    return {name: digest(name, value['encoded'], salt) for name, value in values.items()}
+
+
+def credential_signature(cred_def, digests, blinded_ms, rev_reg_id, cred_rev_id):
+    return digest(cred_def['value']['primary']['key'], digests, blinded_ms, rev_reg_id, cred_rev_id)
+
+
+def rev_reg_delta(rev_reg, issued, revoked):
+    rev_reg['accum'] = digest(rev_reg['accum'], issued, revoked)
+    return json.dumps({'ver': '1.0', 'value': {'accum': rev_reg['accum'], 'issued': issued, 'revoked': revoked}})
+
+
+async def issuer_create_credential(wallet_handle, cred_offer_json, cred_req_json, cred_values_json, rev_reg_id, blob_storage_reader_handle):
+    await simulate('anoncreds')
+    wallet = get_wallet(wallet_handle)
+    offer, request = json.loads(cred_offer_json), json.loads(cred_req_json)
+    cred_def = wallet['cred_defs'][offer['cred_def_id']]['cred_def']
+    if request['cred_def_id'] != offer['cred_def_id'] or request['nonce'] != offer['nonce']:
+        raise IndyError(ErrorCode.CommonInvalidStructure, {'message': 'Credential request does not match offer'})
+    values = json.loads(cred_values_json)
+    cred_rev_id, delta = None, None
+    if rev_reg_id:
+        rev_reg = wallet['rev_regs'][rev_reg_id]
+        index = len(rev_reg['issued']) + 1
+        if index > rev_reg['rev_reg_def']['value']['maxCredNum']:
+            raise IndyError(ErrorCode.AnoncredsRevocationRegistryFullError)
+        rev_reg['issued'].append(index)
+        cred_rev_id = str(index)
+        delta = rev_reg_delta(rev_reg, [index], [])
+    salt = secrets.token_hex(16)
+    digests = attr_digests(values, salt)
+    cred = {'schema_id': offer['schema_id'], 'cred_def_id': offer['cred_def_id'], 'rev_reg_id': rev_reg_id,
+            'values': values, 'salt': salt, 'cred_rev_id': cred_rev_id,
+            'signature': credential_signature(cred_def, digests, request['blinded_ms'], rev_reg_id, cred_rev_id),
+            'signature_correctness_proof': {}, 'rev_reg': None, 'witness': None}
+    return json.dumps(cred), cred_rev_id, delta
+
+
+async def issuer_revoke_credential(wallet_handle, blob_storage_reader_handle, rev_reg_id, cred_revoc_id):
+    await simulate('anoncreds')
+    rev_reg = get_wallet(wallet_handle)['rev_regs'][rev_reg_id]
+    index = int(cred_revoc_id)
+    if index not in rev_reg['issued']:
+        raise IndyError(ErrorCode.AnoncredsInvalidUserRevocId)
+    if index in rev_reg['revoked']:
+        raise IndyError(ErrorCode.AnoncredsCredentialRevoked)
+    rev_reg['revoked'].append(index)
+    return rev_reg_delta(rev_reg, [], [index])
+
+
+async def issuer_merge_revocation_registry_deltas(rev_reg_delta_json, other_rev_reg_delta_json):
+    delta, other = json.loads(rev_reg_delta_json)['value'], json.loads(other_rev_reg_delta_json)['value']
+    issued = (set(delta.get('issued', [])) | set(other.get('issued', []))) - set(other.get('revoked', []))
+    revoked = (set(delta.get('revoked', [])) | set(other.get('revoked', []))) - set(other.get('issued', []))
+    return json.dumps({'ver': '1.0', 'value': {'accum': other['accum'], 'issued': sorted(issued), 'revoked': sorted(revoked)}})
+
+
+async def prover_create_master_secret(wallet_handle, master_secret_name):
+    wallet = get_wallet(wallet_handle)
+    master_secret_name = master_secret_name or str(uuid.uuid4())
+    wallet['master_secrets'][master_secret_name] = secrets.token_hex(32)
+    return master_secret_name
+
+
+async def prover_create_credential_req(wallet_handle, prover_did, cred_offer_json, cred_def_json, master_secret_id):
+    await simulate('anoncreds')
+    wallet = get_wallet(wallet_handle)
+    if master_secret_id not in wallet['master_secrets']:
+        raise IndyError(ErrorCode.WalletItemNotFound)
+    offer = json.loads(cred_offer_json)
+    blinded_ms = digest(wallet['master_secrets'][master_secret_id], offer['cred_def_id'])
+    request = {'prover_did': prover_did, 'cred_def_id': offer['cred_def_id'], 'blinded_ms': blinded_ms,
+               'blinded_ms_correctness_proof': {}, 'nonce': offer['nonce']}
+    metadata = {'master_secret_name': master_secret_id, 'nonce': offer['nonce']}
+    return json.dumps(request), json.dumps(metadata)
+
+
+async def prover_store_credential(wallet_handle, cred_id, cred_req_metadata_json, cred_json, cred_def_json, rev_reg_def_json):
+    await simulate('wallet')
+    wallet = get_wallet(wallet_handle)
+    metadata, cred, cred_def = json.loads(cred_req_metadata_json), json.loads(cred_json), json.loads(cred_def_json)
+    blinded_ms = digest(wallet['master_secrets'][metadata['master_secret_name']], cred['cred_def_id'])
+    signature = credential_signature(cred_def, attr_digests(cred['values'], cred['salt']), blinded_ms,
+                                     cred['rev_reg_id'], cred['cred_rev_id'])
+    if signature != cred['signature']:
+        raise IndyError(ErrorCode.CommonInvalidStructure, {'message': 'Credential signature does not verify'})
+    cred_id = cred_id or str(uuid.uuid4())
+    schema_issuer_did, _, schema_name, schema_version = cred['schema_id'].split(':')
+    wallet['credentials'][cred_id] = dict(cred, master_secret_name = metadata['master_secret_name'], cred_info = {
+        'referent': cred_id,
+        'attrs': {name: value['raw'] for name, value in cred['values'].items()},
+        'schema_id': cred['schema_id'],
+        'cred_def_id': cred['cred_def_id'],
+        'rev_reg_id': cred['rev_reg_id'],
+        'cred_rev_id': cred['cred_rev_id']
+    }, tags = {
+        'schema_id': cred['schema_id'], 'schema_issuer_did': schema_issuer_did, 'schema_name': schema_name,
+        'schema_version': schema_version, 'issuer_did': cred['cred_def_id'].split(':')[0],
+        'cred_def_id': cred['cred_def_id'], 'rev_reg_id': cred['rev_reg_id']
+    })
+    return cred_id
+
+
+def matches_restrictions(tags, restrictions):
+    if not restrictions:
+        return True
+    if isinstance(restrictions, dict):
+        if '$or' in restrictions:
+            return any(matches_restrictions(tags, item) for item in restrictions['$or'])
+        return all(tags.get(key) == value for key, value in restrictions.items() if key in RESTRICTION_KEYS)
+    return any(matches_restrictions(tags, item) for item in restrictions)
+
+
+def normalise(name):
+    return name.replace(' ', '').lower()
+
+
+async def prover_search_credentials_for_proof_req(wallet_handle, proof_request_json, extra_query_json):
+    await simulate('wallet')
+    get_wallet(wallet_handle)
+    return new_handle('searches', {'wallet': wallet_handle, 'proof_request': json.loads(proof_request_json), 'fetched': {}})
+
+
+async def prover_fetch_credentials_for_proof_req(search_handle, item_referent, count):
+    search = get_handle('searches', search_handle, ErrorCode.CommonInvalidParam1)
+    request = search['proof_request']
+    item = request.get('requested_attributes', {}).get(item_referent) or request.get('requested_predicates', {}).get(item_referent)
+    if item is None:
+        raise IndyError(ErrorCode.CommonInvalidStructure, {'message': 'Unknown referent ' + item_referent})
+    found = [{'cred_info': cred['cred_info'], 'interval': item.get('non_revoked', request.get('non_revoked'))}
+             for cred in get_wallet(search['wallet'])['credentials'].values()
+             if normalise(item['name']) in map(normalise, cred['values']) and matches_restrictions(cred['tags'], item.get('restrictions'))]
+    start = search['fetched'].get(item_referent, 0)
+    search['fetched'][item_referent] = start + count
+    return json.dumps(found[start:start + count])
+
+
+async def prover_close_credentials_search_for_proof_req(search_handle):
+    get_handle('searches', search_handle, ErrorCode.CommonInvalidParam1)
+    del handles['searches'][search_handle]
+
+
+def value_of(cred, name):
+    for key, value in cred['values'].items():
+        if normalise(key) == normalise(name):
+            return key, value
+    raise IndyError(ErrorCode.CommonInvalidStructure, {'message': 'Credential has no attribute ' + name})
+
+
+def revocation_witness(rev_reg_id, cred_rev_id, accum, valid):
+    return digest(rev_reg_id, cred_rev_id, accum, valid)
+
+
+async def create_revocation_state(blob_storage_reader_handle, rev_reg_def_json, rev_reg_delta_json, timestamp, cred_rev_id):
+    await simulate('anoncreds')
+    rev_reg_def, delta = json.loads(rev_reg_def_json), json.loads(rev_reg_delta_json)['value']
+    index = int(cred_rev_id)
+    valid = index in delta.get('issued', []) and index not in delta.get('revoked', [])
+    return json.dumps({'rev_reg': {'accum': delta['accum']}, 'timestamp': timestamp, 'valid': valid,
+                       'witness': {'omega': revocation_witness(rev_reg_def['id'], str(index), delta['accum'], valid)}})
+
+
+async def update_revocation_state(blob_storage_reader_handle, rev_state_json, rev_reg_def_json, rev_reg_delta_json, timestamp, cred_rev_id):
+    return await create_revocation_state(blob_storage_reader_handle, rev_reg_def_json, rev_reg_delta_json, timestamp, cred_rev_id)
+
+
+'''
+Builds an Indy-shaped proof: requested_proof with sub_proof_index references and one sub proof
+per credential (and timestamp), with the identifiers the verifier resolves on the ledger.
+'''
+async def prover_create_proof(wallet_handle, proof_req_json, requested_credentials_json, master_secret_name,
+                              schemas_json, credential_defs_json, rev_states_json):
+    await simulate('anoncreds')
+    wallet = get_wallet(wallet_handle)
+    request, requested = json.loads(proof_req_json), json.loads(requested_credentials_json)
+    rev_states = json.loads(rev_states_json)
+    requested_proof = {'revealed_attrs': {}, 'self_attested_attrs': dict(requested.get('self_attested_attributes', {})),
+                       'unrevealed_attrs': {}, 'predicates': {}}
+    sub_proofs, identifiers, indices = [], [], {}
+
+    def sub_proof_index(requested_cred):
+        key = (requested_cred['cred_id'], requested_cred.get('timestamp'))
+        if key not in indices:
+            if requested_cred['cred_id'] not in wallet['credentials']:
+                raise IndyError(ErrorCode.WalletItemNotFound)
+            cred = wallet['credentials'][requested_cred['cred_id']]
+            if cred['master_secret_name'] != master_secret_name:
+                raise IndyError(ErrorCode.CommonInvalidStructure, {'message': 'Credential is bound to another master secret'})
+            non_revoc_proof = None
+            if cred['rev_reg_id'] and key[1] is not None:
+                state = rev_states[cred['rev_reg_id']][str(key[1])]
+                non_revoc_proof = {'accum': state['rev_reg']['accum'], 'valid': state['valid'], 'omega': state['witness']['omega']}
+            indices[key] = len(sub_proofs)
+            sub_proofs.append({'primary_proof': {'digests': attr_digests(cred['values'], cred['salt']), 'salt': cred['salt'],
+                                                 'blinded_ms': digest(wallet['master_secrets'][master_secret_name], cred['cred_def_id']),
+                                                 'cred_rev_id': cred['cred_rev_id'], 'signature': cred['signature'],
+                                                 'revealed': {}, 'predicates': []},
+                               'non_revoc_proof': non_revoc_proof})
+            identifiers.append({'schema_id': cred['schema_id'], 'cred_def_id': cred['cred_def_id'],
+                                'rev_reg_id': cred['rev_reg_id'], 'timestamp': key[1]})
+        return indices[key], wallet['credentials'][requested_cred['cred_id']]
+
+    for referent, requested_cred in requested.get('requested_attributes', {}).items():
+        index, cred = sub_proof_index(requested_cred)
+        name, value = value_of(cred, request['requested_attributes'][referent]['name'])
+        if requested_cred.get('revealed', True):
+            sub_proofs[index]['primary_proof']['revealed'][name] = value['encoded']
+            requested_proof['revealed_attrs'][referent] = {'sub_proof_index': index, 'raw': value['raw'], 'encoded': value['encoded']}
+        else:
+            requested_proof['unrevealed_attrs'][referent] = {'sub_proof_index': index}
+    for referent, requested_cred in requested.get('requested_predicates', {}).items():
+        index, cred = sub_proof_index(requested_cred)
+        predicate = request['requested_predicates'][referent]
+        name, value = value_of(cred, predicate['name'])
+        if not PREDICATES[predicate['p_type']](int(value['encoded']), predicate['p_value']):
+            raise IndyError(ErrorCode.AnoncredsProofRejected, {'message': 'Predicate ' + referent + ' is not satisfied'})
+        sub_proofs[index]['primary_proof']['predicates'].append({'attr_name': name, 'p_type': predicate['p_type'], 'value': predicate['p_value']})
+        requested_proof['predicates'][referent] = {'sub_proof_index': index}
+    return json.dumps({'proof': {'proofs': sub_proofs, 'aggregated_proof': {'c_hash': digest(request['nonce'], sub_proofs)}},
+                       'requested_proof': requested_proof, 'identifiers': identifiers})
+
+
+async def verifier_verify_proof(proof_request_json, proof_json, schemas_json, credential_defs_json, rev_reg_defs_json, rev_regs_json):
+    await simulate('anoncreds')
+    request, proof = json.loads(proof_request_json), json.loads(proof_json)
+    cred_defs, rev_regs = json.loads(credential_defs_json), json.loads(rev_regs_json)
+    sub_proofs, requested_proof = proof['proof']['proofs'], proof['requested_proof']
+    try:
+        if proof['proof']['aggregated_proof']['c_hash'] != digest(request['nonce'], sub_proofs):
+            return False
+        for sub_proof, identifier in zip(sub_proofs, proof['identifiers']):
+            primary = sub_proof['primary_proof']
+            if primary['signature'] != credential_signature(cred_defs[identifier['cred_def_id']], primary['digests'], primary['blinded_ms'],
+                                                            identifier['rev_reg_id'], primary['cred_rev_id']):
+                return False
+            if any(primary['digests'].get(name) != digest(name, encoded, primary['salt']) for name, encoded in primary['revealed'].items()):
+                return False
+            non_revoc_proof = sub_proof['non_revoc_proof']
+            if identifier['rev_reg_id'] and identifier['timestamp'] is not None:
+                accum = rev_regs[identifier['rev_reg_id']][str(identifier['timestamp'])]['value']['accum']
+                if not non_revoc_proof or not non_revoc_proof['valid'] or non_revoc_proof['accum'] != accum or \
+                        non_revoc_proof['omega'] != revocation_witness(identifier['rev_reg_id'], primary['cred_rev_id'], accum, True):
+                    return False
+        for referent, attr in requested_proof['revealed_attrs'].items():
+            primary = sub_proofs[attr['sub_proof_index']]['primary_proof']
+            name = next((key for key in primary['revealed'] if normalise(key) == normalise(request['requested_attributes'][referent]['name'])), None)
+            if name is None or primary['revealed'][name] != attr['encoded']:
+                return False
+        for referent, predicate in request.get('requested_predicates', {}).items():
+            primary = sub_proofs[requested_proof['predicates'][referent]['sub_proof_index']]['primary_proof']
+            if not any(normalise(item['attr_name']) == normalise(predicate['name']) and item['p_type'] == predicate['p_type']
+                       and item['value'] == predicate['p_value'] for item in primary['predicates']):
+                return False
+    except (KeyError, IndexError, TypeError):
+        raise IndyError(ErrorCode.CommonInvalidStructure, {'message': 'Proof does not match the request'})
+    return True
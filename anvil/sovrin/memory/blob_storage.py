@@ -0,0 +1,14 @@
+'''
+Stand-in for indy.blob_storage. Handles only remember the storage config.
+'''
+
+import json
+from .state import new_handle
+
+
+async def open_reader(type_, config_json):
+    return new_handle('blobs', json.loads(config_json))
+
+
+async def open_writer(type_, config_json):
+    return new_handle('blobs', json.loads(config_json))
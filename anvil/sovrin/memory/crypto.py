@@ -0,0 +1,53 @@
+'''
+Stand-in for indy.crypto.
+Envelopes are JSON with the payload in base64: they check who a message is for and from,
+but they are not encrypted.
+'''
+
+import base64, json
+from .error import ErrorCode, IndyError
+from .state import get_wallet, simulate
+
+
+def envelope(recipient_vk, message, sender_vk = None):
+    return json.dumps({
+        'recipient': recipient_vk,
+        'sender': sender_vk,
+        'message': base64.b64encode(bytes(message)).decode('ascii')
+    }).encode('utf-8')
+
+
+def open_envelope(wallet_handle, my_vk, encrypted_message):
+    wallet = get_wallet(wallet_handle)
+    try:
+        sealed = json.loads(bytes(encrypted_message).decode('utf-8'))
+    except ValueError:
+        raise IndyError(ErrorCode.CommonInvalidStructure)
+    if sealed['recipient'] != my_vk or my_vk not in wallet['keys']:
+        raise IndyError(ErrorCode.WalletItemNotFound)
+    return sealed['sender'], base64.b64decode(sealed['message'])
+
+
+async def auth_crypt(wallet_handle, sender_vk, recipient_vk, message):
+    await simulate('crypto')
+    if sender_vk not in get_wallet(wallet_handle)['keys']:
+        raise IndyError(ErrorCode.WalletItemNotFound)
+    return envelope(recipient_vk, message, sender_vk)
+
+
+async def auth_decrypt(wallet_handle, recipient_vk, encrypted_message):
+    await simulate('crypto')
+    sender_vk, message = open_envelope(wallet_handle, recipient_vk, encrypted_message)
+    if sender_vk is None:
+        raise IndyError(ErrorCode.CommonInvalidStructure)
+    return sender_vk, message
+
+
+async def anon_crypt(recipient_vk, message):
+    await simulate('crypto')
+    return envelope(recipient_vk, message)
+
+
+async def anon_decrypt(wallet_handle, recipient_vk, encrypted_message):
+    await simulate('crypto')
+    return open_envelope(wallet_handle, recipient_vk, encrypted_message)[1]
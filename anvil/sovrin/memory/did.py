@@ -0,0 +1,45 @@
+'''
+Stand-in for indy.did.
+'''
+
+import json
+from .error import ErrorCode, IndyError
+from .state import get_wallet, get_handle, new_key_pair, simulate, ledger_get
+
+
+async def create_and_store_my_did(wallet_handle, did_json):
+    await simulate('wallet')
+    wallet = get_wallet(wallet_handle)
+    did, verkey = new_key_pair(json.loads(did_json).get('seed'))
+    if did in wallet['dids']:
+        raise IndyError(ErrorCode.DidAlreadyExistsError)
+    wallet['dids'][did] = {'verkey': verkey, 'metadata': None}
+    wallet['keys'][verkey] = did
+    return did, verkey
+
+
+async def store_their_did(wallet_handle, identity_json):
+    identity = json.loads(identity_json)
+    get_wallet(wallet_handle)['their_dids'][identity['did']] = identity['verkey']
+
+
+# Looks in the wallet first, then on the ledger.
+async def key_for_did(pool_handle, wallet_handle, did):
+    wallet = get_wallet(wallet_handle)
+    if did in wallet['dids']:
+        return wallet['dids'][did]['verkey']
+    if did in wallet['their_dids']:
+        return wallet['their_dids'][did]
+    get_handle('pools', pool_handle, ErrorCode.PoolLedgerInvalidPoolHandle)
+    await simulate('ledger')
+    nym = ledger_get('NYM', did)
+    if not nym:
+        raise IndyError(ErrorCode.WalletItemNotFound)
+    return nym[1]['verkey']
+
+
+async def key_for_local_did(wallet_handle, did):
+    wallet = get_wallet(wallet_handle)
+    if did not in wallet['dids']:
+        raise IndyError(ErrorCode.WalletItemNotFound)
+    return wallet['dids'][did]['verkey']
@@ -0,0 +1,39 @@
+'''
+Stand-in for indy.error, with the error codes ANVIL handles.
+'''
+
+from enum import IntEnum
+
+
+class ErrorCode(IntEnum):
+    Success = 0
+    CommonInvalidParam1 = 100
+    CommonInvalidStructure = 113
+    WalletInvalidHandle = 200
+    WalletNotFoundError = 204
+    WalletAlreadyExistsError = 203
+    WalletAlreadyOpenedError = 206
+    WalletAccessFailed = 207
+    WalletItemNotFound = 212
+    PoolLedgerNotCreatedError = 300
+    PoolLedgerInvalidPoolHandle = 301
+    PoolLedgerTerminated = 302
+    LedgerNoConsensusError = 303
+    LedgerInvalidTransaction = 304
+    LedgerSecurityError = 305
+    PoolLedgerConfigAlreadyExistsError = 306
+    PoolLedgerTimeout = 307
+    LedgerNotFound = 309
+    AnoncredsRevocationRegistryFullError = 401
+    AnoncredsInvalidUserRevocId = 402
+    AnoncredsCredentialRevoked = 406
+    AnoncredsProofRejected = 405
+    DidAlreadyExistsError = 600
+
+
+class IndyError(Exception):
+
+    def __init__(self, error_code, error_details = None):
+        self.error_code = error_code
+        self.error_details = error_details or {}
+        super().__init__(error_code, self.error_details)
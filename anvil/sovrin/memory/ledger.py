@@ -0,0 +1,158 @@
+'''
+Stand-in for indy.ledger, over the SQLite ledger in state.py.
+Requests and replies are JSON in the same shape as Indy's, trimmed to the fields ANVIL uses.
+'''
+
+import json
+from .error import ErrorCode, IndyError
+from .state import get_wallet, get_handle, simulate, ledger_get, ledger_write, ledger_history
+
+
+WRITES = {'1': 'NYM', '101': 'SCHEMA', '102': 'CRED_DEF', '113': 'REVOC_REG_DEF', '114': 'REVOC_REG_ENTRY'}
+READS = {'105': 'NYM', '107': 'SCHEMA', '108': 'CRED_DEF', '115': 'REVOC_REG_DEF', '116': 'REVOC_REG', '117': 'REVOC_REG_DELTA'}
+
+
+def request(submitter_did, operation):
+    return json.dumps({'identifier': submitter_did, 'operation': operation})
+
+
+async def build_nym_request(submitter_did, target_did, ver_key, alias, role):
+    return request(submitter_did, {'type': '1', 'dest': target_did, 'verkey': ver_key, 'alias': alias, 'role': role})
+
+
+async def build_get_nym_request(submitter_did, target_did):
+    return request(submitter_did, {'type': '105', 'id': target_did})
+
+
+async def build_schema_request(submitter_did, data):
+    return request(submitter_did, {'type': '101', 'data': json.loads(data)})
+
+
+async def build_get_schema_request(submitter_did, id_):
+    return request(submitter_did, {'type': '107', 'id': id_})
+
+
+async def build_cred_def_request(submitter_did, data):
+    return request(submitter_did, {'type': '102', 'data': json.loads(data)})
+
+
+async def build_get_cred_def_request(submitter_did, id_):
+    return request(submitter_did, {'type': '108', 'id': id_})
+
+
+async def build_revoc_reg_def_request(submitter_did, data):
+    return request(submitter_did, {'type': '113', 'data': json.loads(data)})
+
+
+async def build_revoc_reg_entry_request(submitter_did, revoc_reg_def_id, rev_def_type, value):
+    return request(submitter_did, {'type': '114', 'revocRegDefId': revoc_reg_def_id, 'revocDefType': rev_def_type,
+                                   'value': json.loads(value)['value']})
+
+
+async def build_get_revoc_reg_def_request(submitter_did, id_):
+    return request(submitter_did, {'type': '115', 'id': id_})
+
+
+async def build_get_revoc_reg_request(submitter_did, revoc_reg_def_id, timestamp):
+    return request(submitter_did, {'type': '116', 'id': revoc_reg_def_id, 'timestamp': timestamp})
+
+
+async def build_get_revoc_reg_delta_request(submitter_did, revoc_reg_def_id, from_, to):
+    return request(submitter_did, {'type': '117', 'id': revoc_reg_def_id, 'from': from_, 'to': to})
+
+
+async def sign_and_submit_request(pool_handle, wallet_handle, submitter_did, request_json):
+    get_handle('pools', pool_handle, ErrorCode.PoolLedgerInvalidPoolHandle)
+    if submitter_did not in get_wallet(wallet_handle)['dids']:
+        raise IndyError(ErrorCode.WalletItemNotFound)
+    await simulate('ledger')
+    operation = json.loads(request_json)['operation']
+    if operation['type'] not in WRITES:
+        return read(operation)
+    submitter = ledger_get('NYM', submitter_did)
+    # Only DIDs on the ledger can write, and only those with a role can write anything but NYMs
+    if not submitter or (operation['type'] != '1' and not submitter[1]['role']):
+        raise IndyError(ErrorCode.LedgerSecurityError)
+    type_ = WRITES[operation['type']]
+    if type_ == 'NYM':
+        id_, data = operation['dest'], operation
+    elif type_ == 'REVOC_REG_ENTRY':
+        id_, data = operation['revocRegDefId'], operation['value']
+    else:
+        id_, data = operation['data']['id'], operation['data']
+        if type_ != 'REVOC_REG_DEF' and ledger_get(type_, id_):
+            raise IndyError(ErrorCode.LedgerInvalidTransaction)
+    seq_no, txn_time = ledger_write(type_, id_, data)
+    return json.dumps({'op': 'REPLY', 'result': {'txnMetadata': {'seqNo': seq_no, 'txnTime': txn_time}}})
+
+
+async def submit_request(pool_handle, request_json):
+    get_handle('pools', pool_handle, ErrorCode.PoolLedgerInvalidPoolHandle)
+    await simulate('ledger')
+    return read(json.loads(request_json)['operation'])
+
+
+def read(operation):
+    type_ = READS.get(operation['type'])
+    if type_ == 'REVOC_REG' or type_ == 'REVOC_REG_DELTA':
+        from_ = operation.get('from') if type_ == 'REVOC_REG_DELTA' else None
+        to = operation['to'] if type_ == 'REVOC_REG_DELTA' else operation['timestamp']
+        entries = ledger_history('REVOC_REG_ENTRY', operation['id'], from_, to)
+        if not entries and from_ is not None:
+            # Nothing changed in the interval, answer with the state as of the start
+            entries = ledger_history('REVOC_REG_ENTRY', operation['id'], None, from_)[-1:]
+            value = {'accum': entries[-1][1]['accum'], 'issued': [], 'revoked': []} if entries else None
+        else:
+            value = fold_entries(entries) if entries else None
+        data = {'id': operation['id'], 'value': value}
+        return reply(data if value else None, entries[-1][0] if entries else None, entries[-1][2] if entries else None)
+    found = ledger_get(type_, operation['id'])
+    if not found:
+        return reply(None, None, None)
+    seq_no, data, txn_time = found
+    return reply(dict(data, seqNo = seq_no) if type_ == 'SCHEMA' else data, seq_no, txn_time)
+
+
+# Issued / revoked indices after applying entries in order.
+def fold_entries(entries):
+    issued, revoked = set(), set()
+    for _, value, _ in entries:
+        issued = (issued | set(value.get('issued', []))) - set(value.get('revoked', []))
+        revoked = (revoked | set(value.get('revoked', []))) - set(value.get('issued', []))
+    return {'accum': entries[-1][1]['accum'], 'issued': sorted(issued), 'revoked': sorted(revoked)}
+
+
+def reply(data, seq_no, txn_time):
+    return json.dumps({'op': 'REPLY', 'result': {'data': data, 'seqNo': seq_no, 'txnTime': txn_time}})
+
+
+def reply_data(response):
+    result = json.loads(response)['result']
+    if result['data'] is None:
+        raise IndyError(ErrorCode.LedgerNotFound)
+    return result
+
+
+async def parse_get_schema_response(get_schema_response):
+    data = reply_data(get_schema_response)['data']
+    return data['id'], json.dumps(data)
+
+
+async def parse_get_cred_def_response(get_cred_def_response):
+    data = reply_data(get_cred_def_response)['data']
+    return data['id'], json.dumps(data)
+
+
+async def parse_get_revoc_reg_def_response(get_revoc_reg_def_response):
+    data = reply_data(get_revoc_reg_def_response)['data']
+    return data['id'], json.dumps(data)
+
+
+async def parse_get_revoc_reg_response(get_revoc_reg_response):
+    result = reply_data(get_revoc_reg_response)
+    return result['data']['id'], json.dumps({'ver': '1.0', 'value': result['data']['value']}), result['txnTime']
+
+
+async def parse_get_revoc_reg_delta_response(get_revoc_reg_delta_response):
+    result = reply_data(get_revoc_reg_delta_response)
+    return result['data']['id'], json.dumps({'ver': '1.0', 'value': result['data']['value']}), result['txnTime']
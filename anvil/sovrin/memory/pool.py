@@ -0,0 +1,37 @@
+'''
+Stand-in for indy.pool.
+'''
+
+from .error import ErrorCode, IndyError
+from .state import handles, pool_configs, new_handle, get_handle, simulate, ledger
+
+
+async def set_protocol_version(protocol_version):
+    pool_configs.setdefault('protocol_version', protocol_version)
+
+
+async def create_pool_ledger_config(config_name, config):
+    if config_name in pool_configs:
+        raise IndyError(ErrorCode.PoolLedgerConfigAlreadyExistsError)
+    pool_configs[config_name] = config
+
+
+async def open_pool_ledger(config_name, config):
+    if config_name not in pool_configs:
+        raise IndyError(ErrorCode.PoolLedgerNotCreatedError)
+    await simulate('ledger')
+    ledger()
+    return new_handle('pools', config_name)
+
+
+async def list_pools():
+    return [{'pool': name} for name in pool_configs if name != 'protocol_version']
+
+
+async def close_pool_ledger(handle):
+    get_handle('pools', handle, ErrorCode.PoolLedgerInvalidPoolHandle)
+    del handles['pools'][handle]
+
+
+async def delete_pool_ledger_config(config_name):
+    pool_configs.pop(config_name, None)
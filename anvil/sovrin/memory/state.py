@@ -0,0 +1,140 @@
+'''
+Shared state of the in-memory stand-in:
+
+1. Latency and failure injection per operation kind (ledger, wallet, crypto, anoncreds).
+2. Handles for pools, wallets, searches and blob storage.
+3. The ledger, a SQLite table of transactions. In memory by default, set ANVIL_MEMORY_LEDGER
+   to a file path to share one ledger between processes (e.g. the four actor apps).
+4. Wallets, which stay private to the process that opened them.
+
+Latency is set in seconds with ANVIL_MEMORY_LATENCY, e.g. 'ledger=0.05,crypto=0.001', and failure
+probability with ANVIL_MEMORY_FAILURES, e.g. 'ledger=0.01'. Both can be changed with configure().
+'''
+
+import asyncio, hashlib, json, os, random, secrets, sqlite3, time
+from .error import ErrorCode, IndyError
+
+
+KINDS = ('ledger', 'wallet', 'crypto', 'anoncreds')
+# Errors raised when a failure is injected, by operation kind
+FAILURES = {
+    'ledger': ErrorCode.PoolLedgerTimeout,
+    'wallet': ErrorCode.WalletAccessFailed,
+    'crypto': ErrorCode.CommonInvalidStructure,
+    'anoncreds': ErrorCode.CommonInvalidStructure
+}
+STEWARD_SEEDS = ['000000000000000000000000Steward1']
+BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def parse_settings(setting):
+    settings = {}
+    for item in filter(None, (setting or '').split(',')):
+        kind, value = item.split('=')
+        settings[kind.strip()] = float(value)
+    return settings
+
+
+simulation = {
+    'latency': parse_settings(os.getenv('ANVIL_MEMORY_LATENCY')),
+    'failures': parse_settings(os.getenv('ANVIL_MEMORY_FAILURES')),
+    'random': random.Random(os.getenv('ANVIL_MEMORY_SEED'))
+}
+handles = {'next': 1, 'pools': {}, 'wallets': {}, 'searches': {}, 'blobs': {}}
+pool_configs = {}
+wallets = {}
+ledger_db = {}
+
+
+'''
+Sets latency in seconds and failure probability per operation kind, e.g.
+configure(latency = {'ledger': 0.05}, failures = {'ledger': 0.01}).
+'''
+def configure(latency = None, failures = None, seed = None):
+    if latency is not None:
+        simulation['latency'] = dict(latency)
+    if failures is not None:
+        simulation['failures'] = dict(failures)
+    if seed is not None:
+        simulation['random'].seed(seed)
+
+
+async def simulate(kind):
+    latency = simulation['latency'].get(kind, 0)
+    if latency:
+        await asyncio.sleep(latency)
+    if simulation['random'].random() < simulation['failures'].get(kind, 0):
+        raise IndyError(FAILURES[kind], {'message': 'Injected ' + kind + ' failure'})
+
+
+def new_handle(kind, value):
+    handle = handles['next']
+    handles['next'] += 1
+    handles[kind][handle] = value
+    return handle
+
+
+def get_handle(kind, handle, error_code):
+    if handle not in handles[kind]:
+        raise IndyError(error_code)
+    return handles[kind][handle]
+
+
+def b58encode(data):
+    number = int.from_bytes(data, 'big')
+    encoded = ''
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58[remainder] + encoded
+    return BASE58[0] * (len(data) - len(data.lstrip(b'\0'))) + encoded
+
+
+def digest(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys = True).encode('utf-8')).hexdigest()
+
+
+# DIDs are the first 16 bytes of the verkey, as in Indy.
+def new_key_pair(seed = None):
+    secret = hashlib.sha256(seed.encode('utf-8')).digest() if seed else secrets.token_bytes(32)
+    verkey = b58encode(hashlib.sha256(b'verkey' + secret).digest())
+    did = b58encode(hashlib.sha256(b'verkey' + secret).digest()[:16])
+    return did, verkey
+
+
+def get_wallet(handle):
+    return wallets[get_handle('wallets', handle, ErrorCode.WalletInvalidHandle)]
+
+
+def ledger():
+    path = os.getenv('ANVIL_MEMORY_LEDGER', ':memory:')
+    if path not in ledger_db:
+        connection = sqlite3.connect(path, isolation_level = None, check_same_thread = False)
+        connection.execute('CREATE TABLE IF NOT EXISTS txns (seq_no INTEGER PRIMARY KEY, type TEXT, id TEXT, data TEXT, txn_time INTEGER)')
+        connection.execute('CREATE INDEX IF NOT EXISTS txns_id ON txns (type, id)')
+        ledger_db[path] = connection
+        # Genesis: Steward DIDs are on the ledger from the start
+        for seed in STEWARD_SEEDS:
+            did, verkey = new_key_pair(seed)
+            if not ledger_get('NYM', did):
+                ledger_write('NYM', did, {'dest': did, 'verkey': verkey, 'role': 'STEWARD'})
+    return ledger_db[path]
+
+
+def ledger_write(type_, id_, data):
+    txn_time = int(time.time())
+    cursor = ledger().execute('INSERT INTO txns (type, id, data, txn_time) VALUES (?, ?, ?, ?)',
+                              (type_, id_, json.dumps(data), txn_time))
+    return cursor.lastrowid, txn_time
+
+
+# Latest transaction of a type for an ID, as (seq_no, data, txn_time), or None.
+def ledger_get(type_, id_):
+    row = ledger().execute('SELECT seq_no, data, txn_time FROM txns WHERE type = ? AND id = ? ORDER BY seq_no DESC LIMIT 1',
+                           (type_, id_)).fetchone()
+    return (row[0], json.loads(row[1]), row[2]) if row else None
+
+
+def ledger_history(type_, id_, from_ = None, to = None):
+    rows = ledger().execute('SELECT seq_no, data, txn_time FROM txns WHERE type = ? AND id = ? AND txn_time > ? AND txn_time <= ? ORDER BY seq_no',
+                            (type_, id_, -1 if from_ is None else from_, to if to is not None else 2 ** 62)).fetchall()
+    return [(row[0], json.loads(row[1]), row[2]) for row in rows]
@@ -0,0 +1,65 @@
+'''
+Stand-in for indy.wallet.
+Wallets live in process memory. RAW keys are used as given, other keys go through a
+(much cheaper than Argon2) hash so the key check behaves like Indy's.
+'''
+
+import hashlib, json, secrets
+from .error import ErrorCode, IndyError
+from .state import handles, wallets, new_handle, get_handle, simulate, b58encode
+
+
+def derive_key(credentials):
+    credentials = json.loads(credentials)
+    if credentials.get('key_derivation_method') == 'RAW':
+        return credentials['key']
+    return hashlib.sha256(credentials['key'].encode('utf-8')).hexdigest()
+
+
+async def create_wallet(config, credentials):
+    await simulate('wallet')
+    id_ = json.loads(config)['id']
+    if id_ in wallets:
+        raise IndyError(ErrorCode.WalletAlreadyExistsError)
+    wallets[id_] = {
+        'id': id_,
+        'key': derive_key(credentials),
+        'dids': {},          # did -> {'verkey', 'metadata'}
+        'keys': {},          # verkey -> did
+        'their_dids': {},    # did -> verkey
+        'master_secrets': {},
+        'cred_defs': {},     # cred_def_id -> {'cred_def', 'secret'}
+        'rev_regs': {},      # rev_reg_id -> {'rev_reg_def', 'issued', 'revoked'}
+        'credentials': {}    # cred_id -> credential with cred_info
+    }
+
+
+async def open_wallet(config, credentials):
+    await simulate('wallet')
+    id_ = json.loads(config)['id']
+    if id_ not in wallets:
+        raise IndyError(ErrorCode.WalletNotFoundError)
+    if wallets[id_]['key'] != derive_key(credentials):
+        raise IndyError(ErrorCode.WalletAccessFailed)
+    if id_ in handles['wallets'].values():
+        raise IndyError(ErrorCode.WalletAlreadyOpenedError)
+    return new_handle('wallets', id_)
+
+
+async def close_wallet(handle):
+    get_handle('wallets', handle, ErrorCode.WalletInvalidHandle)
+    del handles['wallets'][handle]
+
+
+async def delete_wallet(config, credentials):
+    id_ = json.loads(config)['id']
+    if id_ not in wallets:
+        raise IndyError(ErrorCode.WalletNotFoundError)
+    if wallets[id_]['key'] != derive_key(credentials):
+        raise IndyError(ErrorCode.WalletAccessFailed)
+    del wallets[id_]
+
+
+async def generate_wallet_key(config = None):
+    seed = json.loads(config).get('seed') if config else None
+    return b58encode(hashlib.sha256(seed.encode('utf-8')).digest() if seed else secrets.token_bytes(32))
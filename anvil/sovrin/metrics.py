@@ -0,0 +1,139 @@
+'''
+Process-wide metrics in the Prometheus text exposition format:
+
+1. Counters and histograms, updated as things happen (HTTP routes, Indy calls, outbound posts).
+2. Collectors, read when metrics are rendered (inbox depths, cache hit ratios).
+3. render() for a /metrics endpoint.
+
+Metrics are kept as plain dictionaries keyed by label values, no client library needed.
+'''
+
+import json, time
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.tracing import span
+except ImportError:
+    from tracing import span
+
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+metrics = {}    # name -> {'type', 'help', 'labels', 'values': {label values: value or histogram}}
+collectors = []
+
+
+def describe(name, type_, help_, labels = ()):
+    if name not in metrics:
+        metrics[name] = {'type': type_, 'help': help_, 'labels': tuple(labels), 'values': {}}
+    return metrics[name]
+
+
+def inc(name, *label_values, value = 1):
+    values = metrics[name]['values']
+    values[label_values] = values.get(label_values, 0) + value
+
+
+def observe(name, seconds, *label_values):
+    values = metrics[name]['values']
+    if label_values not in values:
+        values[label_values] = {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0}
+    histogram = values[label_values]
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            histogram['buckets'][i] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+
+'''
+Registers a function called on each render, returning samples as
+[(name, type, help, {label: value}, value), ...] for values owned elsewhere.
+'''
+def register_collector(collector):
+    if collector not in collectors:
+        collectors.append(collector)
+
+
+def unregister_collector(collector):
+    if collector in collectors:
+        collectors.remove(collector)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in labels.items()) + '}'
+
+
+def render():
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append('# HELP ' + name + ' ' + metric['help'])
+        lines.append('# TYPE ' + name + ' ' + metric['type'])
+        for label_values, value in sorted(metric['values'].items()):
+            labels = dict(zip(metric['labels'], label_values))
+            if metric['type'] != 'histogram':
+                lines.append(name + format_labels(labels) + ' ' + repr(value))
+                continue
+            for bound, count in zip(BUCKETS, value['buckets']):
+                lines.append(name + '_bucket' + format_labels(dict(labels, le = repr(bound))) + ' ' + str(count))
+            lines.append(name + '_bucket' + format_labels(dict(labels, le = '+Inf')) + ' ' + str(value['count']))
+            lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(value['sum']))
+            lines.append(name + '_count' + format_labels(labels) + ' ' + str(value['count']))
+    # Samples of a metric have to be contiguous, so group what the collectors return by name
+    families = {}
+    for collector in collectors:
+        for name, type_, help_, labels, value in collector():
+            families.setdefault(name, ['# HELP ' + name + ' ' + help_, '# TYPE ' + name + ' ' + type_])
+            families[name].append(name + format_labels(labels) + ' ' + repr(value))
+    for family in families.values():
+        lines.extend(family)
+    return '\n'.join(lines) + '\n'
+
+
+describe('anvil_indy_call_seconds', 'histogram', 'Duration of Indy calls by module and function.', ('module', 'call'))
+describe('anvil_indy_errors_total', 'counter', 'Indy calls that raised, by module, function and error code.', ('module', 'call', 'code'))
+describe('anvil_ledger_seconds', 'histogram', 'Duration of ledger requests by operation (submit or read) and request type.', ('operation', 'type'))
+describe('anvil_ledger_errors_total', 'counter', 'Ledger requests that raised, by operation, request type and error code.', ('operation', 'type', 'code'))
+
+
+# Ledger transaction type codes, as in the request's operation.type
+LEDGER_TYPES = {'1': 'NYM', '101': 'SCHEMA', '102': 'CRED_DEF', '105': 'GET_NYM', '107': 'GET_SCHEMA', '108': 'GET_CRED_DEF',
+                '113': 'REVOC_REG_DEF', '114': 'REVOC_REG_ENTRY', '115': 'GET_REVOC_REG_DEF', '116': 'GET_REVOC_REG',
+                '117': 'GET_REVOC_REG_DELTA'}
+LEDGER_CALLS = {'sign_and_submit_request': 'submit', 'submit_request': 'read'}
+# Decryption is traced by the callers once they know which trace the message belongs to
+UNTRACED_CALLS = ('auth_decrypt', 'anon_decrypt')
+
+
+def ledger_request_type(request_json):
+    try:
+        value = str(json.loads(request_json)['operation']['type'])
+    except (ValueError, KeyError, TypeError):
+        return 'unknown'
+    return LEDGER_TYPES.get(value, value)
+
+
+# Wraps an Indy coroutine function so each call is timed, traced and its errors counted by error code name.
+def instrument(module, call, function):
+    async def instrumented(*args, **kwargs):
+        started = time.perf_counter()
+        code = None
+        try:
+            if call in UNTRACED_CALLS:
+                return await function(*args, **kwargs)
+            with span(module + '.' + call):
+                return await function(*args, **kwargs)
+        except Exception as ex:
+            code = getattr(getattr(ex, 'error_code', None), 'name', None) or type(ex).__name__
+            inc('anvil_indy_errors_total', module, call, code)
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            observe('anvil_indy_call_seconds', seconds, module, call)
+            if call in LEDGER_CALLS:
+                request_type = ledger_request_type(args[-1])
+                observe('anvil_ledger_seconds', seconds, LEDGER_CALLS[call], request_type)
+                if code:
+                    inc('anvil_ledger_errors_total', LEDGER_CALLS[call], request_type, code)
+    return instrumented
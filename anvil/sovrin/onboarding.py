@@ -1,7 +1,7 @@
 '''
 Sovrin onboarding functions:
 
-1. *Demo* onboard taking the anchor and onboardee as arguments.
+1. *Demo* onboard taking the anchor and onboardee as arguments, and the demo onboardings as a dependency graph.
 2. Onboarding 1: Anchor sends connection request.
 3. Onboarding 2: Onboardee sends connection response.
 4. Onboarding 3: Anchor recieves connection response, establishing a secure channel.
@@ -19,9 +19,18 @@ Basic steps for establishing a pairwise connection:
 '''
 
 
-import json, random
-from indy import ledger, wallet, did, crypto
-from indy.error import IndyError, ErrorCode
+import json, random, time
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.backend import ledger, wallet, did, crypto
+    from sovrin.tracing import traced, inject, extract, record
+    from sovrin.events import log
+    from sovrin.utilities import run_graph
+except ImportError:
+    from backend import ledger, wallet, did, crypto
+    from tracing import traced, inject, extract, record
+    from events import log
+    from utilities import run_graph
 
 
 '''
@@ -42,8 +51,9 @@ async def demo_onboard(anchor, onboardee):
 
 
 # Onboarding 1: Anchor sends connection request.
+@traced('onboarding_anchor_send', starts = True)
 async def onboarding_anchor_send(_from, unique_onboardee_name):
-    print(_from['name'].capitalize() + ' sending connection request to ' + unique_onboardee_name + '...')
+    log('onboarding_anchor_send', _from['name'].capitalize() + ' sending connection request to ' + unique_onboardee_name + '...', actor = _from['name'])
     (from_to_did, from_to_key) = await did.create_and_store_my_did(_from['wallet'], "{}")
     _from[unique_onboardee_name + '_did'] = from_to_did
     _from[unique_onboardee_name + '_key'] = from_to_key
@@ -54,13 +64,15 @@ async def onboarding_anchor_send(_from, unique_onboardee_name):
         'did': from_to_did,
         'nonce': nonce
     }
-    return _from, _from['connection_request']
+    return _from, inject(_from['connection_request'])
 
 
 # Onboarding 2: Onboardee sends connection response.
+@traced('onboarding_onboardee_reply')
 async def onboarding_onboardee_reply(to, connection_request, from_pool):
+    connection_request, _ = extract(dict(connection_request))
     to['unique_anchor_name'] = connection_request['name']
-    print(to['name'].capitalize() + ' sending connection response to ' + to['unique_anchor_name'] + '...')
+    log('onboarding_onboardee_reply', to['name'].capitalize() + ' sending connection response to ' + to['unique_anchor_name'] + '...', actor = to['name'])
     (to_from_did, to_from_key) = await did.create_and_store_my_did(to['wallet'], "{}")
     to[to['unique_anchor_name'] + '_did'] = to_from_did
     to[to['unique_anchor_name'] + '_key'] = to_from_key
@@ -71,25 +83,29 @@ async def onboarding_onboardee_reply(to, connection_request, from_pool):
         'nonce': connection_request['nonce']
     })
     to['anoncrypted_connection_response'] = \
-        await crypto.anon_crypt(to['from_to_verkey'], to['connection_response'].encode('utf-8'))
+        await crypto.anon_crypt(to['from_to_verkey'], inject(to['connection_response']).encode('utf-8'))
     return to, to['anoncrypted_connection_response'] # latter to be sent to the _from agent
 
 
 # Onboarding 3: Anchor recieves connection response, establishing a secure channel.
+@traced('onboarding_anchor_receive')
 async def onboarding_anchor_receive(_from, anoncrypted_connection_reponse, unique_onboardee_name):
-    print(_from['name'].capitalize() + ' establishing a secure channel with ' + unique_onboardee_name + '...')
+    log('onboarding_anchor_receive', _from['name'].capitalize() + ' establishing a secure channel with ' + unique_onboardee_name + '...', actor = _from['name'])
     _from['anoncrypted_connection_response'] = anoncrypted_connection_reponse
-    _from['connection_response'] = \
-        json.loads((await crypto.anon_decrypt(_from['wallet'], _from[unique_onboardee_name + '_key'],
-                                              _from['anoncrypted_connection_response'])).decode("utf-8"))
+    started = time.time_ns()
+    _from['connection_response'], _ = \
+        extract(json.loads((await crypto.anon_decrypt(_from['wallet'], _from[unique_onboardee_name + '_key'],
+                                                      _from['anoncrypted_connection_response'])).decode("utf-8")))
+    record('decrypt', started)
     assert _from['connection_request']['nonce'] == _from['connection_response']['nonce']
     await send_nym(_from['pool'], _from['wallet'], _from['did'], _from['connection_response']['did'], _from['connection_response']['verkey'], None)
     return _from
 
 
 # Onboarding 4: Onboardee creates their DID and sends it to the Anchor.
+@traced('onboarding_onboardee_create_did')
 async def onboarding_onboardee_create_did(to):
-    print(to['name'].capitalize() + ' getting their DID...')
+    log('onboarding_onboardee_create_did', to['name'].capitalize() + ' getting their DID...', actor = to['name'])
     (to_did, to_key) = await did.create_and_store_my_did(to['wallet'], "{}")
     to['did'] = to_did
     to['did_info'] = json.dumps({
@@ -97,13 +113,14 @@ async def onboarding_onboardee_create_did(to):
         'verkey': to_key
     })
     to['authcrypted_did_info'] = \
-        await crypto.auth_crypt(to['wallet'], to[to['unique_anchor_name'] + '_key'], to['from_to_verkey'], to['did_info'].encode('utf-8'))
+        await crypto.auth_crypt(to['wallet'], to[to['unique_anchor_name'] + '_key'], to['from_to_verkey'], inject(to['did_info']).encode('utf-8'))
     return to, to['authcrypted_did_info']
 
 
 # Onboarding 5: Anchor registers the Onboardee as a new trust anchor on the ledger.
+@traced('onboarding_anchor_register_onboardee_did')
 async def onboarding_anchor_register_onboardee_did(_from, unique_onboardee_name, authcrypted_did_info):
-    print(_from['name'].capitalize() + ' registering ' + unique_onboardee_name + ' as a new trust anchor...')
+    log('onboarding_anchor_register_onboardee_did', _from['name'].capitalize() + ' registering ' + unique_onboardee_name + ' as a new trust anchor...', actor = _from['name'])
     sender_verkey, _, authdecrypted_did_info = \
         await auth_decrypt(_from['wallet'], _from[unique_onboardee_name + '_key'], authcrypted_did_info)
     assert sender_verkey == await did.key_for_did(_from['pool'], _from['wallet'], _from['connection_response']['did'])
@@ -118,16 +135,43 @@ async def send_nym(pool_handle, wallet_handle, _did, new_did, new_key, role):
 
 
 async def auth_decrypt(wallet_handle, key, message):
+    started = time.time_ns()
     from_verkey, decrypted_message_json = await crypto.auth_decrypt(wallet_handle, key, message)
     decrypted_message_json = decrypted_message_json.decode("utf-8")
     decrypted_message = json.loads(decrypted_message_json)
+    # Continue the sender's trace if the message carries one, and pass the message on without it
+    decrypted_message, carried_trace = extract(decrypted_message)
+    if carried_trace:
+        decrypted_message_json = json.dumps(decrypted_message)
+    record('decrypt', started)
     return from_verkey, decrypted_message_json, decrypted_message
     
 
-# This function establishes secure channels between all actors for same-file demoes.
+# This function establishes secure channels between all actors for same-file demoes, see onboarding_steps().
 async def establish_channels_demo(steward, issuer, prover, verifier):
-    steward, issuer = await demo_onboard(steward, issuer)
-    steward, verifier = await demo_onboard(steward, verifier)
-    issuer, prover = await demo_onboard(issuer, prover)
-    verifier, prover = await demo_onboard(verifier, prover)
+    actors = {'steward': steward, 'issuer': issuer, 'prover': prover, 'verifier': verifier}
+    await run_graph(onboarding_steps(actors), 'establish_channels_demo')
     return steward, issuer, prover, verifier
+
+
+'''
+The demo onboardings as steps for run_graph(), on the actors by name, looked up when each step runs.
+An anchor keeps one connection in progress and an onboardee one Verinym request, so:
+1. The steward onboards the issuer, then the verifier.
+2. The issuer onboards the prover once it has its Verinym, alongside the steward and the verifier.
+3. The verifier onboards the prover once both are done.
+With setup, each onboarding also waits for steps named after its two actors, e.g. those setting them up.
+'''
+def onboarding_steps(actors, setup = False):
+    def waits(*names):
+        return list(names) if setup else []
+
+    def onboard(anchor, onboardee):
+        return lambda: demo_onboard(actors[anchor], actors[onboardee])
+
+    return {
+        'steward_issuer': (waits('steward', 'issuer'), onboard('steward', 'issuer')),
+        'steward_verifier': (waits('verifier') + ['steward_issuer'], onboard('steward', 'verifier')),
+        'issuer_prover': (waits('prover') + ['steward_issuer'], onboard('issuer', 'prover')),
+        'verifier_prover': (['steward_verifier', 'issuer_prover'], onboard('verifier', 'prover'))
+    }
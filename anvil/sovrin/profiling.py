@@ -0,0 +1,193 @@
+'''
+On-demand profiling of app routes and Sovrin steps, for a bounded window:
+
+1. sample: a background thread samples the event loop thread's stack every few milliseconds and counts
+   the stacks by the route or step running, written as collapsed stacks (one 'frame;frame;frame count' line each)
+   for flamegraph.pl or speedscope.
+2. cprofile: each profiled route or step runs under cProfile, written as a pstats file per call.
+   Other coroutines running while it awaits are included.
+
+Start with the ANVIL_PROFILE environment variable, a comma-separated list of routes and steps (or *),
+e.g. ANVIL_PROFILE=/verify,/send_credential,verify_proof, or with start() (the apps' /profile/start route).
+ANVIL_PROFILE_MODE, ANVIL_PROFILE_SECONDS and ANVIL_PROFILE_DIR set the mode (default sample),
+window (default 60) and output folder (default profiles). Nothing is measured when off.
+'''
+
+import atexit, cProfile, functools, os, re, sys, threading, time
+
+
+MODES = ('sample', 'cprofile')
+SAMPLE_SECONDS = 0.005
+
+settings = {
+    'names': set(),
+    'mode': 'sample',
+    'until': 0,
+    'dir': os.getenv('ANVIL_PROFILE_DIR', 'profiles')
+}
+state = {'sampler': None, 'profiling': False, 'active': [], 'stacks': {}, 'written': []}
+lock = threading.Lock()
+
+
+'''
+Profiles the given routes and steps ('*' for all) for `seconds`, replacing any window already open.
+Returns the status().
+'''
+def start(names, mode = 'sample', seconds = 60, directory = None):
+    if mode not in MODES:
+        raise ValueError('Unknown profiling mode ' + mode + ', choose one of ' + ', '.join(MODES) + '.')
+    stop()
+    state['written'] = []
+    settings['names'] = set(name.strip() for name in names if name.strip())
+    settings['mode'] = mode
+    settings['until'] = time.monotonic() + float(seconds)
+    if directory:
+        settings['dir'] = directory
+    os.makedirs(settings['dir'], exist_ok = True)
+    if mode == 'sample' and settings['names']:
+        state['sampler'] = Sampler(threading.get_ident())
+        state['sampler'].start()
+    return status()
+
+
+# Closes the window and writes the sampled stacks. Returns the files written in the last window.
+def stop():
+    settings['names'] = set()
+    sampler, state['sampler'] = state['sampler'], None
+    if sampler is not None:
+        sampler.stopped.set()
+        if sampler is not threading.current_thread():
+            sampler.join()
+    write_stacks()
+    return list(state['written'])
+
+
+def status():
+    return {
+        'names': sorted(settings['names']),
+        'mode': settings['mode'],
+        'seconds_left': max(0, round(settings['until'] - time.monotonic(), 1)) if settings['names'] else 0,
+        'dir': settings['dir'],
+        'written': list(state['written'])
+    }
+
+
+def selected(name):
+    if not settings['names']:
+        return False
+    if time.monotonic() > settings['until']:
+        stop()
+        return False
+    return name in settings['names'] or '*' in settings['names']
+
+
+def file_name(name, extension):
+    return os.path.join(settings['dir'], (re.sub('[^A-Za-z0-9_.-]+', '_', name).strip('_') or 'root') + extension)
+
+
+class Profile:
+
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        state['active'].append(self.name)
+        # cProfile can only run once per thread, so a step inside a profiled route is part of its profile
+        if settings['mode'] == 'cprofile' and not state['profiling']:
+            state['profiling'] = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            self.profiler.disable()
+            state['profiling'] = False
+            path = file_name(self.name, '-' + str(time.time_ns()) + '.pstats')
+            self.profiler.dump_stats(path)
+            state['written'].append(path)
+        if self.name in state['active']:
+            state['active'].remove(self.name)
+        return False
+
+
+class NoProfile:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NO_PROFILE = NoProfile()
+
+
+# Profiles a route or step if it is selected. Use as a context manager.
+def profile(name):
+    return Profile(name) if selected(name) else NO_PROFILE
+
+
+# Decorator for Sovrin steps, e.g. @profiled('verify_proof').
+def profiled(name):
+    def decorate(function):
+        @functools.wraps(function)
+        async def step(*args, **kwargs):
+            if not settings['names']:
+                return await function(*args, **kwargs)
+            with profile(name):
+                return await function(*args, **kwargs)
+        return step
+    return decorate
+
+
+class Sampler(threading.Thread):
+
+    def __init__(self, thread_id):
+        super().__init__(name = 'anvil-profiler', daemon = True)
+        self.thread_id = thread_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_SECONDS):
+            if time.monotonic() > settings['until']:
+                stop()
+                break
+            active = state['active']
+            frame = sys._current_frames().get(self.thread_id)
+            if not active or frame is None:
+                continue
+            stack = collapse(frame)
+            with lock:
+                stacks = state['stacks'].setdefault(active[-1], {})
+                stacks[stack] = stacks.get(stack, 0) + 1
+
+
+# Stack from the outermost frame in, as 'file:function' separated by semicolons.
+def collapse(frame):
+    frames = []
+    while frame is not None:
+        frames.append(os.path.basename(frame.f_code.co_filename) + ':' + frame.f_code.co_name)
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+# Appends the sampled stacks to [dir]/[name].collapsed, one file per route or step.
+def write_stacks():
+    with lock:
+        sampled, state['stacks'] = state['stacks'], {}
+    for name, stacks in sampled.items():
+        path = file_name(name, '.collapsed')
+        with open(path, 'a') as file_:
+            for stack, count in sorted(stacks.items()):
+                file_.write(stack + ' ' + str(count) + '\n')
+        state['written'].append(path)
+
+
+# Stacks sampled in a window still open at exit are written too
+atexit.register(stop)
+
+if os.getenv('ANVIL_PROFILE'):
+    start(os.getenv('ANVIL_PROFILE').split(','), os.getenv('ANVIL_PROFILE_MODE', 'sample'),
+          os.getenv('ANVIL_PROFILE_SECONDS', 60))
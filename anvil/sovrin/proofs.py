@@ -4,23 +4,52 @@ Sovrin proofs functions:
 1. Request proof of a credential.
 2. Create proof of a credential.
 3. Verify a proof.
+4. Proof request templates: register once, then request with a fresh nonce.
 '''
 
-import json
-from indy import anoncreds, did, crypto, ledger
+import hashlib, json, os, secrets, time
+from collections import OrderedDict
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.backend import anoncreds, did, crypto, ledger
+    from sovrin.revocation import get_revocation_state, get_rev_reg_def, get_rev_reg
+    from sovrin.tracing import traced, inject, extract, record
+    from sovrin.profiling import profiled
+    from sovrin.events import log
+    from sovrin.encoding import check_revealed_encodings
+except ImportError:
+    from backend import anoncreds, did, crypto, ledger
+    from revocation import get_revocation_state, get_rev_reg_def, get_rev_reg
+    from tracing import traced, inject, extract, record
+    from profiling import profiled
+    from events import log
+    from encoding import check_revealed_encodings
 
 
+PREDICATE_TYPES = ('>=', '>', '<=', '<')
+# Set ANVIL_CHECK_ENCODINGS=0 to accept credentials issued with encodings of their own
+CHECK_ENCODINGS = os.getenv('ANVIL_CHECK_ENCODINGS', '1') != '0'
+# Templates registered from proof requests given in full, kept for the most recently used ANVIL_ADHOC_TEMPLATES (default 64)
+MAX_ADHOC = int(os.getenv('ANVIL_ADHOC_TEMPLATES', 64))
+proof_templates = {}
+adhoc_templates = OrderedDict()
+
+
+@traced('request_proof_of_credential', starts = True)
+@profiled('request_proof_of_credential')
 async def request_proof_of_credential(verifier, proof_request = {}):
-    print('Verifier requesting proof of credential...')
+    log('request_proof_of_credential', 'Verifier requesting proof of credential...', actor = verifier['name'])
     # Create proof request
     verifier['proof_request'] = proof_request
-    # Get key for prover DID
-    verifier['prover_key_for_verifier'] = \
-        await did.key_for_did(verifier['pool'], verifier['wallet'], verifier['connection_response']['did'])
+    # Get key for prover DID, only looked up again when the connection changes
+    prover_did = verifier['connection_response']['did']
+    if verifier.get('prover_did_for_verifier') != prover_did:
+        verifier['prover_key_for_verifier'] = await did.key_for_did(verifier['pool'], verifier['wallet'], prover_did)
+        verifier['prover_did_for_verifier'] = prover_did
     # Authenticate, encrypt and send
     verifier['authcrypted_proof_request'] = \
         await crypto.auth_crypt(verifier['wallet'], verifier['prover_key'], verifier['prover_key_for_verifier'],
-                                verifier['proof_request'].encode('utf-8'))
+                                inject(verifier['proof_request']).encode('utf-8'))
     return verifier, verifier['authcrypted_proof_request']
 
 
@@ -31,12 +60,14 @@ Requested attributes, predicates, and non-issuer attributes are provided as an a
 Non-issuer attributes refer to attributes in the proof request that the credential issuer does not have on file.
 Self-attested predicates aren't included since they are (presumably) not helpful.
 '''
+@traced('create_proof_of_credential')
+@profiled('create_proof_of_credential')
 async def create_proof_of_credential(prover, self_attested_attrs = {}, requested_attrs = [], requested_preds = [], non_issuer_attributes = []):
-    print('Prover getting credential and creating proof...')
+    log('create_proof_of_credential', 'Prover getting credential and creating proof...', actor = prover['name'])
     num_attributes_to_search = len(self_attested_attrs) + len(requested_attrs) - len(non_issuer_attributes) 
     num_predicates = len(requested_preds)
     # Decrypt
-    prover['verifier_key_for_prover'], prover['proof_request'], _ = \
+    prover['verifier_key_for_prover'], prover['proof_request'], proof_request = \
         await auth_decrypt(prover['wallet'], prover['verifier_key'], prover['authcrypted_proof_request'])
     # Search for a proof request and get the credential attributes needed
     search_for_proof_request = \
@@ -61,19 +92,21 @@ async def create_proof_of_credential(prover, self_attested_attrs = {}, requested
     for _, value in cred_predicates.items():
         creds_for_proof[value['referent']] = value
     prover['creds_for_proof'] = creds_for_proof
-    # Get attributes from ledger
-    prover['schemas'], prover['cred_defs'], prover['revoc_states'] = \
+    # Get attributes from ledger, with revocation states if the verifier asks for non-revocation
+    prover['schemas'], prover['cred_defs'], prover['revoc_states'], timestamps = \
         await prover_get_entities_from_ledger(prover['pool'], prover['verifier_did'],
-                                              prover['creds_for_proof'], prover['name'])
+                                              prover['creds_for_proof'], prover['name'], proof_request.get('non_revoked'))
     # Create the proof, specifiying what to reveal (NOTE: all verifiable whether revealed or not)
     requested_attrs_dict = {}
     for i in requested_attrs:
         stri = str(i)
-        requested_attrs_dict['attr' + stri + '_referent'] = {'cred_id': cred_attrs['cred_for_attr' + stri]['referent'], 'revealed': True}
+        requested_attrs_dict['attr' + stri + '_referent'] = \
+            requested_cred(cred_attrs['cred_for_attr' + stri]['referent'], timestamps, revealed = True)
     requested_predicates_dict = {}
     for i in requested_preds:
         stri = str(i)
-        requested_predicates_dict['predicate' + stri + '_referent'] = {'cred_id': cred_predicates['cred_for_predicate' + stri]['referent']}
+        requested_predicates_dict['predicate' + stri + '_referent'] = \
+            requested_cred(cred_predicates['cred_for_predicate' + stri]['referent'], timestamps)
     proof_request_reply_from_prover = json.dumps({
         'self_attested_attributes': self_attested_attrs,
         'requested_attributes': requested_attrs_dict,
@@ -87,33 +120,95 @@ async def create_proof_of_credential(prover, self_attested_attrs = {}, requested
     # Authenticate, encrypt and send
     prover['authcrypted_proof'] = \
         await crypto.auth_crypt(prover['wallet'], prover['verifier_key'], prover['verifier_key_for_prover'],
-                                prover['proof'].encode('utf-8'))
+                                inject(prover['proof']).encode('utf-8'))
     return prover, prover['authcrypted_proof']
 
-async def verify_proof(verifier, assertions_to_make):
-    print('Verifier getting proof and verifying credential...')
+'''
+Assertions to make can be given as JSON (see the API reference) or as a checker from compile_assertions(),
+e.g. the 'check' of a registered proof template.
+
+Verification is staged from cheapest to most expensive so bad proofs are rejected before any ledger or CL work:
+1. Decrypt.
+2. Structure and assertions on the revealed / self-attested values.
+3. Encodings: each revealed raw value must encode to the value proven (see encoding.py), unless check_encodings is False.
+4. Entity resolution (schemas and credential definitions from the ledger).
+5. Cryptographic check.
+Each stage's result and timing is recorded in verifier['verification_report'].
+A failing stage raises a ValueError, independently of interpreter flags such as -O.
+'''
+@traced('verify_proof')
+@profiled('verify_proof')
+async def verify_proof(verifier, assertions_to_make, check_encodings = CHECK_ENCODINGS):
+    log('verify_proof', 'Verifier getting proof and verifying credential...', actor = verifier['name'])
+    check = assertions_to_make if callable(assertions_to_make) else compile_assertions(assertions_to_make)
+    verifier['verification_report'] = report = []
     # Decrypt
-    _, verifier['proof'], decrypted_proof = \
-        await auth_decrypt(verifier['wallet'], verifier['prover_key'], verifier['authcrypted_proof'])
+    started = time.perf_counter()
+    try:
+        _, verifier['proof'], decrypted_proof = \
+            await auth_decrypt(verifier['wallet'], verifier['prover_key'], verifier['authcrypted_proof'])
+    except Exception as ex:
+        end_stage(report, 'decrypt', started, [repr(ex)])
+    end_stage(report, 'decrypt', started)
+    # Check everything is as claimed by the prover
+    started = time.perf_counter()
+    failures = check_proof_structure(verifier['proof_request'], decrypted_proof)
+    end_stage(report, 'assertions', started, failures or check(decrypted_proof))
+    # The crypto check binds the encoded values only, so the raw values revealed with them are checked here
+    if check_encodings:
+        started = time.perf_counter()
+        end_stage(report, 'encodings', started, check_revealed_encodings(decrypted_proof))
     # Get credential attribute values from ledger
+    started = time.perf_counter()
     verifier['schemas'], verifier['cred_defs'], verifier['revoc_ref_defs'], verifier['revoc_regs'] = \
         await verifier_get_entities_from_ledger(verifier['pool'], verifier['did'],
                                                 decrypted_proof['identifiers'], verifier['name'])
-    # Assert everything is as claimed by the prover and verify
-    for key, value in assertions_to_make['revealed'].items():
-        assert value == decrypted_proof['requested_proof']['revealed_attrs'][key]['raw']
-    for key, value in assertions_to_make['self_attested'].items():
-        assert value == decrypted_proof['requested_proof']['self_attested_attrs'][key]
-    assert await anoncreds.verifier_verify_proof(verifier['proof_request'], verifier['proof'],
-                                                 verifier['schemas'], verifier['cred_defs'], verifier['revoc_ref_defs'],
-                                                 verifier['revoc_regs'])
+    end_stage(report, 'entities', started)
+    # Verify
+    started = time.perf_counter()
+    valid = await anoncreds.verifier_verify_proof(verifier['proof_request'], verifier['proof'],
+                                                  verifier['schemas'], verifier['cred_defs'], verifier['revoc_ref_defs'],
+                                                  verifier['revoc_regs'])
+    end_stage(report, 'crypto', started, [] if valid else ['proof does not verify'])
     return verifier
 
 
+def end_stage(report, stage, started, failures = []):
+    report.append({
+        'stage': stage,
+        'ok': not failures,
+        'seconds': time.perf_counter() - started,
+        'failures': failures
+    })
+    if failures:
+        raise ValueError('Proof rejected at ' + stage + ' stage: ' + ', '.join(failures))
+
+
+# Returns what is missing from a decrypted proof for it to answer the proof request (string).
+def check_proof_structure(proof_request, decrypted_proof):
+    if not all(key in decrypted_proof for key in ('proof', 'requested_proof', 'identifiers')) or not decrypted_proof['identifiers']:
+        return ['proof, requested_proof and identifiers']
+    request = json.loads(proof_request)
+    requested_proof = decrypted_proof['requested_proof']
+    answered = set()
+    for kind in ('revealed_attrs', 'self_attested_attrs', 'unrevealed_attrs', 'predicates'):
+        answered.update(requested_proof.get(kind, {}))
+    requested = list(request.get('requested_attributes', {})) + list(request.get('requested_predicates', {}))
+    failures = [referent for referent in requested if referent not in answered]
+    failures += ['identifiers'] if any('schema_id' not in item or 'cred_def_id' not in item for item in decrypted_proof['identifiers']) else []
+    return failures
+
+
 async def auth_decrypt(wallet_handle, key, message):
+    started = time.time_ns()
     from_verkey, decrypted_message_json = await crypto.auth_decrypt(wallet_handle, key, message)
     decrypted_message_json = decrypted_message_json.decode("utf-8")
     decrypted_message = json.loads(decrypted_message_json)
+    # Continue the sender's trace if the message carries one, and pass the message on without it
+    decrypted_message, carried_trace = extract(decrypted_message)
+    if carried_trace:
+        decrypted_message_json = json.dumps(decrypted_message)
+    record('decrypt', started)
     return from_verkey, decrypted_message_json, decrypted_message
 
 
@@ -123,18 +218,30 @@ async def get_credential_for_referent(search_handle, referent):
     return credentials[0]['cred_info']
 
 
-async def prover_get_entities_from_ledger(pool_handle, _did, identifiers, actor):
+def requested_cred(cred_id, timestamps, **fields):
+    fields['cred_id'] = cred_id
+    if cred_id in timestamps:
+        fields['timestamp'] = timestamps[cred_id]
+    return fields
+
+
+# Also returns the revocation state timestamp for each revocable credential (by credential ID).
+async def prover_get_entities_from_ledger(pool_handle, _did, identifiers, actor, non_revoked = None):
     schemas = {}
     cred_defs = {}
     rev_states = {}
+    timestamps = {}
     for item in identifiers.values():
         (received_schema_id, received_schema) = await get_schema(pool_handle, _did, item['schema_id'])
         schemas[received_schema_id] = json.loads(received_schema)
         (received_cred_def_id, received_cred_def) = await get_cred_def(pool_handle, _did, item['cred_def_id'])
         cred_defs[received_cred_def_id] = json.loads(received_cred_def)
-        if 'rev_reg_seq_no' in item:
-            pass # Revocation states not yet implemented in Sovrin's Python wrapper
-    return json.dumps(schemas), json.dumps(cred_defs), json.dumps(rev_states)
+        if non_revoked and item.get('rev_reg_id'):
+            rev_state, timestamp = await get_revocation_state(pool_handle, _did, item['rev_reg_id'], item['cred_rev_id'],
+                                                              non_revoked.get('to'))
+            rev_states.setdefault(item['rev_reg_id'], {})[timestamp] = json.loads(rev_state)
+            timestamps[item['referent']] = timestamp
+    return json.dumps(schemas), json.dumps(cred_defs), json.dumps(rev_states), timestamps
 
 
 async def get_schema(pool_handle, _did, schema_id):
@@ -159,6 +266,116 @@ async def verifier_get_entities_from_ledger(pool_handle, _did, identifiers, acto
         schemas[received_schema_id] = json.loads(received_schema)
         (received_cred_def_id, received_cred_def) = await get_cred_def(pool_handle, _did, item['cred_def_id'])
         cred_defs[received_cred_def_id] = json.loads(received_cred_def)
-        if 'rev_reg_seq_no' in item:
-            pass # Revocation states not yet implemented in Sovrin's Python wrapper
+        if item.get('rev_reg_id') and item.get('timestamp'):
+            rev_reg_defs[item['rev_reg_id']] = json.loads(await get_rev_reg_def(pool_handle, _did, item['rev_reg_id']))
+            rev_regs.setdefault(item['rev_reg_id'], {})[item['timestamp']] = \
+                json.loads(await get_rev_reg(pool_handle, _did, item['rev_reg_id'], item['timestamp']))
     return json.dumps(schemas), json.dumps(cred_defs), json.dumps(rev_reg_defs), json.dumps(rev_regs)
+
+
+'''
+Registers a named proof request template in the format of example_data/*/proof_request.json,
+i.e. {"request": {...}, "assertions_to_make": {...}}.
+The request is validated and serialized once, with a unique sentinel where each request's nonce goes.
+If the request has a non_revoked entry, each request asks for non-revocation up to the time it is made.
+'''
+def register_proof_template(name, proof_request):
+    validate_proof_request(proof_request)
+    token = secrets.token_hex(16)
+    # Slot: sentinel, each replaced by a value of its own when the request is made
+    sentinels = {'nonce': 'anvil_nonce_' + token}
+    if 'non_revoked' in proof_request['request']:
+        sentinels['non_revoked'] = 'anvil_non_revoked_' + token
+    serialized = json.dumps(dict(proof_request['request'], **sentinels))
+    slots, parts = [], []
+    for slot, sentinel in sorted(sentinels.items(), key = lambda item: serialized.index('"' + item[1] + '"')):
+        if serialized.count('"' + sentinel + '"') != 1:
+            raise ValueError('Proof request ' + name + ' cannot be made into a template.')
+        part, serialized = serialized.split('"' + sentinel + '"', 1)
+        slots.append(slot)
+        parts.append(part)
+    proof_templates[name] = {
+        'name': name,
+        'parts': parts + [serialized],
+        'slots': slots,
+        'assertions': proof_request['assertions_to_make'],
+        'check': compile_assertions(proof_request['assertions_to_make'])
+    }
+    return proof_templates[name]
+
+
+# Registers every [name]/proof_request.json under a path such as example_data, keyed by folder name.
+def load_proof_templates(path):
+    for name in sorted(os.listdir(path)):
+        filename = os.path.join(path, name, 'proof_request.json')
+        if name not in proof_templates and os.path.isfile(filename):
+            with open(filename) as file_:
+                register_proof_template(name, json.load(file_))
+    return proof_templates
+
+
+'''
+Registers a proof request given in full, as its JSON string, under its SHA-256 digest and returns the name.
+Only the MAX_ADHOC most recently used are kept, so requests pasted by users cannot grow the templates without limit.
+'''
+def register_adhoc_template(proof_request_json):
+    name = hashlib.sha256(proof_request_json.encode('utf-8')).hexdigest()
+    if name not in proof_templates:
+        register_proof_template(name, json.loads(proof_request_json))
+    adhoc_templates[name] = True
+    adhoc_templates.move_to_end(name)
+    while len(adhoc_templates) > MAX_ADHOC:
+        proof_templates.pop(adhoc_templates.popitem(last = False)[0], None)
+    return name
+
+
+# Returns a proof request string ready for request_proof_of_credential(), only the nonce is new.
+def instantiate_proof_request(name, nonce = None):
+    template = proof_templates[name]
+    if nonce is None:
+        nonce = ''.join(secrets.choice('0123456789') for i in range(25))
+    values = {'nonce': '"' + nonce + '"', 'non_revoked': '{"to": ' + str(int(time.time())) + '}'}
+    return ''.join(part + values[slot] for part, slot in zip(template['parts'], template['slots'])) + template['parts'][-1]
+
+
+async def request_proof_from_template(verifier, name):
+    verifier['proof_template'] = name
+    verifier['assertions_to_make'] = proof_templates[name]['assertions']
+    return await request_proof_of_credential(verifier, instantiate_proof_request(name))
+
+
+def validate_proof_request(proof_request):
+    request = proof_request['request']
+    for field in ('name', 'version'):
+        if not isinstance(request.get(field), str):
+            raise ValueError('Proof request ' + field + ' must be a string.')
+    attributes = request.get('requested_attributes', {})
+    predicates = request.get('requested_predicates', {})
+    for referent, attribute in attributes.items():
+        if 'name' not in attribute:
+            raise ValueError('Requested attribute ' + referent + ' has no name.')
+    for referent, predicate in predicates.items():
+        if 'name' not in predicate or predicate.get('p_type') not in PREDICATE_TYPES or not isinstance(predicate.get('p_value'), int):
+            raise ValueError('Requested predicate ' + referent + ' needs a name, a p_type in ' + str(PREDICATE_TYPES) + ' and an integer p_value.')
+    assertions = proof_request['assertions_to_make']
+    for kind in ('revealed', 'self_attested'):
+        for referent in assertions.get(kind, {}):
+            if referent not in attributes:
+                raise ValueError('Assertion on ' + referent + ' which is not a requested attribute.')
+
+
+'''
+Compiles assertions to make into a checker taking a decrypted proof.
+The checker returns the referents whose values do not match, so an empty list means all assertions hold.
+'''
+def compile_assertions(assertions_to_make):
+    revealed = tuple(assertions_to_make.get('revealed', {}).items())
+    self_attested = tuple(assertions_to_make.get('self_attested', {}).items())
+    def check(decrypted_proof):
+        requested_proof = decrypted_proof['requested_proof']
+        revealed_attrs = requested_proof.get('revealed_attrs', {})
+        self_attested_attrs = requested_proof.get('self_attested_attrs', {})
+        failed = [key for key, value in revealed if key not in revealed_attrs or revealed_attrs[key]['raw'] != value]
+        failed += [key for key, value in self_attested if self_attested_attrs.get(key) != value]
+        return failed
+    return check
@@ -0,0 +1,120 @@
+'''
+Sovrin exchange artefact retention:
+
+1. Set up a retention policy (limits by artefact count and bytes).
+2. Retire the artefacts of a completed exchange from an actor data structure.
+3. Fetch a retired exchange, from RAM or from the compressed on-disk spill.
+
+Hot state (wallet, pool, DIDs, keys, credential definitions) is never retired.
+Retired exchanges are kept in RAM until a limit is hit, after which the oldest
+are spilled to gzipped JSON for audit (or dropped if no spill directory is set).
+'''
+
+import json, gzip, os, time, base64
+from collections import OrderedDict
+
+
+# Artefacts left behind by a completed exchange. '{schema}' is the actor's current unique schema name.
+ISSUER_ARTEFACTS = ['authcrypted_cred_offer', 'authcrypted_cred_request', 'authcrypted_cred', 'prover_cred_values',
+                    '{schema}_cred_offer', '{schema}_cred_request', '{schema}_cred']
+PROVER_CREDENTIAL_ARTEFACTS = ['authcrypted_cred_offer', 'authcrypted_cred_request', 'authcrypted_cred',
+                               '{schema}_cred_values', '{schema}_cred_request', '{schema}_cred']
+PROVER_PROOF_ARTEFACTS = ['authcrypted_proof_request', 'proof_request', 'creds_for_proof', 'requested_creds',
+                          'schemas', 'cred_defs', 'revoc_states', 'proof', 'authcrypted_proof']
+VERIFIER_ARTEFACTS = ['authcrypted_proof_request', 'authcrypted_proof', 'proof', 'schemas', 'cred_defs',
+                      'revoc_ref_defs', 'revoc_regs']
+
+
+def setup_retention(max_count = 64, max_bytes = 8 * 1024 * 1024, spill_dir = None):
+    return {
+        'max_count': max_count,
+        'max_bytes': max_bytes,
+        'spill_dir': spill_dir,
+        'exchanges': OrderedDict(), # exchange id -> (artefacts, size in bytes), oldest first
+        'bytes': 0,
+        'retired': 0,
+        'spilled': 0,
+        'evicted': 0
+    }
+
+
+# Policy from ANVIL_RETAIN_COUNT, ANVIL_RETAIN_BYTES and ANVIL_SPILL_DIR (spill disabled if unset).
+def retention_from_env():
+    return setup_retention(int(os.getenv('ANVIL_RETAIN_COUNT', 64)),
+                           int(os.getenv('ANVIL_RETAIN_BYTES', 8 * 1024 * 1024)),
+                           os.getenv('ANVIL_SPILL_DIR'))
+
+
+'''
+Moves the given artefacts out of the actor data structure into the retention store.
+Missing keys are skipped, so the same list can be used whatever stage the exchange reached.
+'''
+def retire_artefacts(retention, actor, keys, exchange = None):
+    schema = actor.get('unique_schema_name', '')
+    artefacts = {}
+    for key in keys:
+        key = key.format(schema = schema)
+        if key in actor:
+            artefacts[key] = actor.pop(key)
+    if not artefacts:
+        return retention, actor
+    retention['retired'] += 1
+    if exchange is None:
+        exchange = actor['name'] + '_' + str(int(time.time() * 1000)) + '_' + str(retention['retired'])
+    size = sum(artefact_size(value) for value in artefacts.values())
+    retention['exchanges'][exchange] = (artefacts, size)
+    retention['bytes'] += size
+    enforce_limits(retention)
+    return retention, actor
+
+
+def get_retired_exchange(retention, exchange):
+    if exchange in retention['exchanges']:
+        return retention['exchanges'][exchange][0]
+    if retention['spill_dir']:
+        path = spill_path(retention, exchange)
+        if os.path.isfile(path):
+            with gzip.open(path, 'rt') as file_:
+                return json.load(file_, object_hook = decode_bytes)
+    return None
+
+
+def enforce_limits(retention):
+    exchanges = retention['exchanges']
+    while exchanges and (len(exchanges) > retention['max_count'] or retention['bytes'] > retention['max_bytes']):
+        exchange, (artefacts, size) = exchanges.popitem(last = False)
+        retention['bytes'] -= size
+        if retention['spill_dir']:
+            spill(retention, exchange, artefacts)
+            retention['spilled'] += 1
+        else:
+            retention['evicted'] += 1
+
+
+def spill(retention, exchange, artefacts):
+    os.makedirs(retention['spill_dir'], exist_ok = True)
+    with gzip.open(spill_path(retention, exchange), 'wt') as file_:
+        json.dump(artefacts, file_, default = encode_bytes)
+
+
+def spill_path(retention, exchange):
+    return os.path.join(retention['spill_dir'], exchange + '.json.gz')
+
+
+def artefact_size(value):
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return len(json.dumps(value, default = str))
+
+
+# Authcrypted artefacts are bytes, which JSON cannot hold directly.
+def encode_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def decode_bytes(obj):
+    if '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
@@ -0,0 +1,192 @@
+'''
+Sovrin revocation functions:
+
+1. Create a revocation registry for a credential definition (issuer).
+2. Revoke a credential (issuer).
+3. Get registry deltas, cached and updated incrementally by timestamp.
+4. Create or update a revocation state for a stored credential (prover).
+5. Tails files: stored in ANVIL_TAILS_DIR and read through memory mapping.
+'''
+
+import hashlib, json, os, time, mmap
+from pathlib import Path
+from tempfile import gettempdir
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.backend import anoncreds, blob_storage, ledger
+    from sovrin.events import log
+except ImportError:
+    from backend import anoncreds, blob_storage, ledger
+    from events import log
+
+
+TAILS_DIR = os.getenv('ANVIL_TAILS_DIR', str(Path(gettempdir()).joinpath('indy', 'tails')))
+TAILS_CONFIG = json.dumps({'base_dir': TAILS_DIR, 'uri_pattern': ''})
+BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+# Deltas fetched within this many seconds are reused without asking the ledger again.
+REFRESH_SECONDS = float(os.getenv('ANVIL_REVOCATION_REFRESH', 5))
+
+# Ledger reads shared by every actor in the process.
+revocation_cache = {
+    'rev_reg_defs': {}, # rev_reg_id -> rev_reg_def_json
+    'rev_regs': {},     # (rev_reg_id, timestamp) -> rev_reg_json
+    'deltas': {},       # rev_reg_id -> {'delta': json, 'timestamp': ledger timestamp, 'fetched': local time}
+    'states': {},       # (rev_reg_id, cred_rev_id) -> (rev_state_json, timestamp)
+    'hits': 0,
+    'misses': 0
+}
+tails_handles = {}
+
+
+async def create_revocation_registry(issuer, unique_schema_name, max_cred_num = 100):
+    log('create_revocation_registry', issuer['name'].capitalize() + ' creating revocation registry...', actor = issuer['name'])
+    tails_writer = await blob_storage.open_writer('default', TAILS_CONFIG)
+    (issuer[unique_schema_name + '_rev_reg_id'], issuer[unique_schema_name + '_rev_reg_def'], rev_reg_entry) = \
+        await anoncreds.issuer_create_and_store_revoc_reg(issuer['wallet'], issuer['did'], None, 'TAG1',
+                                                          issuer[unique_schema_name + '_cred_def_id'],
+                                                          json.dumps({'max_cred_num': max_cred_num, 'issuance_type': 'ISSUANCE_ON_DEMAND'}),
+                                                          tails_writer)
+    # Send definition and initial accumulator to ledger
+    rev_reg_def_request = await ledger.build_revoc_reg_def_request(issuer['did'], issuer[unique_schema_name + '_rev_reg_def'])
+    await ledger.sign_and_submit_request(issuer['pool'], issuer['wallet'], issuer['did'], rev_reg_def_request)
+    await send_rev_reg_entry(issuer, issuer[unique_schema_name + '_rev_reg_id'], rev_reg_entry)
+    return issuer
+
+
+async def revoke_credential(issuer, unique_schema_name, cred_rev_id):
+    log('revoke_credential', issuer['name'].capitalize() + ' revoking credential...', actor = issuer['name'], cred_rev_id = cred_rev_id)
+    rev_reg_delta = await anoncreds.issuer_revoke_credential(issuer['wallet'], await tails_reader(),
+                                                             issuer[unique_schema_name + '_rev_reg_id'], cred_rev_id)
+    await send_rev_reg_entry(issuer, issuer[unique_schema_name + '_rev_reg_id'], rev_reg_delta)
+    return issuer
+
+
+async def send_rev_reg_entry(issuer, rev_reg_id, rev_reg_delta):
+    rev_reg_entry_request = await ledger.build_revoc_reg_entry_request(issuer['did'], rev_reg_id, 'CL_ACCUM', rev_reg_delta)
+    await ledger.sign_and_submit_request(issuer['pool'], issuer['wallet'], issuer['did'], rev_reg_entry_request)
+
+
+async def get_rev_reg_def(pool_handle, _did, rev_reg_id):
+    rev_reg_defs = revocation_cache['rev_reg_defs']
+    if rev_reg_id in rev_reg_defs:
+        revocation_cache['hits'] += 1
+    else:
+        revocation_cache['misses'] += 1
+        get_rev_reg_def_request = await ledger.build_get_revoc_reg_def_request(_did, rev_reg_id)
+        get_rev_reg_def_response = await ledger.submit_request(pool_handle, get_rev_reg_def_request)
+        _, rev_reg_defs[rev_reg_id] = await ledger.parse_get_revoc_reg_def_response(get_rev_reg_def_response)
+    return rev_reg_defs[rev_reg_id]
+
+
+# Registry value at a given timestamp, as used by the verifier. These never change so are cached for good.
+async def get_rev_reg(pool_handle, _did, rev_reg_id, timestamp):
+    rev_regs = revocation_cache['rev_regs']
+    if (rev_reg_id, timestamp) in rev_regs:
+        revocation_cache['hits'] += 1
+    else:
+        revocation_cache['misses'] += 1
+        get_rev_reg_request = await ledger.build_get_revoc_reg_request(_did, rev_reg_id, timestamp)
+        get_rev_reg_response = await ledger.submit_request(pool_handle, get_rev_reg_request)
+        _, rev_regs[(rev_reg_id, timestamp)], _ = await ledger.parse_get_revoc_reg_response(get_rev_reg_response)
+    return rev_regs[(rev_reg_id, timestamp)]
+
+
+'''
+Returns the registry delta from issuance up to `to` (default now) and its ledger timestamp.
+The first call fetches the full delta. Later calls only fetch what changed since the cached timestamp
+and merge it in, or reuse the cache if it was refreshed within REFRESH_SECONDS.
+'''
+async def get_rev_reg_delta(pool_handle, _did, rev_reg_id, to = None):
+    to = int(time.time()) if to is None else to
+    cached = revocation_cache['deltas'].get(rev_reg_id)
+    if cached and cached['timestamp'] > to:
+        cached = None # Asking about the past, fetch in full without touching the cache
+    elif cached and time.time() - cached['fetched'] < REFRESH_SECONDS:
+        revocation_cache['hits'] += 1
+        return cached['delta'], cached['timestamp']
+    revocation_cache['misses'] += 1
+    from_ = cached['timestamp'] if cached else None
+    get_delta_request = await ledger.build_get_revoc_reg_delta_request(_did, rev_reg_id, from_, to)
+    get_delta_response = await ledger.submit_request(pool_handle, get_delta_request)
+    _, delta, timestamp = await ledger.parse_get_revoc_reg_delta_response(get_delta_response)
+    if cached:
+        delta = await anoncreds.issuer_merge_revocation_registry_deltas(cached['delta'], delta)
+    latest = revocation_cache['deltas'].get(rev_reg_id)
+    if not latest or latest['timestamp'] <= timestamp:
+        revocation_cache['deltas'][rev_reg_id] = {'delta': delta, 'timestamp': timestamp, 'fetched': time.time()}
+    return delta, timestamp
+
+
+# Revocation state for a credential, updated from the cached delta rather than rebuilt.
+async def get_revocation_state(pool_handle, _did, rev_reg_id, cred_rev_id, to = None):
+    rev_reg_def = await get_rev_reg_def(pool_handle, _did, rev_reg_id)
+    delta, timestamp = await get_rev_reg_delta(pool_handle, _did, rev_reg_id, to)
+    key = (rev_reg_id, cred_rev_id)
+    cached = revocation_cache['states'].get(key)
+    if cached and cached[1] == timestamp:
+        return cached
+    reader = await tails_reader()
+    if cached:
+        rev_state = await anoncreds.update_revocation_state(reader, cached[0], rev_reg_def, delta, timestamp, cred_rev_id)
+    else:
+        rev_state = await anoncreds.create_revocation_state(reader, rev_reg_def, delta, timestamp, cred_rev_id)
+    revocation_cache['states'][key] = (rev_state, timestamp)
+    return rev_state, timestamp
+
+
+async def tails_reader():
+    if 'reader' not in tails_handles:
+        tails_handles['reader'] = await blob_storage.open_reader('default', TAILS_CONFIG)
+    return tails_handles['reader']
+
+
+def tails_hash_of(rev_reg_def_json):
+    return json.loads(rev_reg_def_json)['value']['tailsHash']
+
+
+def tails_path(tails_hash):
+    # Tails hashes are base58, anything else could escape the tails folder
+    if not tails_hash.isalnum():
+        raise ValueError('Invalid tails hash.')
+    return os.path.join(TAILS_DIR, tails_hash)
+
+
+def has_tails(tails_hash):
+    return os.path.isfile(tails_path(tails_hash))
+
+
+# Memory-mapped view of a tails file, mapped once per process and shared by every reader.
+def read_tails(tails_hash):
+    if tails_hash not in tails_handles:
+        with open(tails_path(tails_hash), 'rb') as file_:
+            tails_handles[tails_hash] = mmap.mmap(file_.fileno(), 0, access = mmap.ACCESS_READ)
+    return memoryview(tails_handles[tails_hash])
+
+
+# Yields a tails file in chunks straight from the memory map, e.g. for serving over HTTP.
+def iter_tails(tails_hash, chunk_size = 1024 * 1024):
+    view = read_tails(tails_hash)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size].tobytes()
+
+
+# Tails files are named by the base58 of their SHA-256, as Indy's tails writer does.
+def tails_digest(data):
+    data = hashlib.sha256(data).digest()
+    number = int.from_bytes(data, 'big')
+    encoded = ''
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58[remainder] + encoded
+    return BASE58[0] * (len(data) - len(data.lstrip(b'\0'))) + encoded
+
+
+# Raises a ValueError for data that is not the tails file, e.g. an error page, so it is never stored under the hash.
+def store_tails(tails_hash, data):
+    if tails_digest(data) != tails_hash:
+        raise ValueError('Tails file does not match its hash ' + tails_hash + '.')
+    os.makedirs(TAILS_DIR, exist_ok = True)
+    path = tails_path(tails_hash)
+    with open(path + '.part', 'wb') as file_:
+        file_.write(data)
+    os.replace(path + '.part', path)
@@ -3,15 +3,33 @@ Sovrin schema functions:
 
 1. Create credential schema.
 2. Create credential definition.
+3. Index definitions by unique schema name, schema ID and credential definition ID.
 '''
 
-import json, time
-from indy import anoncreds, ledger
+import asyncio, json, os
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.backend import anoncreds, ledger, current_backend
+    from sovrin.revocation import create_revocation_registry
+    from sovrin.events import log
+except ImportError:
+    from backend import anoncreds, ledger, current_backend
+    from revocation import create_revocation_registry
+    from events import log
+
+
+CRED_DEF_TAG = 'TAG1'
+
+
+# Seconds to let a new schema reach the pool before reading it back, ANVIL_SCHEMA_SETTLE or 1.
+# The in-memory ledger has it straight away, so none there, and benchmarks time the backend's own work.
+def settle_seconds():
+    return float(os.getenv('ANVIL_SCHEMA_SETTLE', 0 if current_backend() == 'memory' else 1))
 
     
 async def create_schema(schema, creator):
-    print(creator['name'].capitalize() + ' creating credential schema...')
-    unique_schema_name = schema['name'].replace(' ', '_').replace('-', '_').lower()
+    log('create_schema', creator['name'].capitalize() + ' creating credential schema...', actor = creator['name'])
+    unique_schema_name = unique_name(schema)
     (creator['schema_id'], creator[unique_schema_name + '_schema']) = \
         await anoncreds.issuer_create_schema(creator['did'], schema['name'], schema['version'],
                                              json.dumps(schema['attributes']))
@@ -22,13 +40,13 @@ async def create_schema(schema, creator):
     
 
 async def create_credential_definition(creator, schema_id, unique_schema_name, revocable = False):
-    print(creator['name'].capitalize() + ' applying credential definition...')
-    time.sleep(1)  # sleep 1 second before getting schema
+    log('create_credential_definition', creator['name'].capitalize() + ' applying credential definition...', actor = creator['name'], revocable = revocable)
+    await asyncio.sleep(settle_seconds())  # before getting schema, without holding up other registrations
     (creator['schema_id'], creator[unique_schema_name + '_schema']) = \
         await get_schema(creator['pool'], creator['did'], schema_id)
     # Create and store credential definition in wallet
     cred_def = {
-        'tag': 'TAG1',
+        'tag': CRED_DEF_TAG,
         'type': 'CL',
         'config': {
             "support_revocation": revocable
@@ -41,9 +59,35 @@ async def create_credential_definition(creator, schema_id, unique_schema_name, r
                                                                json.dumps(cred_def['config']))
     # Send definition to ledger
     await send_cred_def(creator['pool'], creator['wallet'], creator['did'], creator[unique_schema_name + '_cred_def'])
+    if revocable:
+        creator = await create_revocation_registry(creator, unique_schema_name)
+    index_definition(creator, unique_schema_name, schema_id, revocable)
     return creator
 
 
+def unique_name(schema):
+    return schema['name'].replace(' ', '_').replace('-', '_').lower()
+
+
+'''
+Keeps a definition in the creator's index, so it can be found by unique schema name, schema ID or
+credential definition ID without a search. Filled by create_credential_definition() and register_catalogue().
+'''
+def index_definition(creator, unique_schema_name, schema_id, revocable = False):
+    cred_def_id = creator[unique_schema_name + '_cred_def_id']
+    creator.setdefault('definitions', {})[unique_schema_name] = {'schema_id': schema_id, 'cred_def_id': cred_def_id, 'revocable': revocable}
+    ids = creator.setdefault('definition_ids', {})
+    ids[schema_id] = ids[cred_def_id] = unique_schema_name
+    return creator
+
+
+# Returns the unique schema name and index entry for any of the keys above, or (None, None).
+def find_definition(creator, key):
+    definitions = creator.get('definitions', {})
+    unique_schema_name = key if key in definitions else creator.get('definition_ids', {}).get(key)
+    return (unique_schema_name, definitions[unique_schema_name]) if unique_schema_name else (None, None)
+
+
 async def send_schema(pool_handle, wallet_handle, _did, schema):
     schema_request = await ledger.build_schema_request(_did, schema)
     await ledger.sign_and_submit_request(pool_handle, wallet_handle, _did, schema_request)
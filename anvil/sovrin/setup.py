@@ -2,30 +2,58 @@
 Sovrin setup/teardown functions:
 
 1. Pool setup.
-2. Set self up: establish dictionary data structure, create and open wallet.
-3. Actor teardown.
+2. Wallet keys: random, from the environment, or pre-derived RAW keys from a local key file.
+3. Set self up: establish dictionary data structure, create and open wallet.
+4. Actor teardown, optionally keeping wallets open for the next setup.
 '''
 
-import json, urllib, argparse
+import json, os, urllib, argparse
 from pathlib import Path
 from tempfile import gettempdir
 from os import environ
-from indy import pool, wallet, did
-from indy.error import ErrorCode, IndyError
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin.backend import pool, wallet, did, error, use_backend, BACKENDS
+    from sovrin.events import log
+    from sovrin.utilities import generate_base58, run_graph
+except ImportError:
+    from backend import pool, wallet, did, error, use_backend, BACKENDS
+    from events import log
+    from utilities import generate_base58, run_graph
 parser = argparse.ArgumentParser(description='Run python getting-started scenario (Prover/Issuer)')
 parser.add_argument('-t', '--storage_type', help='load custom wallet storage plug-in')
 parser.add_argument('-l', '--library', help='dynamic library to load for plug-in')
 parser.add_argument('-e', '--entrypoint', help='entry point for dynamic library')
 parser.add_argument('-c', '--config', help='entry point for dynamic library')
 parser.add_argument('-s', '--creds', help='entry point for dynamic library')
+parser.add_argument('-b', '--backend', choices = BACKENDS, help='indy (default) or memory, overrides ANVIL_BACKEND')
 args = parser.parse_known_args()[0]
+if args.backend:
+    use_backend(args.backend)
 
 
 PROTOCOL_VERSION = 2
+'''
+Wallet keys go through Argon2 every time a wallet is opened, unless the key derivation method is RAW.
+ANVIL_WALLET_KEY_METHOD sets it for keys from WALLET_KEY or generated at random: ARGON2I_MOD (Indy's default),
+ARGON2I_INT (faster, weaker) or RAW (a key from generate_wallet_key(), used as given).
+ANVIL_WALLET_KEY_FILE names a JSON file of a wallet ID and RAW key per actor, created on first use and kept
+readable by its owner only, so actors set up from it reopen the same wallets without deriving a key.
+'''
+KEY_METHOD = os.getenv('ANVIL_WALLET_KEY_METHOD')
+KEY_FILE = os.getenv('ANVIL_WALLET_KEY_FILE')
+'''
+With ANVIL_WALLET_CACHE=1, teardown keeps wallets open and set_self_up reuses them for the same wallet,
+so a reset and setup skip closing, deleting, creating and opening it again. Their contents are kept,
+e.g. the DIDs and credentials stored before the reset.
+'''
+CACHE_WALLETS = os.getenv('ANVIL_WALLET_CACHE', '0') == '1'
+# Open wallets kept by teardown, by wallet config: {'handle', 'credentials', 'dids': {seed: (did, verkey)}}
+wallet_cache = {}
 
 
 async def setup_pool(net = 'local'):
-    print('Setting up pool...')
+    log('setup_pool', 'Setting up pool...', net = net)
     name = 'ANVIL' if net == 'local' else net
     pool_ = {
         'name': name
@@ -35,48 +63,120 @@ async def setup_pool(net = 'local'):
     await pool.set_protocol_version(PROTOCOL_VERSION)
     try:
         await pool.create_pool_ledger_config(pool_['name'], pool_['config'])
-    except IndyError as ex:
-        if ex.error_code == ErrorCode.PoolLedgerConfigAlreadyExistsError:
+    except error.IndyError as ex:
+        if ex.error_code == error.ErrorCode.PoolLedgerConfigAlreadyExistsError:
             pass
     pool_['handle'] = await pool.open_pool_ledger(pool_['name'], None)
     return pool_['name'], pool_['handle']
 
 
+'''
+Wallet ID, key and key derivation method for an actor: from the key file if there is one,
+otherwise WALLET_ID and WALLET_KEY, or random ones.
+'''
+async def wallet_key(name, path = None):
+    path = path or KEY_FILE
+    if path:
+        return await key_file_entry(name, path)
+    if os.getenv('WALLET_KEY'):
+        key = os.getenv('WALLET_KEY')
+    elif KEY_METHOD == 'RAW':
+        key = await wallet.generate_wallet_key(None)
+    else:
+        key = generate_base58(64)
+    return os.getenv('WALLET_ID', generate_base58(64)), key, KEY_METHOD
+
+
+async def key_file_entry(name, path):
+    # Generated before reading, so no other setup in the process writes the file in between
+    new_key = await wallet.generate_wallet_key(None)
+    keys = {}
+    if os.path.isfile(path):
+        with open(path) as file_:
+            keys = json.load(file_)
+    if name not in keys:
+        keys[name] = {'id': name + '_' + generate_base58(16), 'key': new_key}
+        temp_path = path + '.tmp'
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file_:
+            json.dump(keys, file_, indent = 4)
+        os.replace(temp_path, path)
+        log('wallet_key_created', 'Wallet key for ' + name + ' saved to the key file', actor = name, path = path)
+    return keys[name]['id'], keys[name]['key'], 'RAW'
+
+
 # Set self up: establish dictionary data structure, create and open wallet.
 # If initialised from seed, create and store DID on the spot (for Steward Anchors).
-async def set_self_up(name, id_, key, pool_handle, seed = None):
-    print('Setting up ' + name + '...')
+async def set_self_up(name, id_, key, pool_handle, seed = None, key_method = None):
+    log('set_self_up', 'Setting up ' + name + '...', actor = name)
+    credentials = {'key': key}
+    if key_method:
+        credentials['key_derivation_method'] = key_method
     actor = {
         'name': name,
         'wallet_config': json.dumps({'id': id_}),
-        'wallet_credentials': json.dumps({'key': key}),
+        'wallet_credentials': json.dumps(credentials),
         'pool': pool_handle,
         'role': 'TRUST_ANCHOR' # Do not change role for individualised connections to work.
     }
-    try:
-        await wallet.create_wallet(wallet_config("create", actor['wallet_config']), wallet_credentials("create", actor['wallet_credentials']))
-    except IndyError as ex:
-        if ex.error_code == ErrorCode.PoolLedgerConfigAlreadyExistsError:
-            pass
-    actor['wallet'] = await wallet.open_wallet(wallet_config("open", actor['wallet_config']), wallet_credentials("open", actor['wallet_credentials']))
+    cached = wallet_cache.pop(actor['wallet_config'], None)
+    if cached and cached['credentials'] == actor['wallet_credentials']:
+        log('wallet_reused', 'Reusing the open wallet of ' + name, actor = name)
+        actor['wallet'], actor['seeded_dids'] = cached['handle'], cached['dids']
+    else:
+        if cached:
+            # Same wallet, different key: open it as asked, which fails if the key is wrong
+            await wallet.close_wallet(cached['handle'])
+        try:
+            await wallet.create_wallet(wallet_config("create", actor['wallet_config']), wallet_credentials("create", actor['wallet_credentials']))
+        except error.IndyError as ex:
+            # Kept from an earlier run, e.g. with a key file
+            if ex.error_code != error.ErrorCode.WalletAlreadyExistsError:
+                raise
+        actor['wallet'] = await wallet.open_wallet(wallet_config("open", actor['wallet_config']), wallet_credentials("open", actor['wallet_credentials']))
+        actor['seeded_dids'] = {}
     if seed:
         # Generate DID from seed - generally only used for existing Steward Anchor.
         actor['seed'] = seed
         actor['did_info'] = json.dumps({'seed': actor['seed']})
-        actor['did'], actor['key'] = await did.create_and_store_my_did(actor['wallet'], actor['did_info'])
+        if seed in actor['seeded_dids']:
+            actor['did'], actor['key'] = actor['seeded_dids'][seed]
+        else:
+            actor['did'], actor['key'] = await did.create_and_store_my_did(actor['wallet'], actor['did_info'])
+            actor['seeded_dids'][seed] = actor['did'], actor['key']
     return actor
 
 
 async def teardown(pool_name, pool_handle, actor_list = []):
-    print('Tearing down connections...')
+    log('teardown', 'Tearing down connections...')
+    await teardown_actors(actor_list, cache = False)
+    await close_cached_wallets()
+    if await pool.list_pools():
+        await pool.close_pool_ledger(pool_handle)
+        await pool.delete_pool_ledger_config(pool_name)
+
+
+# Closes and deletes the actors' wallets, or keeps them open with CACHE_WALLETS, leaving the pool open for others.
+async def teardown_actors(actor_list, cache = None):
+    cache = CACHE_WALLETS if cache is None else cache
     for actor in actor_list:
         if 'wallet' in actor:
+            if cache:
+                wallet_cache[actor['wallet_config']] = {'handle': actor['wallet'], 'credentials': actor['wallet_credentials'], 'dids': actor.get('seeded_dids', {})}
+                continue
             await wallet.close_wallet(actor['wallet'])
             await wallet.delete_wallet(actor['wallet_config'], actor['wallet_credentials'])
-    if await pool.list_pools():
-        await pool.close_pool_ledger(pool_handle)
-        await pool.delete_pool_ledger_config(pool_name)
-    
+
+
+
+def cached_handles():
+    return [cached['handle'] for cached in wallet_cache.values()]
+
+
+async def close_cached_wallets():
+    while wallet_cache:
+        _, cached = wallet_cache.popitem()
+        await wallet.close_wallet(cached['handle'])
+
 
 def wallet_config(operation, wallet_config_str):
     if not args.storage_type:
@@ -139,12 +239,14 @@ def save_pool_genesis_txn_file(path, net = 'local'):
         f.writelines(data)
 
 
-# This function sets up all actors for same-file demoes.
+# This function sets up all actors for same-file demoes, their wallets concurrently.
 async def setup_demo():
     pool_name, pool_handle = await setup_pool('local')
-    steward = await set_self_up('steward', 'STEWARD_DEMO_DID', 'STEWARD_DEMO_KEY', pool_handle, seed = '000000000000000000000000Steward1')
-    issuer = await set_self_up('issuer', 'ISSUER_DEMO_DID', 'ISSUER_DEMO_KEY', pool_handle)
-    prover = await set_self_up('prover', 'PROVER_DEMO_DID', 'PROVER_DEMO_KEY', pool_handle)
-    verifier = await set_self_up('verifier', 'VERIFIER_DEMO_DID', 'VERIFIER_DEMO_KEY', pool_handle)
-    return pool_name, pool_handle, steward, issuer, prover, verifier
+    actors, _ = await run_graph({
+        'steward': ([], lambda: set_self_up('steward', 'STEWARD_DEMO_DID', 'STEWARD_DEMO_KEY', pool_handle, seed = '000000000000000000000000Steward1')),
+        'issuer': ([], lambda: set_self_up('issuer', 'ISSUER_DEMO_DID', 'ISSUER_DEMO_KEY', pool_handle)),
+        'prover': ([], lambda: set_self_up('prover', 'PROVER_DEMO_DID', 'PROVER_DEMO_KEY', pool_handle)),
+        'verifier': ([], lambda: set_self_up('verifier', 'VERIFIER_DEMO_DID', 'VERIFIER_DEMO_KEY', pool_handle))
+    }, 'setup_demo')
+    return pool_name, pool_handle, actors['steward'], actors['issuer'], actors['prover'], actors['verifier']
 
@@ -0,0 +1,221 @@
+'''
+Tracing of credential exchanges across actors:
+
+1. Spans for local work: each step of onboarding, issuance and proofs, decryption and every Indy call.
+2. Trace context carried between actors in the authcrypted messages, as a `~trace` field
+   (as in the Aries message tracing decorator), and between apps in the W3C `traceparent` HTTP header.
+3. The context of the last exchange is kept on the actor, so a step triggered later
+   (e.g. from the app's UI) continues the same trace.
+4. Finished spans are appended to ANVIL_TRACE_FILE as OpenTelemetry OTLP/JSON, one export request per line,
+   as written by the OpenTelemetry file exporter and read by its collectors.
+
+Tracing is off unless ANVIL_TRACE_FILE is set, and then adds nothing to messages or headers.
+'''
+
+import contextvars, functools, json, os, secrets, sys, time
+
+
+settings = {
+    'file': os.getenv('ANVIL_TRACE_FILE'),
+    'service': os.getenv('ANVIL_SERVICE_NAME', os.path.splitext(os.path.basename(sys.argv[0] or 'anvil'))[0]),
+    'batch': 64
+}
+current_span = contextvars.ContextVar('current_span', default = None)
+finished = []
+
+
+def enabled():
+    return bool(settings['file'])
+
+
+def configure(file = None, service = None):
+    if file is not None:
+        settings['file'] = file
+    if service is not None:
+        settings['service'] = service
+
+
+class Span:
+
+    def __init__(self, name, parent = None, attributes = None):
+        self.name = name
+        self.trace_id = parent['trace_id'] if parent else secrets.token_hex(16)
+        self.parent_id = parent['span_id'] if parent else None
+        self.span_id = secrets.token_hex(8)
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+        self.token = None
+
+    def context(self):
+        return {'trace_id': self.trace_id, 'span_id': self.span_id}
+
+    # Moves the span into a trace received from another actor, keeping its timing.
+    def adopt(self, context):
+        self.trace_id, self.parent_id = context['trace_id'], context['span_id']
+
+    def __enter__(self):
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time_ns()
+        try:
+            current_span.reset(self.token)
+        except ValueError:
+            # Exited in another context than it was entered in, e.g. across a framework's request hooks
+            current_span.set(None)
+        if exc is not None:
+            self.error = repr(exc)
+        finish(self)
+        return False
+
+
+class NoSpan:
+
+    attributes = {}
+
+    def context(self):
+        return None
+
+    def adopt(self, context):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+'''
+Starts a span, as a child of `parent` (a context from context_of() or extract()) if given,
+otherwise of the current span. Use as a context manager.
+'''
+def span(name, parent = None, **attributes):
+    if not settings['file']:
+        return NO_SPAN
+    if parent is None and current_span.get() is not None:
+        parent = current_span.get().context()
+    return Span(name, parent, attributes)
+
+
+# Records a span for work that started at `start` (time.time_ns()) and has just ended, as a child of the current span.
+def record(name, start, **attributes):
+    if not settings['file']:
+        return
+    span_ = span(name, **attributes)
+    span_.start, span_.end = start, time.time_ns()
+    finish(span_)
+
+
+def finish(span_):
+    finished.append(span_)
+    # Flush when a local root finishes so traces appear promptly, or when the batch is full
+    if span_.parent_id is None or current_span.get() is None or len(finished) >= settings['batch']:
+        flush()
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(span_):
+    exported = {
+        'traceId': span_.trace_id,
+        'spanId': span_.span_id,
+        'name': span_.name,
+        'kind': 1,
+        'startTimeUnixNano': str(span_.start),
+        'endTimeUnixNano': str(span_.end),
+        'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in span_.attributes.items()],
+        'status': {'code': 2, 'message': span_.error} if span_.error else {'code': 1}
+    }
+    if span_.parent_id:
+        exported['parentSpanId'] = span_.parent_id
+    return exported
+
+
+def flush():
+    if not finished or not settings['file']:
+        return
+    spans = [otlp_span(span_) for span_ in finished]
+    finished.clear()
+    line = json.dumps({'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': settings['service']}}]},
+        'scopeSpans': [{'scope': {'name': 'anvil'}, 'spans': spans}]
+    }]})
+    with open(settings['file'], 'a') as file_:
+        file_.write(line + '\n')
+
+
+def context_of(span_ = None):
+    span_ = span_ or current_span.get()
+    return span_.context() if span_ else None
+
+
+# Adds the current trace context to an outgoing message, a dict or a JSON object string.
+def inject(message):
+    context = context_of()
+    if context is None:
+        return message
+    if isinstance(message, dict):
+        return dict(message, **{'~trace': context})
+    # Spliced into the JSON string rather than parsed and dumped again
+    body = message.strip()[1:]
+    return '{"~trace": ' + json.dumps(context) + (', ' + body if body.strip() != '}' else '}')
+
+
+'''
+Removes the trace context from a received message (dict), moving the current span into its trace.
+Returns the message and whether it carried a context, in which case a JSON form should be re-serialised.
+'''
+def extract(message):
+    if not isinstance(message, dict) or '~trace' not in message:
+        return message, False
+    context = message.pop('~trace')
+    if current_span.get() is not None and isinstance(context, dict) and 'trace_id' in context:
+        current_span.get().adopt(context)
+    return message, True
+
+
+def traceparent():
+    context = context_of()
+    return '00-' + context['trace_id'] + '-' + context['span_id'] + '-01' if context else None
+
+
+def from_traceparent(header):
+    parts = (header or '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return {'trace_id': parts[1], 'span_id': parts[2]}
+
+
+'''
+Decorator for steps taking an actor as their first argument, e.g. @traced('offer_credential').
+The step's span continues the actor's last exchange, or the current trace if there is none.
+Steps that open an exchange (starts = True) begin a new trace unless called within one.
+'''
+def traced(name, starts = False):
+    def decorate(function):
+        @functools.wraps(function)
+        async def step(actor, *args, **kwargs):
+            if not settings['file']:
+                return await function(actor, *args, **kwargs)
+            parent = None if starts else actor.get('trace')
+            with span(name, parent, actor = actor.get('name', '')) as span_:
+                result = await function(actor, *args, **kwargs)
+                actor['trace'] = span_.context()
+            return result
+        return step
+    return decorate
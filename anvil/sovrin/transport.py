@@ -0,0 +1,101 @@
+'''
+Message transports between actors:
+
+1. memory: named in-process channels, one asyncio queue each (default). Payloads are handed over
+   as they are, bytes or memoryview, without copying or touching the disk.
+2. file: the net_sim_[channel] files, for actors run as separate scripts on one machine.
+
+Select with the ANVIL_TRANSPORT environment variable or use_transport().
+A memory channel can also stand in for an HTTP hop between the apps when they run in one process:
+name it after the URL with url_channel(), e.g. send(data, url_channel('http://127.0.0.1:5002/credential_store')).
+'''
+
+import asyncio, os, time
+from urllib.parse import urlsplit
+
+
+TRANSPORTS = ('memory', 'file')
+POLL_SECONDS = 0.01
+
+
+class MemoryTransport:
+
+    def __init__(self, maxsize = 0):
+        self.maxsize = maxsize
+        self.channels = {}
+
+    def channel(self, channel):
+        if channel not in self.channels:
+            self.channels[channel] = asyncio.Queue(self.maxsize)
+        return self.channels[channel]
+
+    async def send(self, data, channel = 0):
+        await self.channel(channel).put(data)
+
+    # Raises asyncio.TimeoutError if nothing arrives within timeout seconds (None waits indefinitely).
+    async def receive(self, channel = 0, timeout = None):
+        return await asyncio.wait_for(self.channel(channel).get(), timeout)
+
+    def pending(self, channel = 0):
+        return self.channels[channel].qsize() if channel in self.channels else 0
+
+    def close(self, channel = 0):
+        self.channels.pop(channel, None)
+
+
+class FileTransport:
+
+    def path(self, channel):
+        return 'net_sim_' + str(channel)
+
+    async def send(self, data, channel = 0):
+        with open(self.path(channel) + '.part', 'wb') as file_:
+            file_.write(data)
+        os.replace(self.path(channel) + '.part', self.path(channel))
+
+    # Waits for the channel's file, then reads and removes it so each message is received once.
+    async def receive(self, channel = 0, timeout = None):
+        started = time.monotonic()
+        while not os.path.exists(self.path(channel)):
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(POLL_SECONDS)
+        with open(self.path(channel), 'rb') as file_:
+            data = file_.read()
+        os.remove(self.path(channel))
+        return data
+
+    def pending(self, channel = 0):
+        return int(os.path.exists(self.path(channel)))
+
+    def close(self, channel = 0):
+        if os.path.exists(self.path(channel)):
+            os.remove(self.path(channel))
+
+
+transports = {'memory': MemoryTransport(), 'file': FileTransport()}
+selected = {'transport': os.getenv('ANVIL_TRANSPORT', 'memory')}
+
+
+def use_transport(name):
+    if name not in TRANSPORTS:
+        raise ValueError('Unknown transport ' + name + ', choose one of ' + ', '.join(TRANSPORTS) + '.')
+    selected['transport'] = name
+
+
+def get_transport(name = None):
+    return transports[name or selected['transport']]
+
+
+# Channel name for an HTTP endpoint, e.g. '127.0.0.1:5002/credential_store'.
+def url_channel(url):
+    parts = urlsplit(url)
+    return parts.netloc + parts.path
+
+
+async def send(data, channel = 0):
+    await get_transport().send(data, channel)
+
+
+async def receive(channel = 0, timeout = None):
+    return await get_transport().receive(channel, timeout)
@@ -2,7 +2,14 @@
 Sovrin core utilities.
 '''
 
-import asyncio, json, random
+import asyncio, json, random, time
+# Sibling modules are importable as sovrin.[module] from the apps and as [module] from the demo runners.
+try:
+    from sovrin import transport
+    from sovrin.events import log
+except ImportError:
+    import transport
+    from events import log
 
 
 def run_coroutine(coroutine, loop = None):
@@ -37,6 +44,69 @@ def receive_data(channel = 0):
     return data
 
 
+# Sends through the selected transport (see transport.py), in memory by default.
+async def send_data_async(data, channel = 0):
+    await transport.send(data, channel)
+
+
+# Waits for data on the channel, raising asyncio.TimeoutError after timeout seconds if given.
+async def receive_data_async(channel = 0, timeout = None):
+    return await transport.receive(channel, timeout)
+
+
+'''
+Runs steps as a dependency graph, {name: ([names of the steps it waits for], coroutine function)}.
+Each step starts as soon as the steps it waits for are done, so independent ones run concurrently.
+Returns the steps' results and their timings by name: when each started after the graph did, and how long it took.
+Steps that share single-slot actor state (e.g. two onboardings of the same onboardee) must wait for one another.
+'''
+async def run_graph(steps, label = 'graph'):
+    unknown = [dependency for dependencies, _ in steps.values() for dependency in dependencies if dependency not in steps]
+    if unknown:
+        raise ValueError('Unknown steps: ' + ', '.join(unknown) + '.')
+    check_acyclic(steps)
+    started = time.perf_counter()
+    tasks, timings = {}, {}
+
+    async def run(name):
+        dependencies, function = steps[name]
+        await asyncio.gather(*(tasks[dependency] for dependency in dependencies))
+        began = time.perf_counter()
+        result = await function()
+        timings[name] = {'start': began - started, 'seconds': time.perf_counter() - began}
+        log('graph_step', label + ': ' + name + ' done', level = 'debug', graph = label, step = name, **timings[name])
+        return result
+
+    # Every task is created before any runs, so each finds the tasks it waits for
+    for name in steps:
+        tasks[name] = asyncio.ensure_future(run(name))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    log('graph_done', label + ' done', graph = label, seconds = time.perf_counter() - started, steps = len(steps))
+    return {name: task.result() for name, task in tasks.items()}, timings
+
+
+def check_acyclic(steps):
+    done, visiting = set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError('Steps wait for each other: ' + name + '.')
+        visiting.add(name)
+        for dependency in steps[name][0]:
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+
+    for name in steps:
+        visit(name)
+
+
 def generate_nonce(length):
     nonce = ''.join(random.choice('0123456789') for i in range(length))
     return nonce
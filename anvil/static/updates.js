@@ -0,0 +1,34 @@
+/*
+Applies the actor's state pushed to /events (see updates.py) to the page, rather than loading the page again:
+- data-show="flag !other a|b" shows an element while every term holds, i.e. flag is set, other is not, and a or b is.
+- data-text="name" shows the value of name.
+*/
+function anvilUpdates(url) {
+    var state = {};
+
+    function holds(term) {
+        return term.split('|').some(function (flag) {
+            return flag.charAt(0) === '!' ? !state[flag.slice(1)] : !!state[flag];
+        });
+    }
+
+    function apply() {
+        document.querySelectorAll('[data-show]').forEach(function (element) {
+            element.hidden = !element.dataset.show.split(' ').every(holds);
+        });
+        document.querySelectorAll('[data-text]').forEach(function (element) {
+            var value = state[element.dataset.text];
+            element.textContent = typeof value === 'string' ? value : JSON.stringify(value);
+        });
+    }
+
+    var source = new EventSource(url);
+    source.addEventListener('state', function (event) {
+        state = JSON.parse(event.data);
+        apply();
+    });
+    source.addEventListener('delta', function (event) {
+        Object.assign(state, JSON.parse(event.data));
+        apply();
+    });
+}
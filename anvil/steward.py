@@ -1,8 +1,8 @@
 import os, requests, time, json
 from quart import Quart, render_template, redirect, url_for, session, request, jsonify
-from sovrin.utilities import generate_base58
-from sovrin.setup import setup_pool, set_self_up
-from common import common_setup, common_connection_request, common_establish_channel, common_verinym_request, common_reset
+from sovrin.setup import set_self_up, wallet_key
+from common import common_setup, common_connection_request, common_establish_channel, common_verinym_request, common_reset, common_instrument, common_admission, common_pool, common_state, common_run, common_updates, common_form, common_api, common_soft
+from api import APIError, action, optional
 app = Quart(__name__)
 
 debug = False # Do not enable in production
@@ -13,32 +13,60 @@ port = 5000
 steward = {}
 counterparty_name = False
 pool_handle = 1
+common_instrument(app, actor = 'steward')
+# The routes peers call, and those of them that decrypt or write to the ledger straight away
+common_admission(app, ['/establish_channel', '/verinym_request'], ['/establish_channel', '/verinym_request'], 'steward')
+common_state(app, 'steward', globals(), ['steward', 'counterparty_name'])
 
 
-@app.route('/')
-def index():
+# Flags for the page and for /events subscribers.
+def view_state():
     global steward
     setup = True if steward else False
     channel_established = True if 'connection_response' in steward else False
-    return render_template('steward.html', actor = 'STEWARD', setup = setup, channel_established = channel_established)
+    return {
+        'setup': setup,
+        'channel_established': channel_established
+    }
 
 
-@app.route('/setup', methods = ['GET', 'POST'])
-async def setup():
+@app.route('/')
+def index():
+    return render_template('steward.html', actor = 'STEWARD', **view_state())
+
+
+common_updates(app, view_state)
+actions = {}
+common_api(app, 'steward', actions, view_state)
+
+
+@action(actions, 'setup')
+async def do_setup(fields):
     global steward, pool_handle
-    _, pool_handle = await setup_pool('local')
-    id_ = os.getenv('WALLET_ID', generate_base58(64))
-    key = os.getenv('WALLET_KEY', generate_base58(64))
+    if steward:
+        raise APIError('conflict', 'Already set up. Reset first.')
+    pool_handle = await common_pool('local')
+    id_, key, key_method = await wallet_key('steward')
     seed = os.getenv('SOVRIN_SEED', '000000000000000000000000Steward1')
-    steward = await set_self_up('steward', id_, key, pool_handle, seed = seed)
-    return redirect(url_for('index'))
+    steward = await set_self_up('steward', id_, key, pool_handle, seed = seed, key_method = key_method)
+    return {'did': steward['did']}
+
+
+@app.route('/setup', methods = ['GET', 'POST'])
+async def setup():
+    return await common_form(do_setup)
+
+
+@action(actions, 'connection_request', ip_address = str, name = str)
+async def do_connection_request(fields):
+    global steward, counterparty_name
+    steward, counterparty_name = await common_connection_request(steward, fields['ip_address'], fields['name'])
+    return {'name': counterparty_name}
 
 
 @app.route('/connection_request', methods = ['GET', 'POST'])
 async def connection_request():
-    global steward, counterparty_name
-    steward, counterparty_name = await common_connection_request(steward)
-    return redirect(url_for('index'))
+    return await common_form(do_connection_request)
 
 
 @app.route('/establish_channel', methods = ['GET', 'POST'])
@@ -55,11 +83,19 @@ async def verinym_request():
     return '200'
 
 
-@app.route('/reset')
-async def reset():
-    global steward, pool_handle
+@action(actions, 'reset', soft = optional(bool))
+async def do_reset(fields):
+    global steward, pool_handle, counterparty_name
+    if common_soft(fields):
+        # Only an onboarding in flight, which the onboardee starts again
+        counterparty_name = False
+        return {'soft': True}
     steward, pool_handle = await common_reset([steward], pool_handle)
-    return redirect(url_for('index'))
+
+
+@app.route('/reset', methods = ['GET', 'POST'])
+async def reset():
+    return await common_form(do_reset)
 
 
 @app.route('/reload')
@@ -69,5 +105,5 @@ def reload():
 
 if __name__ == '__main__':
     app.secret_key = os.getenv('ANVIL_KEY', 'MUST_BE_STATIC')
-    app.run(host, port, debug)
+    common_run(app, 'steward', host, port, debug)
     
@@ -0,0 +1,173 @@
+'''
+Shared state for apps run as several worker processes:
+
+1. A store keeps JSON values by key, with a version each, and applies updates atomically.
+2. sqlite: a file shared by the workers on one host, e.g. ANVIL_STORE=sqlite:///var/lib/anvil/issuer.db.
+3. memory: kept in the process, the local stand-in for networked stores. A networked store (e.g. Redis)
+   implements get, version and update, and is added with register_store().
+4. App state (actor dicts, inboxes, flags) is encoded to JSON, keeping bytes, deques and ordered dicts.
+5. Each worker's changes are merged with the latest stored state: dict keys one by one, list items
+   added and removed, and the counters in COUNTERS (e.g. inbox counts) by adding up the changes.
+   Other values, other numbers included, are last writer wins, as with concurrent requests in one process.
+'''
+
+import asyncio, base64, json, sqlite3, threading
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit
+
+
+class MemoryStore:
+
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key, (None, 0))
+
+    async def version(self, key):
+        return self.values.get(key, (None, 0))[1]
+
+    # Replaces the value with function(current value), returns the new value and version.
+    async def update(self, key, function):
+        value, version = self.values.get(key, (None, 0))
+        self.values[key] = (function(value), version + 1)
+        return self.values[key]
+
+
+class SQLiteStore:
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level = None, check_same_thread = False, timeout = 30)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT, version INTEGER)')
+        # Calls run in threads off the event loop, one at a time on the connection
+        self.lock = threading.Lock()
+
+    async def call(self, function, *args):
+        def locked():
+            with self.lock:
+                return function(*args)
+        return await asyncio.to_thread(locked)
+
+    async def get(self, key):
+        return await self.call(self.read, key)
+
+    async def version(self, key):
+        row = await self.call(lambda: self.connection.execute('SELECT version FROM state WHERE key = ?', (key,)).fetchone())
+        return row[0] if row else 0
+
+    async def update(self, key, function):
+        return await self.call(self.write, key, function)
+
+    def read(self, key):
+        row = self.connection.execute('SELECT value, version FROM state WHERE key = ?', (key,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (None, 0)
+
+    # Holds the write lock from read to write, so workers updating at once take turns.
+    def write(self, key, function):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            value, version = self.read(key)
+            value = function(value)
+            self.connection.execute('INSERT OR REPLACE INTO state (key, value, version) VALUES (?, ?, ?)',
+                                    (key, json.dumps(value), version + 1))
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        return value, version + 1
+
+
+stores = {
+    'memory': lambda url: MemoryStore(),
+    'sqlite': lambda url: SQLiteStore(urlsplit(url).netloc + urlsplit(url).path or 'anvil_state.db')
+}
+
+
+# Adds a store type, e.g. register_store('redis', lambda url: RedisStore(url)) for ANVIL_STORE=redis://host:6379/0.
+def register_store(scheme, factory):
+    stores[scheme] = factory
+
+
+def open_store(url):
+    scheme = urlsplit(url).scheme or url
+    if scheme not in stores:
+        raise ValueError('Unknown store ' + scheme + ', choose one of ' + ', '.join(stores) + '.')
+    return stores[scheme](url)
+
+
+def encode(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, deque):
+        return {'__deque__': [encode(item) for item in value]}
+    if isinstance(value, OrderedDict):
+        return {'__ordered__': {key: encode(item) for key, item in value.items()}}
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict):
+        if '__bytes__' in value:
+            return base64.b64decode(value['__bytes__'])
+        if '__deque__' in value:
+            return deque(decode(item) for item in value['__deque__'])
+        if '__ordered__' in value:
+            return OrderedDict((key, decode(item)) for key, item in value['__ordered__'].items())
+        return {key: decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    return value
+
+
+# Keys of numbers that count events, such as the inbox counts, merged by adding each worker's increments
+COUNTERS = ('accepted', 'duplicates', 'rejected', 'failed')
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+'''
+Three-way merge of encoded values: applies the changes from base to ours onto theirs, the latest stored value.
+The key is the value's key in its dict, to tell counters apart.
+'''
+def merge(base, ours, theirs, key = None):
+    if ours == base:
+        return theirs
+    if isinstance(base, dict) and isinstance(ours, dict) and isinstance(theirs, dict):
+        merged = dict(theirs)
+        for name in list(base) + [name for name in ours if name not in base]:
+            if name not in ours:
+                merged.pop(name, None)
+            elif name not in base or ours[name] != base[name]:
+                merged[name] = merge(base.get(name), ours[name], theirs.get(name), name)
+        return merged
+    if isinstance(base, list) and isinstance(ours, list) and isinstance(theirs, list):
+        removed = [item for item in base if item not in ours]
+        added = [item for item in ours if item not in base]
+        return [item for item in theirs if item not in removed] + [item for item in added if item not in theirs]
+    if key in COUNTERS and is_number(base) and is_number(ours) and is_number(theirs):
+        return theirs + ours - base
+    return ours
+
+
+# Updates a live value to match another, keeping the same object so references held elsewhere stay valid.
+def assign(current, value):
+    if type(current) is not type(value):
+        return value
+    if isinstance(current, dict):
+        current.clear()
+        current.update(value)
+    elif isinstance(current, deque):
+        current.clear()
+        current.extend(value)
+    elif isinstance(current, list):
+        current[:] = value
+    else:
+        return value
+    return current
@@ -0,0 +1,237 @@
+'''
+Runs one actor app for many tenants (e.g. organisations) in one process, on one event loop:
+
+1. Each tenant is served at /t/[tenant]/ on the actor's port, with its own copy of the app: its own wallet, DIDs, inboxes and pages.
+2. A tenant's app is loaded on its first request. Tenants share one pool handle, one HTTP session, and the revocation and tails caches.
+3. Wallets are opened on demand and kept open for the most recently used tenants, up to ANVIL_TENANT_WALLETS (default 100).
+   Wallets idle for ANVIL_TENANT_IDLE seconds (default 300) are closed, and opened again on the tenant's next request.
+4. Wallet IDs and RAW keys are kept per tenant in ANVIL_WALLET_KEY_FILE (default anvil_[actor]_tenant_keys.json, see setup.py),
+   so opening a wallet again does not derive its key.
+5. Peers reach a tenant at [ip]:[port]/t/[tenant]. Their replies without the path go to the tenant that last wrote to them.
+6. Only provisioned tenants are served, others get a 404: those with a key in the key file, or listed in ANVIL_TENANT_ALLOW
+   (e.g. acme,globex). Provision one with its key by running this file with its name, see below.
+7. At most ANVIL_TENANTS apps (default 1000) are loaded. A new tenant beyond that unloads the least recently used idle one,
+   or gets a 503 if every one is in the middle of a request. Apps idle for ANVIL_TENANT_UNLOAD seconds (default 3600) are unloaded too.
+   An unloaded tenant's wallet is kept, but the exchanges it had in flight are dropped, and it sets up again from its wallet.
+
+Run from this folder, for issuers, provers or verifiers:
+ANVIL_TENANT_ACTOR=verifier python3 tenants.py
+To provision tenants, adding their keys to the key file:
+ANVIL_TENANT_ACTOR=verifier python3 tenants.py acme globex
+State is kept in the process, ANVIL_STORE is not supported in this mode.
+'''
+
+import asyncio, importlib.util, json, os, re, sys, time
+from collections import OrderedDict
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+import sovrin.setup
+from sovrin.backend import wallet
+from sovrin.setup import wallet_config, wallet_credentials, key_file_entry
+from sovrin.events import log
+from sovrin.metrics import unregister_collector
+from common import local_apps, current_tenant, tenant_peers
+from admission import RETRY_AFTER
+
+
+# The actors' ports, as in their apps
+ACTORS = {'issuer': 5001, 'prover': 5002, 'verifier': 5003}
+TENANT_PATH = re.compile(r'^/t/([A-Za-z0-9_-]{1,64})(/.*)?$')
+MAX_WALLETS = int(os.getenv('ANVIL_TENANT_WALLETS', 100))
+IDLE_SECONDS = float(os.getenv('ANVIL_TENANT_IDLE', 300))
+MAX_TENANTS = int(os.getenv('ANVIL_TENANTS', 1000))
+UNLOAD_SECONDS = float(os.getenv('ANVIL_TENANT_UNLOAD', 3600))
+ALLOWED = set(tenant.strip() for tenant in os.getenv('ANVIL_TENANT_ALLOW', '').split(',') if tenant.strip())
+host = '0.0.0.0'
+
+# By tenant, least recently used first: {'module', 'app', 'started', 'busy', 'used'}
+tenants = OrderedDict()
+hosted = {}
+# The key file's entries, read again when it changes: {'mtime', 'names'}
+key_file = {'mtime': None, 'names': set()}
+
+
+# Sets the actor served, e.g. mount('verifier'), and registers the tenants by port so common_outbound() knows they are local.
+def mount(actor):
+    if actor not in ACTORS:
+        raise ValueError('Tenants can be ' + ', '.join(ACTORS) + ', not ' + actor + '.')
+    if os.getenv('ANVIL_STORE'):
+        raise ValueError('Tenant state is kept in the process, unset ANVIL_STORE.')
+    hosted['actor'] = actor
+    hosted['port'] = ACTORS[actor]
+    sovrin.setup.KEY_FILE = sovrin.setup.KEY_FILE or 'anvil_' + actor + '_tenant_keys.json'
+    local_apps[hosted['port']] = tenants_app
+    return tenants_app
+
+
+# The tenant's module and key file name, e.g. issuer_acme, as common_actor_name() gives it.
+def tenant_name(tenant):
+    return hosted['actor'] + '_' + tenant
+
+
+# True if the tenant is in ANVIL_TENANT_ALLOW or has a key in the key file.
+def provisioned(tenant):
+    if tenant in ALLOWED:
+        return True
+    path = sovrin.setup.KEY_FILE
+    mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+    if mtime != key_file['mtime']:
+        key_file['names'] = set()
+        if mtime:
+            with open(path) as file_:
+                key_file['names'] = set(json.load(file_))
+        key_file['mtime'] = mtime
+    return tenant_name(tenant) in key_file['names']
+
+
+# Adds the tenant's wallet ID and key to the key file, so it is served.
+async def provision(tenant):
+    if not TENANT_PATH.match('/t/' + tenant):
+        raise ValueError('Tenant names are 1 to 64 letters, digits, - or _, not ' + tenant + '.')
+    await key_file_entry(tenant_name(tenant), sovrin.setup.KEY_FILE)
+    log('tenant_provisioned', 'Provisioned tenant ' + tenant, actor = hosted['actor'], tenant = tenant)
+
+
+# Loads a copy of the actor's app with its own globals for a new tenant.
+def load_tenant(tenant):
+    name = tenant_name(tenant)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(os.path.dirname(os.path.abspath(__file__)), hosted['actor'] + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    # Quart finds the templates from the module
+    sys.modules[name] = module
+    token = current_tenant.set(tenant)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        current_tenant.reset(token)
+    module.app.secret_key = os.getenv('ANVIL_KEY', 'MUST_BE_STATIC')
+    log('tenant_loaded', 'Loaded tenant ' + tenant, actor = hosted['actor'], tenant = tenant)
+    return {'module': module, 'app': module.app, 'started': asyncio.ensure_future(module.app.startup()), 'busy': 0, 'used': time.monotonic()}
+
+
+# The tenant's actor dict, whichever the app holds now (a reset replaces it).
+def actor_of(entry):
+    return getattr(entry['module'], hosted['actor'])
+
+
+async def open_tenant_wallet(entry):
+    actor = actor_of(entry)
+    if 'wallet_config' in actor and 'wallet' not in actor:
+        actor['wallet'] = await wallet.open_wallet(wallet_config('open', actor['wallet_config']), wallet_credentials('open', actor['wallet_credentials']))
+
+
+async def close_tenant_wallet(tenant, entry):
+    actor = actor_of(entry)
+    if 'wallet' in actor:
+        await wallet.close_wallet(actor.pop('wallet'))
+        log('tenant_wallet_closed', 'Closed the wallet of tenant ' + tenant, level = 'debug', actor = hosted['actor'], tenant = tenant)
+
+
+# Closes the tenant's wallet and shuts its app down, dropping its module so it is loaded afresh on its next request.
+async def unload_tenant(tenant):
+    entry = tenants.pop(tenant)
+    await close_tenant_wallet(tenant, entry)
+    await entry['app'].shutdown()
+    unregister_collector(entry['app'].extensions.get('anvil_collector'))
+    sys.modules.pop(tenant_name(tenant), None)
+    log('tenant_unloaded', 'Unloaded tenant ' + tenant, actor = hosted['actor'], tenant = tenant)
+
+
+'''
+Closes the wallets of the least recently used tenants beyond MAX_WALLETS, and those idle for more than idle seconds.
+Unloads the apps idle for more than unload seconds. Tenants in the middle of a request keep theirs.
+'''
+async def evict(idle = None, unload = None):
+    open_wallets = [(tenant, entry) for tenant, entry in tenants.items() if 'wallet' in actor_of(entry)]
+    excess = len(open_wallets) - MAX_WALLETS
+    now = time.monotonic()
+    for tenant, entry in open_wallets:
+        if entry['busy']:
+            continue
+        if excess > 0 or (idle is not None and now - entry['used'] > idle):
+            await close_tenant_wallet(tenant, entry)
+            excess -= 1
+    if unload is not None:
+        for tenant, entry in list(tenants.items()):
+            if not entry['busy'] and now - entry['used'] > unload:
+                await unload_tenant(tenant)
+
+
+# Unloads the least recently used idle tenant to make room for another. Returns False if every tenant is busy.
+async def make_room():
+    for tenant, entry in tenants.items():
+        if not entry['busy']:
+            await unload_tenant(tenant)
+            return True
+    return False
+
+
+async def evict_idle():
+    while True:
+        await asyncio.sleep(max(min(IDLE_SECONDS, UNLOAD_SECONDS) / 2, 1))
+        await evict(IDLE_SECONDS, UNLOAD_SECONDS)
+
+
+# ASGI app passing each request to its tenant's app, as /t/[tenant]/[route] or from a peer the tenant wrote to.
+async def tenants_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    match = TENANT_PATH.match(scope['path'])
+    if match:
+        tenant = match.group(1)
+        root_path = scope.get('root_path', '') + '/t/' + tenant
+        # The app needs a path below its root, /t/acme becomes /t/acme/
+        scope = dict(scope, root_path = root_path, path = scope['path'] if match.group(2) else root_path + '/')
+    else:
+        tenant = tenant_peers.get(scope['client'][0]) if scope.get('client') else None
+    if tenant not in tenants:
+        if tenant is None or not provisioned(tenant):
+            return await respond(send, 404, b'No such tenant. Use /t/[tenant]/ for a provisioned tenant\'s routes.')
+        if len(tenants) >= MAX_TENANTS and not await make_room():
+            return await respond(send, 503, b'Too many tenants in use, try again later.')
+        tenants[tenant] = load_tenant(tenant)
+    entry = tenants[tenant]
+    tenants.move_to_end(tenant)
+    entry['busy'] += 1
+    token = current_tenant.set(tenant)
+    try:
+        await entry['started']
+        await open_tenant_wallet(entry)
+        await entry['app'](scope, receive, send)
+    finally:
+        current_tenant.reset(token)
+        entry['busy'] -= 1
+        entry['used'] = time.monotonic()
+    await evict()
+
+
+async def respond(send, status, body):
+    headers = [(b'content-type', b'text/plain')] + ([(b'retry-after', str(RETRY_AFTER).encode())] if status == 503 else [])
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            hosted['evictor'] = asyncio.ensure_future(evict_idle())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            hosted['evictor'].cancel()
+            for tenant, entry in tenants.items():
+                await close_tenant_wallet(tenant, entry)
+                await entry['app'].shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+if __name__ == '__main__':
+    mount(os.getenv('ANVIL_TENANT_ACTOR', 'issuer'))
+    if sys.argv[1:]:
+        for tenant in sys.argv[1:]:
+            asyncio.run(provision(tenant))
+        sys.exit()
+    config = Config()
+    config.bind = [host + ':' + str(hosted['port'])]
+    asyncio.run(serve(tenants_app, config))
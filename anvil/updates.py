@@ -0,0 +1,89 @@
+'''
+Server-sent events of an actor's state, for the apps' pages and for programmatic subscribers:
+
+1. Each app has a hub, GET /events subscribes to it.
+2. A subscriber gets the actor's view state in full first ('state'), then the keys that changed with each request ('delta').
+3. Apps publish other events as they happen, e.g. 'inbox' for a new message or 'proof_verified'.
+4. A subscriber that falls behind is sent the full state again, rather than holding up the app.
+
+With no subscribers, nothing is computed.
+
+The pages mark what depends on the state with show() (see static/updates.js), and apply each delta in place.
+'''
+
+import asyncio, json
+from jinja2 import pass_context
+from markupsafe import Markup
+
+
+QUEUE_SIZE = 64
+KEEPALIVE_SECONDS = 15
+
+
+class Hub:
+
+    def __init__(self, view_state):
+        self.view_state = view_state
+        self.state = None
+        self.subscribers = set()
+
+    def subscribe(self):
+        queue = asyncio.Queue(QUEUE_SIZE)
+        self.subscribers.add(queue)
+        if self.state is None:
+            self.state = self.view_state()
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            self.state = None
+
+    def publish(self, event, data):
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(('state', self.state))
+
+    # Publishes the keys of the view state that changed since the last refresh.
+    def refresh(self):
+        if not self.subscribers:
+            return
+        state = self.view_state()
+        delta = {key: value for key, value in state.items() if self.state.get(key) != value}
+        self.state = state
+        if delta:
+            self.publish('delta', delta)
+
+
+def format_event(event, data):
+    return 'event: ' + event + '\ndata: ' + json.dumps(data, default = str) + '\n\n'
+
+
+async def stream(hub):
+    queue = hub.subscribe()
+    try:
+        yield format_event('state', hub.state)
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                yield format_event(event, data)
+            except asyncio.TimeoutError:
+                # Comment line, keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+    finally:
+        hub.unsubscribe(queue)
+
+
+# True if every space separated term holds, where a term is flag, !flag, or a|b for either.
+def holds(state, expression):
+    return all(any(not state.get(flag[1:]) if flag.startswith('!') else bool(state.get(flag)) for flag in term.split('|')) for term in expression.split())
+
+
+# Template global: marks an element to show while the expression holds, hidden until then.
+@pass_context
+def show(context, expression):
+    return Markup('data-show="%s"%s') % (expression, '' if holds(context, expression) else Markup(' hidden'))
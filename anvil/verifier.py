@@ -1,9 +1,14 @@
 import os, requests, json, time, asyncio, subprocess
 from quart import Quart, render_template, redirect, url_for, request
-from common import common_setup, common_respond, common_get_verinym, common_reset, common_connection_request, common_establish_channel, common_verinym_request
+from common import common_setup, common_respond, common_get_verinym, common_reset, common_connection_request, common_establish_channel, common_verinym_request, common_enqueue, common_post, common_instrument, common_admission, common_state, common_run, common_updates, common_publish, common_form, common_api, common_soft, common_soft_reset
+from api import APIError, action, optional, as_string
+from inbox import setup_inboxes, peek, take, dead_letter, clear_inboxes
 from sovrin.schema import create_schema, create_credential_definition
 from sovrin.credentials import offer_credential, create_and_send_credential
-from sovrin.proofs import request_proof_of_credential, verify_proof
+from sovrin.proofs import verify_proof, proof_templates, register_adhoc_template, load_proof_templates, request_proof_from_template
+from sovrin.retention import retention_from_env, retire_artefacts, VERIFIER_ARTEFACTS
+from sovrin.events import log
+from sovrin.deadlines import DeadlineExceeded
 from fetch.agents import search, purchase_service
 app = Quart(__name__)
 
@@ -16,14 +21,23 @@ prover_port = 5002
 
 # We use globals for our server-side session since this is not supported in Quart yet.
 verifier = {}
-request_ip = anchor_ip = received_data = counterparty_name = False
+anchor_ip = counterparty_name = False
 pool_handle = 1
+retention = retention_from_env()
+inboxes = setup_inboxes(['receive', 'proof_inbox'])
+common_instrument(app, inboxes, 'verifier')
+# The routes peers call, and those of them that decrypt or write to the ledger straight away
+common_admission(app, ['/receive', '/establish_channel', '/verinym_request', '/proof_inbox'], ['/establish_channel', '/verinym_request'], 'verifier')
+common_state(app, 'verifier', globals(), ['verifier', 'anchor_ip', 'counterparty_name', 'inboxes'])
+load_proof_templates(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_data'))
 
 
-@app.route('/')
-def index():
+# Flags for the page and for /events subscribers.
+def view_state():
     setup = True if verifier else False
-    have_data = True if received_data else False
+    connection_request = peek(inboxes['receive'])
+    have_data = True if connection_request else False
+    request_ip = connection_request['sender'] if connection_request else False
     responded = True if 'connection_response' in verifier else False
     '''
     The onboardee depends on the anchor to finish establishing the secure channel.
@@ -36,64 +50,111 @@ def index():
     prover_registered = True if 'prover_ip' in verifier else False
     have_verinym = True if 'did_info' in verifier else False
     credential_requested = True if 'authcrypted_cred_request' in verifier else False
-    have_proof = True if 'authcrypted_proof' in verifier else False
+    have_proof = True if inboxes['proof_inbox']['messages'] else False
     search_results = verifier['search_results'].strip('"[]\'').replace(',', ', ') if 'search_results' in verifier else False
-    return render_template('verifier.html', actor = 'VERIFIER', setup = setup, have_data = have_data, request_ip = request_ip, responded = responded, channel_established = channel_established, have_verinym = have_verinym, prover_registered = prover_registered, credential_requested = credential_requested, have_proof = have_proof, search_results = search_results)
- 
+    return {
+        'setup': setup,
+        'have_data': have_data,
+        'request_ip': request_ip,
+        'responded': responded,
+        'channel_established': channel_established,
+        'have_verinym': have_verinym,
+        'prover_registered': prover_registered,
+        'credential_requested': credential_requested,
+        'have_proof': have_proof,
+        'search_results': search_results
+    }
 
-@app.route('/setup', methods = ['GET', 'POST'])
-async def setup():
+
+@app.route('/')
+def index():
+    return render_template('verifier.html', actor = 'VERIFIER', **view_state())
+
+
+common_updates(app, view_state)
+actions = {}
+common_api(app, 'verifier', actions, view_state)
+
+
+@action(actions, 'setup')
+async def do_setup(fields):
     global verifier, pool_handle
+    if verifier:
+        raise APIError('conflict', 'Already set up. Reset first.')
     verifier, pool_handle = await common_setup('verifier')
-    return redirect(url_for('index'))
+
+
+@app.route('/setup', methods = ['GET', 'POST'])
+async def setup():
+    return await common_form(do_setup)
 
 
 '''
 Rudimentary Fetch search engine.
 Fairly easy to flesh out given the rich query sub-language – see Fetch SDK docs.
 '''
-@app.route('/search_for_services', methods = ['GET', 'POST'])
-async def search_for_services():
+@action(actions, 'search_for_services', searchterms = str)
+async def do_search_for_services(fields):
     global verifier
-    form = await request.form
-    search_terms = form['searchterms'].replace(' ', '_').replace(',', '_')
+    search_terms = fields['searchterms'].replace(' ', '_').replace(',', '_')
     verifier['search_terms'] = search_terms
-    search(search_terms)
+    await search(search_terms)
     if os.path.isfile('search_results.json'):
         with open('search_results.json') as file_:
             verifier['search_results'] = json.load(file_)
-    return redirect(url_for('index'))
+    return {'results': verifier.get('search_results')}
+
+
+@app.route('/search_for_services', methods = ['GET', 'POST'])
+async def search_for_services():
+    return await common_form(do_search_for_services)
 
 
 
 @app.route('/receive', methods = ['GET', 'POST'])
 async def data():
-    global received_data, request_ip
-    received_data = await request.data
-    request_ip = request.remote_addr
-    print(received_data)
-    return '200'
+    log('message_received', 'Message received', route = '/receive', sender = request.remote_addr, payload = await request.data)
+    return await common_enqueue(inboxes['receive'])
+
+
+@action(actions, 'respond')
+async def do_respond(fields):
+    global verifier, anchor_ip
+    message = peek(inboxes['receive'])
+    if not message:
+        raise APIError('nothing_pending', 'No connection request waiting.')
+    verifier, anchor_ip = await common_respond(verifier, message['data'], pool_handle, anchor_port, message['sender'])
+    take(inboxes['receive'])
+    return {'anchor_ip': anchor_ip}
 
 
 @app.route('/respond', methods = ['GET', 'POST'])
 async def respond():
-    global verifier, anchor_ip
-    verifier, anchor_ip = await common_respond(verifier, received_data, pool_handle, anchor_port)
-    return redirect(url_for('index'))
+    return await common_form(do_respond)
 
 
-@app.route('/get_verinym', methods = ['GET', 'POST'])
-async def get_verinym():
+@action(actions, 'get_verinym')
+async def do_get_verinym(fields):
     global verifier
     verifier = await common_get_verinym(verifier, anchor_ip, anchor_port)
-    return redirect(url_for('index'))
+    return {'did': verifier['did']}
+
+
+@app.route('/get_verinym', methods = ['GET', 'POST'])
+async def get_verinym():
+    return await common_form(do_get_verinym)
+
+
+@action(actions, 'connection_request', ip_address = str, name = str)
+async def do_connection_request(fields):
+    global verifier, counterparty_name
+    verifier, counterparty_name = await common_connection_request(verifier, fields['ip_address'], fields['name'])
+    return {'name': counterparty_name}
 
 
 @app.route('/connection_request', methods = ['GET', 'POST'])
 async def connection_request():
-    global verifier, counterparty_name
-    verifier, counterparty_name = await common_connection_request(verifier)
-    return redirect(url_for('index'))
+    return await common_form(do_connection_request)
 
 
 @app.route('/establish_channel', methods = ['GET', 'POST'])
@@ -112,61 +173,102 @@ async def verinym_request():
     return '200'
 
 
-@app.route('/request_proof', methods = ['GET', 'POST'])
-async def request_proof():
+'''
+Proof requests have 2 parts:
+1. Request: the requested attributes/predicates (to be sent to prover).
+2. Assertions: the assertions about the attributes/predicates to ensure are true.
+Either give the name of a registered template (e.g. degree_example) or the full JSON,
+which is registered as a template on first use (see register_adhoc_template() in sovrin/proofs.py).
+'''
+@action(actions, 'request_proof', proofrequest = (str, dict))
+async def do_request_proof(fields):
     global verifier
+    if 'prover_ip' not in verifier:
+        raise APIError('nothing_pending', 'No prover connected.')
     try:
-        form = await request.form
-        json_request = json.loads(form['proofrequest'])
-        '''
-        Proof requests have 2 parts:
-        1. Request: the requested attributes/predicates (to be sent to prover).
-        2. Assertions: the assertions about the attributes/predicates to ensure are true.
-        '''
-        request_json_string = json.dumps(json_request['request'])
-        verifier['assertions_to_make'] = json_request['assertions_to_make']
-        verifier, proof_request = await request_proof_of_credential(verifier, request_json_string)
-        requests.post('http://' + verifier['prover_ip'] + ':' + str(prover_port) + '/proof_request', proof_request)
-        return redirect(url_for('index'))
-    except:
-        return 'Invalid proof request. Check formatting.'
+        name = as_string(fields['proofrequest']).strip()
+        if name not in proof_templates:
+            name = register_adhoc_template(name)
+        verifier, proof_request = await request_proof_from_template(verifier, name)
+    except Exception as ex:
+        raise APIError('invalid_request', 'Invalid proof request. Check formatting.', repr(ex))
+    await common_post('http://' + verifier['prover_ip'] + ':' + str(prover_port) + '/proof_request', proof_request)
+    return {'template': name}
+
+
+@app.route('/request_proof', methods = ['GET', 'POST'])
+async def request_proof():
+    return await common_form(do_request_proof)
 
 
 @app.route('/proof_inbox', methods = ['GET', 'POST'])
 async def proof_inbox():
-    global verifier
-    verifier['authcrypted_proof'] = await request.data
-    return '200'
+    return await common_enqueue(inboxes['proof_inbox'])
+
+
+@action(actions, 'verify')
+async def do_verify(fields):
+    global verifier, retention
+    message = peek(inboxes['proof_inbox'])
+    if not message:
+        raise APIError('nothing_pending', 'No proof waiting.')
+    try:
+        verifier['authcrypted_proof'] = message['data']
+        # A template given in full may have made way for newer ones since, its assertions are kept with the request
+        template = proof_templates.get(verifier['proof_template'])
+        verifier = await verify_proof(verifier, template['check'] if template else verifier['assertions_to_make'])
+    except DeadlineExceeded:
+        # Left queued, to be verified again when there is time
+        raise
+    except ValueError as ex:
+        # Rejected by one of the verification stages, see verifier['verification_report']
+        dead_letter(inboxes['proof_inbox'], repr(ex))
+        common_publish('proof_rejected', verifier.get('verification_report'))
+        raise APIError('rejected', 'Proof invalid. ' + str(ex), verifier.get('verification_report'))
+    except Exception as ex:
+        # Moved aside too, so the next proof can be verified
+        dead_letter(inboxes['proof_inbox'], repr(ex))
+        raise APIError('invalid_request', 'Proof invalid. Potentially check your own assertions on the values.', repr(ex))
+    # Hide verify function until next proof received
+    take(inboxes['proof_inbox'])
+    report = verifier['verification_report']
+    retention, verifier = retire_artefacts(retention, verifier, VERIFIER_ARTEFACTS)
+    common_publish('proof_verified', report)
+    return {'report': report}
 
 
 @app.route('/verify', methods = ['GET', 'POST'])
 async def verify():
-    global verifier
-    try:
-        verifier = await verify_proof(verifier, verifier['assertions_to_make'])
-        # Hide verify function until next proof received
-        verifier.pop('authcrypted_proof', None)
-        return redirect(url_for('index'))
-    except:
-        return 'Proof invalid. Potentially check your own assertions on the values.'
+    return await common_form(do_verify)
+
+
+@action(actions, 'purchase_service', maxprice = (str, int, float))
+async def do_purchase_service(fields):
+    if 'search_terms' not in verifier:
+        raise APIError('nothing_pending', 'Search for services first.')
+    await purchase_service(fields['maxprice'], verifier['search_terms'])
 
 
 @app.route('/purchase_service', methods = ['GET', 'POST'])
 async def purchase_service_():
-    form = await request.form
-    max_price = form['maxprice']
-    search_terms = verifier['search_terms']
-    purchase_service(max_price, search_terms)
-    return redirect(url_for('index'))
+    return await common_form(do_purchase_service)
 
 
-@app.route('/reset')
-async def reset():
-    global verifier, pool_handle, received_data, anchor_ip
+@action(actions, 'reset', soft = optional(bool))
+async def do_reset(fields):
+    global verifier, pool_handle, anchor_ip
+    if common_soft(fields):
+        # The proof request waiting for a proof goes too
+        verifier = common_soft_reset(verifier, inboxes, VERIFIER_ARTEFACTS + ['proof_request', 'proof_template', 'assertions_to_make'])
+        return {'soft': True}
     verifier, pool_handle = await common_reset([verifier], pool_handle)
-    received_data = False
+    clear_inboxes(inboxes)
     anchor_ip = False
-    return redirect(url_for('index'))
+
+
+@app.route('/reset', methods = ['GET', 'POST'])
+async def reset():
+    return await common_form(do_reset)
 
 
 @app.route('/reload')
@@ -176,4 +278,4 @@ def reload():
 
 if __name__ == '__main__':
     app.secret_key = os.getenv('ANVIL_KEY', 'MUST_BE_STATIC')
-    app.run(host, port, debug)
+    common_run(app, 'verifier', host, port, debug)